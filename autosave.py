@@ -0,0 +1,198 @@
+'''
+Atomic file writes and the autosave journal of the editor.
+
+``atomic_write`` writes a temporary file next to the target and moves it
+over the target with ``os.replace``, so a crash leaves either the old or the
+new file, never a part of one.
+
+A ``PatchJournal`` keeps the unsaved edits of a text as a diff against its
+original: one JSON line of header, then one line per autosave with the hunks
+dropped and added since the previous one.  Hunks are keyed by their range
+in the original, which edits elsewhere never move, so an autosave writes
+only the hunks that changed, however large the file.  The journal is
+rewritten as a single record once the appended records outgrow it.
+
+>>> journal = PatchJournal('unused', {'sha1': '0'})
+>>> data, rewrite = journal.update({(1, 2): ['B']}, lambda key, value: value)
+>>> rewrite
+True
+>>> data, rewrite = journal.update({(1, 2): ['B'], (3, 3): ['x']}, lambda key, value: value)
+>>> data, rewrite
+('{"drop": [], "add": [[3, 3, ["x"]]]}\\n', False)
+>>> apply_hunks(['a', 'b', 'c'], {(1, 2): ['B'], (3, 3): ['x']})
+['a', 'B', 'c', 'x']
+'''
+import json
+import os
+import tempfile
+
+
+def atomic_write(path, data):
+    ''' Replace the file at ``path`` by the bytes ``data`` in one step '''
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temp_path = tempfile.mkstemp(prefix='.%s.' % os.path.basename(path), suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(handle, 'wb') as out_file:
+            out_file.write(data)
+            out_file.flush()
+            os.fsync(out_file.fileno())
+        try:
+            os.chmod(temp_path, os.stat(path).st_mode & 0o7777)
+        except FileNotFoundError:
+            pass
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+    # Make the rename itself durable where directories can be opened.
+    try:
+        directory_handle = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(directory_handle)
+    except OSError:
+        pass
+    finally:
+        os.close(directory_handle)
+
+
+class PatchJournal:
+    '''
+    Journal at ``path`` of the hunks turning an original into the working
+    copy, with ``header`` describing the original.
+
+    ``update`` works out what changed since the last call and returns the
+    text to write; the writing itself is left to the caller, usually off
+    the GUI thread with ``write_journal``.
+    '''
+
+    def __init__(self, path, header):
+        self.path = path
+        self.header = header
+        # (old_start, old_end) -> value of every hunk written so far, None
+        # until the journal was written.
+        self._hunks = None
+        self._lines = {}
+        self._appended = 0
+        self._size = 0
+
+    def update(self, hunks, get_lines):
+        '''
+        Bring the journal to ``hunks``.
+
+        :param hunks: dict of ``(old_start, old_end)`` to a value standing
+                      for the new lines of the hunk; equal values mean equal
+                      lines
+        :param get_lines: ``get_lines(key, value)`` returns the lines of a
+                          hunk that has to be written
+        :return: ``(data, rewrite)``: the text to append to the journal, or
+                 with ``rewrite`` the whole journal to write instead; data
+                 is None when nothing changed
+        '''
+        if self._hunks is None:
+            return self._rewrite(hunks, get_lines)
+
+        previous = self._hunks
+        drop = [key for key in previous if key not in hunks]
+        add = [key for key, value in hunks.items() if previous.get(key) != value]
+        if not drop and not add:
+            return None, False
+
+        for key in drop:
+            self._size -= self._lines.pop(key)
+        added = []
+        for key in add:
+            lines = get_lines(key, hunks[key])
+            self._size -= self._lines.get(key, 0)
+            self._lines[key] = len(json.dumps(lines))
+            self._size += self._lines[key]
+            added.append([key[0], key[1], lines])
+        self._hunks = dict(hunks)
+
+        data = json.dumps({'drop': [list(key) for key in drop], 'add': added}) + '\n'
+        self._appended += len(data)
+        if self._appended > 2 * self._size + 65536:
+            return self._rewrite(hunks, get_lines)
+
+        return data, False
+
+    def forget(self):
+        ''' The values given so far are no longer comparable, write everything next time '''
+        self._hunks = None
+
+    def _rewrite(self, hunks, get_lines):
+        self._hunks = dict(hunks)
+        self._lines = {}
+        added = []
+        for key, value in hunks.items():
+            lines = get_lines(key, value)
+            self._lines[key] = len(json.dumps(lines))
+            added.append([key[0], key[1], lines])
+        self._size = sum(self._lines.values())
+
+        data = json.dumps(self.header) + '\n' + json.dumps({'drop': [], 'add': added}) + '\n'
+        self._appended = 0
+        return data, True
+
+
+def write_journal(path, data, rewrite):
+    ''' Write what ``PatchJournal.update`` returned '''
+    if rewrite:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        atomic_write(path, data.encode('utf-8'))
+        return
+
+    with open(path, 'a', encoding='utf-8') as out_file:
+        out_file.write(data)
+        out_file.flush()
+        os.fsync(out_file.fileno())
+
+
+def remove_journal(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def read_journal(path):
+    '''
+    Replay the journal at ``path``: ``(header, hunks)`` with hunks a dict of
+    ``(old_start, old_end)`` to lines, or None when there is no readable
+    journal.  A record cut short by a crash ends the replay.
+    '''
+    try:
+        with open(path, encoding='utf-8') as in_file:
+            header = json.loads(in_file.readline())
+            hunks = {}
+            for line in in_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                for start, end in record['drop']:
+                    hunks.pop((start, end), None)
+                for start, end, lines in record['add']:
+                    hunks[start, end] = lines
+    except (OSError, ValueError):
+        return None
+
+    return header, hunks
+
+
+def apply_hunks(original, hunks):
+    ''' The lines of ``original`` with the journaled ``hunks`` applied '''
+    lines = []
+    pos = 0
+    for (start, end), new in sorted(hunks.items()):
+        lines.extend(original[pos:start])
+        lines.extend(new)
+        pos = end
+    lines.extend(original[pos:])
+
+    return lines
@@ -0,0 +1,350 @@
+'''
+Diff many file pairs without Qt.
+
+Compares two files, or every file of two directory trees, with the line diff
+of the editor and prints the result as unified diff or as one JSON object per
+pair.  Pairs are spread over a process pool and printed in order as they are
+done; identical files are recognised by size and content before any decoding
+or diffing.  Throughput is reported on stderr.
+
+With ``--base`` the two files or trees are merged instead, as ours and
+theirs against the common base, and the merged text is written with the
+conflicts between markers.
+
+    python -m batch_diff old.py new.py
+    python -m batch_diff --format jsonl -j 8 build/expected build/actual
+    python -m batch_diff --base base.py -o merged.py ours.py theirs.py
+'''
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from diff_engine import diff_lines, merge3
+
+
+def read_lines(data):
+    '''
+    Split decoded text into lines that keep their '\\n', like the editor
+    splits on '\\n' only.
+    '''
+    text = data.decode('utf-8', 'replace')
+    lines = [line + '\n' for line in text.split('\n')]
+    last = lines.pop()
+    if last != '\n':
+        lines.append(last[:-1])
+
+    return lines
+
+
+def unified_diff(old, new, hunks, old_name, new_name, context=3):
+    ''' Yield the lines of a unified diff of ``old`` and ``new`` from ``hunks`` '''
+    if not hunks:
+        return
+
+    yield '--- %s\n' % old_name
+    yield '+++ %s\n' % new_name
+
+    group = [hunks[0]]
+    for hunk in hunks[1:]:
+        if hunk.old_start - group[-1].old_end > 2 * context:
+            yield from _unified_group(old, new, group, context)
+            group = []
+        group.append(hunk)
+    yield from _unified_group(old, new, group, context)
+
+
+def _unified_group(old, new, group, context):
+    old_lo = max(group[0].old_start - context, 0)
+    old_hi = min(group[-1].old_end + context, len(old))
+    new_lo = group[0].new_start - (group[0].old_start - old_lo)
+    new_hi = group[-1].new_end + (old_hi - group[-1].old_end)
+
+    yield '@@ -%s +%s @@\n' % (_unified_range(old_lo, old_hi), _unified_range(new_lo, new_hi))
+
+    pos = old_lo
+    for hunk in group:
+        for line in old[pos:hunk.old_start]:
+            yield from _unified_line(' ', line)
+        for line in old[hunk.old_start:hunk.old_end]:
+            yield from _unified_line('-', line)
+        for line in new[hunk.new_start:hunk.new_end]:
+            yield from _unified_line('+', line)
+        pos = hunk.old_end
+    for line in old[pos:old_hi]:
+        yield from _unified_line(' ', line)
+
+
+def _unified_range(lo, hi):
+    # An empty range names the line before it, as diff -u does.
+    if hi - lo == 1:
+        return '%d' % (lo + 1)
+    return '%d,%d' % (lo + 1 if hi > lo else lo, hi - lo)
+
+
+def _unified_line(prefix, line):
+    if line.endswith('\n'):
+        yield prefix + line
+    else:
+        yield prefix + line + '\n'
+        yield '\\ No newline at end of file\n'
+
+
+def diff_pair(pair, output='unified', context=3):
+    '''
+    Diff one ``(old_path, new_path)`` pair, either path may be None.
+
+    Returns ``(status, lines, text)``: status is 'identical', 'modified',
+    'added', 'removed' or 'binary', lines the number of lines read and text
+    the rendered output for the pair.  A file that cannot be read gives the
+    status 'error' and the message as text.
+
+    >>> diff_pair(('no/such/old.py', 'no/such/new.py'))
+    ('error', 0, "[Errno 2] No such file or directory: 'no/such/old.py'\\n")
+    '''
+    try:
+        return _diff_pair(pair, output, context)
+    except OSError as error:
+        return 'error', 0, '%s\n' % error
+
+
+def _diff_pair(pair, output, context):
+    old_path, new_path = pair
+
+    if old_path is not None and new_path is not None and os.path.getsize(old_path) == os.path.getsize(new_path):
+        with open(old_path, 'rb') as old_file, open(new_path, 'rb') as new_file:
+            old_data = old_file.read()
+            new_data = new_file.read()
+        if old_data == new_data:
+            return 'identical', 0, _render(output, 'identical', pair, [], 0, 0, '')
+    else:
+        old_data = _read(old_path)
+        new_data = _read(new_path)
+
+    if b'\0' in old_data or b'\0' in new_data:
+        text = 'Binary files %s and %s differ\n' % (old_path or '/dev/null', new_path or '/dev/null')
+        return 'binary', 0, _render(output, 'binary', pair, [], 0, 0, text)
+
+    old = read_lines(old_data)
+    new = read_lines(new_data)
+    hunks = diff_lines(old, new)
+
+    status = 'modified'
+    if old_path is None:
+        status = 'added'
+    elif new_path is None:
+        status = 'removed'
+
+    text = ''
+    if output == 'unified':
+        text = ''.join(unified_diff(old, new, hunks, old_path or '/dev/null', new_path or '/dev/null', context))
+    removed = sum(hunk.old_end - hunk.old_start for hunk in hunks)
+    added = sum(hunk.new_end - hunk.new_start for hunk in hunks)
+
+    return status, len(old) + len(new), _render(output, status, pair, hunks, added, removed, text)
+
+
+def _read(path):
+    if path is None:
+        return b''
+    with open(path, 'rb') as in_file:
+        return in_file.read()
+
+
+def _render(output, status, pair, hunks, added, removed, text):
+    if output == 'jsonl':
+        record = {
+            'old': pair[0],
+            'new': pair[1],
+            'status': status,
+            'added': added,
+            'removed': removed,
+            'hunks': [list(hunk) for hunk in hunks],
+        }
+        return json.dumps(record) + '\n'
+    return text
+
+
+def _diff_pair_star(args):
+    return diff_pair(*args)
+
+
+def file_pairs(old, new):
+    ''' Pairs of paths to compare for two files or two directory trees '''
+    if not (os.path.isdir(old) and os.path.isdir(new)):
+        return [(old, new)]
+
+    old_files = set(_relative_files(old))
+    new_files = set(_relative_files(new))
+    pairs = []
+    for name in sorted(old_files | new_files):
+        pairs.append((os.path.join(old, name) if name in old_files else None,
+                      os.path.join(new, name) if name in new_files else None))
+
+    return pairs
+
+
+def merge_triple(triple, diff3=False):
+    '''
+    Merge one ``(ours_path, base_path, theirs_path)`` triple, any path may be
+    None for a file that does not exist on that side.
+
+    Returns ``(status, conflicts, data)``: status is 'clean', 'conflict' or
+    'binary', conflicts the number of conflicting regions and data the
+    merged bytes, None when the merge deletes the file.  A binary file that
+    both sides changed keeps ours.  With ``diff3`` the base lines of a
+    conflict are written too.
+    '''
+    ours_path, base_path, theirs_path = triple
+    base, ours, theirs = _read(base_path), _read(ours_path), _read(theirs_path)
+
+    # Whole files changed on one side only need no decoding or diffing.
+    if theirs == base or theirs == ours:
+        return 'clean', 0, None if ours_path is None else ours
+    if ours == base:
+        return 'clean', 0, None if theirs_path is None else theirs
+    if b'\0' in base or b'\0' in ours or b'\0' in theirs:
+        return 'binary', 1, ours
+
+    # Lines split on '\n' only and surrogateescape keep the bytes as they are.
+    base, ours, theirs = (data.decode('utf-8', 'surrogateescape').split('\n') for data in (base, ours, theirs))
+    markers = ('<<<<<<< %s' % (ours_path or '/dev/null'), '=======',
+               '>>>>>>> %s' % (theirs_path or '/dev/null'))
+    base_marker = '||||||| %s' % (base_path or '/dev/null') if diff3 else None
+    merge = merge3(base, ours, theirs, markers, base_marker)
+
+    data = '\n'.join(merge.lines).encode('utf-8', 'surrogateescape')
+    return 'conflict' if merge.conflicts else 'clean', len(merge.conflicts), data
+
+
+def _merge_triple_star(args):
+    return merge_triple(*args)
+
+
+def file_triples(ours, base, theirs):
+    '''
+    Triples of paths to merge for three files or three directory trees, with
+    the path of the result relative to the output
+    '''
+    if not (os.path.isdir(ours) and os.path.isdir(base) and os.path.isdir(theirs)):
+        return [((ours, base, theirs), None)]
+
+    files = [set(_relative_files(root)) for root in (ours, base, theirs)]
+    triples = []
+    for name in sorted(files[0] | files[1] | files[2]):
+        triples.append((tuple(os.path.join(root, name) if name in names else None
+                              for root, names in zip((ours, base, theirs), files)), name))
+
+    return triples
+
+
+def merge_main(args, parser):
+    '''
+    Merge ``args.old`` (ours) and ``args.new`` (theirs) against ``args.base``;
+    the exit status is 1 when a conflict is left.
+    '''
+    triples = file_triples(args.old, args.base, args.new)
+    if triples[0][1] is not None and not args.output:
+        parser.error('merging directories needs --output')
+
+    tasks = [(triple, args.diff3) for triple, _ in triples]
+    start = time.perf_counter()
+    counts = {}
+    executor = None
+    if args.jobs > 1 and len(tasks) > 1:
+        executor = ProcessPoolExecutor(max_workers=args.jobs)
+        results = executor.map(_merge_triple_star, tasks, chunksize=max(1, min(64, len(tasks) // (4 * args.jobs))))
+    else:
+        results = map(_merge_triple_star, tasks)
+
+    try:
+        for (triple, name), (status, conflicts, data) in zip(triples, results):
+            counts[status] = counts.get(status, 0) + 1
+            if conflicts and not args.quiet:
+                print('%s: %d conflicts' % (name or triple[0], conflicts), file=sys.stderr)
+
+            path = args.output if name is None else os.path.join(args.output, name)
+            if path is None:
+                sys.stdout.buffer.write(data or b'')
+            elif data is not None:
+                os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                with open(path, 'wb') as out_file:
+                    out_file.write(data)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    summary = ', '.join('%d %s' % (count, status) for status, count in sorted(counts.items()))
+    print('%d files (%s) in %.2fs: %.0f files/s' % (len(triples), summary or 'none', elapsed,
+                                                    len(triples) / elapsed), file=sys.stderr)
+
+    return 1 if set(counts) - {'clean'} else 0
+
+
+def _relative_files(root):
+    for directory, _, names in os.walk(root):
+        for name in names:
+            yield os.path.relpath(os.path.join(directory, name), root)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('old', help='original file or directory, ours with --base')
+    parser.add_argument('new', help='changed file or directory, theirs with --base')
+    parser.add_argument('--format', choices=('unified', 'jsonl'), default='unified')
+    parser.add_argument('-U', '--context', type=int, default=3, help='lines of context in unified output')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='worker processes')
+    parser.add_argument('-q', '--quiet', action='store_true', help='only print the summary')
+    parser.add_argument('--base', help='merge old and new against this common base file or directory')
+    parser.add_argument('-o', '--output', help='merged file or directory, stdout by default')
+    parser.add_argument('--diff3', action='store_true', help='also write the base lines of a conflict')
+    args = parser.parse_args(argv)
+
+    if args.base:
+        return merge_main(args, parser)
+
+    pairs = file_pairs(args.old, args.new)
+    tasks = [(pair, args.format, args.context) for pair in pairs]
+
+    start = time.perf_counter()
+    counts = {}
+    lines = 0
+    if args.jobs > 1 and len(tasks) > 1:
+        executor = ProcessPoolExecutor(max_workers=args.jobs)
+        results = executor.map(_diff_pair_star, tasks, chunksize=max(1, min(64, len(tasks) // (4 * args.jobs))))
+    else:
+        executor = None
+        results = map(_diff_pair_star, tasks)
+
+    try:
+        for status, pair_lines, text in results:
+            counts[status] = counts.get(status, 0) + 1
+            lines += pair_lines
+            if status == 'error':
+                sys.stderr.write(text)
+            elif text and not args.quiet:
+                sys.stdout.write(text)
+    except BrokenPipeError:
+        # The reader went away, as with ``| head``; stop quietly.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 1
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    summary = ', '.join('%d %s' % (count, status) for status, count in sorted(counts.items()))
+    print('%d pairs (%s) in %.2fs: %.0f files/s, %.0f lines/s' % (
+        len(pairs), summary or 'none', elapsed, len(pairs) / elapsed, lines / elapsed), file=sys.stderr)
+
+    # Like diff: 2 when a file could not be read, 1 when files differ.
+    if 'error' in counts:
+        return 2
+    return 1 if set(counts) - {'identical'} else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,79 @@
+'''
+Micro-benchmark of the line number bar of the base pane.
+
+Shows a diff of ``--lines`` lines with an edit every few hundred lines,
+scrolls through it and prints the paint time per frame of the number bar,
+as recorded in NumberBar.paint_time.
+
+    python benchmarks/bench_gutter.py --lines 100000 --frames 200
+'''
+import argparse
+import os
+import random
+import sys
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from PySide6.QtWidgets import QApplication
+
+from diff_engine import IncrementalDiff
+from text_model import TextModel
+
+
+def edited(lines, seed=0, every=300):
+    ''' Copy of ``lines`` with one line inserted or deleted per ``every`` lines '''
+    new = list(lines)
+    rng = random.Random(seed)
+    for _ in range(len(lines) // every):
+        row = rng.randrange(len(new))
+        if rng.random() < 0.5:
+            del new[row]
+        else:
+            new.insert(row, 'inserted %d' % row)
+
+    return new
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--lines', type=int, default=100000)
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--height', type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+
+    from main import MainWindow
+    window = MainWindow()
+    window.resize(1200, args.height)
+    window.show()
+
+    lines = ['line %d' % i for i in range(args.lines)]
+    model = TextModel(lines)
+    window.reset_diff(model)
+    window.print_output(IncrementalDiff(model.original, model.intern_lines(edited(lines))))
+    app.processEvents()
+
+    number_bar = window._editor_base.number_bar
+    scroll_bar = window._editor_base.edit.verticalScrollBar()
+    step = max(1, scroll_bar.maximum() // args.frames)
+
+    times = []
+    for value in range(0, scroll_bar.maximum(), step):
+        scroll_bar.setValue(value)
+        number_bar.repaint()
+        times.append(number_bar.paint_time)
+
+    times.sort()
+    print('frames %d, rows per frame %d' % (len(times), args.height // number_bar.fontMetrics().height()))
+    print('p50 %.2f ms  p99 %.2f ms  max %.2f ms' % (
+        times[len(times) // 2] * 1000, times[int(len(times) * 0.99)] * 1000, times[-1] * 1000))
+
+    window.close()
+    return times
+
+
+if __name__ == '__main__':
+    main()
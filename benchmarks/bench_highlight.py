@@ -0,0 +1,89 @@
+'''
+Micro-benchmark of Highlighter.highlightBlock.
+
+Highlights test.py-style source with the rules of MainWindow and prints
+blocks per second for the former per-rule re.finditer loop ("before") and the
+combined single-pass regex ("after").
+
+    python benchmarks/bench_highlight.py --lines 20000 --repeat 5
+'''
+import argparse
+import os
+import re
+import sys
+import time
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from PySide6.QtGui import QTextDocument
+from PySide6.QtWidgets import QApplication
+
+from code_editor import Highlighter
+
+
+class LegacyHighlighter(Highlighter):
+    ''' highlightBlock as it was: every rule rescans the block '''
+
+    def highlightBlock(self, text):
+        for pattern, format in self._mappings.items():
+            for match in re.finditer(pattern, text):
+                start, end = match.span()
+                self.setFormat(start, end - start, format)
+
+
+def sample_source(lines):
+    with open(os.path.join(ROOT, 'test.py')) as in_file:
+        source = in_file.read().split('\n')
+
+    return '\n'.join(source[i % len(source)] for i in range(lines))
+
+
+def blocks_per_second(highlighter, document, repeat):
+    highlighter.setDocument(document)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        highlighter.rehighlight()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    highlighter.setDocument(None)
+    return document.blockCount() / best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--lines', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+
+    from main import MainWindow
+    window = MainWindow()
+    # The rules are installed with the other services after the first paint.
+    window.start_services()
+    mappings = window._highlighter._mappings
+
+    document = QTextDocument()
+    document.setPlainText(sample_source(args.lines))
+
+    results = {}
+    for name, cls in (('before', LegacyHighlighter), ('after', Highlighter)):
+        highlighter = cls(True, False)
+        for pattern, format in mappings.items():
+            highlighter.add_mapping(pattern, format)
+        results[name] = blocks_per_second(highlighter, document, args.repeat)
+
+    for name, rate in results.items():
+        print('%-6s %12.0f blocks/s' % (name, rate))
+    print('speedup %.2fx' % (results['after'] / results['before']))
+
+    window.deleteLater()
+    return results
+
+
+if __name__ == '__main__':
+    main()
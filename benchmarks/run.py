@@ -0,0 +1,257 @@
+'''
+Benchmark suite of the editor, with results saved as JSON.
+
+Runs offscreen and measures the full diff and a keystroke re-diffed and
+shown in the base pane on synthetic files of 1k to 1M lines,
+Highlighter.highlightBlock throughput, the paint time of the line number
+bar, the time open_file takes to load a file and find through the trigram
+index of a multi-megabyte file.  Results can be compared against a saved
+baseline; the exit status is 1 when a result got worse than the baseline by
+more than ``--tolerance``.
+
+    python benchmarks/run.py --output baseline.json
+    python benchmarks/run.py --baseline baseline.json --output current.json
+'''
+from array import array
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import PySide6
+from PySide6.QtCore import QEventLoop
+from PySide6.QtGui import QTextDocument
+from PySide6.QtWidgets import QApplication
+
+from bench_gutter import edited
+from bench_highlight import sample_source
+from code_editor import Highlighter
+from diff_engine import IncrementalDiff
+from search_index import Query, SearchIndex
+from text_model import TextModel
+
+
+SIZES = (1000, 10000, 100000, 1000000)
+# One edit per this many lines, for a sparse and a dense diff.
+DENSITIES = (1000, 30)
+
+
+def best_time(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def result(value, unit, better='lower'):
+    return {'value': value, 'unit': unit, 'better': better}
+
+
+def bench_diff(results, app, window, sizes, repeat):
+    '''
+    Full diff as run by DiffScheduler, and one keystroke re-diffed in place
+    and applied to the base pane of ``window``: marks, numbers and text
+    '''
+    for size in sizes:
+        lines = ['line %d' % i for i in range(size)]
+        for every in DENSITIES:
+            new = edited(lines, every=every)
+            model = TextModel(lines)
+
+            def full():
+                IncrementalDiff(model.original, model.intern_lines(new))
+
+            seconds = best_time(full, repeat)
+            results['diff.full.%d.every%d' % (size, every)] = result(seconds * 1000, 'ms')
+
+            window.reset_diff(model)
+            window.print_output(IncrementalDiff(model.original, model.intern_lines(new)))
+            app.processEvents()
+            diff = window._diff
+            row = size // 2
+            line_ids = array('i', [model.intern('typed'), diff.new[row]])
+
+            def keystroke():
+                for index in range(100):
+                    diff.apply_edit(row, 1, line_ids[index % 2:index % 2 + 1])
+                    window.apply_diff_patch(diff.realign())
+
+            seconds = best_time(keystroke, repeat) / 100
+            results['diff.keystroke.%d.every%d' % (size, every)] = result(seconds * 1e6, 'us')
+    window.new_file()
+
+
+def bench_highlight(results, window, lines, repeat):
+    document = QTextDocument()
+    document.setPlainText(sample_source(lines))
+
+    highlighter = Highlighter(True, False)
+    for pattern, format in window._highlighter._mappings.items():
+        highlighter.add_mapping(pattern, format)
+    highlighter.setDocument(document)
+
+    seconds = best_time(highlighter.rehighlight, repeat)
+    highlighter.setDocument(None)
+    results['highlight.%d' % lines] = result(document.blockCount() / seconds, 'blocks/s', 'higher')
+
+
+def bench_gutter(results, app, window, lines, frames):
+    source = ['line %d' % i for i in range(lines)]
+    model = TextModel(source)
+    window.reset_diff(model)
+    window.print_output(IncrementalDiff(model.original, model.intern_lines(edited(source))))
+    app.processEvents()
+
+    number_bar = window._editor_base.number_bar
+    scroll_bar = window._editor_base.edit.verticalScrollBar()
+    step = max(1, scroll_bar.maximum() // frames)
+
+    times = []
+    for value in range(0, scroll_bar.maximum(), step):
+        scroll_bar.setValue(value)
+        number_bar.repaint()
+        times.append(number_bar.paint_time)
+
+    times.sort()
+    results['gutter.p50.%d' % lines] = result(times[len(times) // 2] * 1000, 'ms')
+    results['gutter.p99.%d' % lines] = result(times[int(len(times) * 0.99)] * 1000, 'ms')
+    window.new_file()
+
+
+def bench_open(results, app, window, sizes):
+    for size in sizes:
+        with tempfile.NamedTemporaryFile('w', suffix='.py', delete=False) as out_file:
+            out_file.write(sample_source(size))
+        try:
+            start = time.perf_counter()
+            window.open_file(out_file.name)
+            while window._loading:
+                app.processEvents(QEventLoop.AllEvents, 50)
+            seconds = time.perf_counter() - start
+        finally:
+            os.unlink(out_file.name)
+
+        results['open.%d' % size] = result(seconds * 1000, 'ms')
+        window.new_file()
+
+
+def bench_find(results, lines, repeat):
+    ''' Index build, then queries over the whole text, one viewport and find next '''
+    source = sample_source(lines).split('\n')
+    source[lines // 2] = 'needle_%d = None' % lines
+    seconds = best_time(lambda: SearchIndex(source), 1)
+    results['find.index.%d' % lines] = result(seconds * 1000, 'ms')
+
+    index = SearchIndex(source)
+    queries = {
+        'rare': Query('needle_%d' % lines),
+        'regex': Query(r'needle_\d+ = ', regex=True),
+        'common': Query('print'),
+    }
+    for name, query in queries.items():
+        seconds = best_time(lambda: sum(1 for _ in index.find(query)), repeat)
+        results['find.all.%s.%d' % (name, lines)] = result(seconds * 1000, 'ms')
+
+    query = queries['common']
+    seconds = best_time(lambda: list(index.find(query, lines // 3, lines // 3 + 60)), repeat)
+    results['find.viewport.%d' % lines] = result(seconds * 1000, 'ms')
+    seconds = best_time(lambda: index.find_next(queries['rare'], 0, 0), repeat)
+    results['find.next.%d' % lines] = result(seconds * 1000, 'ms')
+
+    index.replace_lines(lines // 4, 1, ['typed'])
+    seconds = best_time(index.refresh, 1)
+    results['find.edit.%d' % lines] = result(seconds * 1000, 'ms')
+
+
+def compare(results, baseline, tolerance):
+    ''' Print results next to the baseline, return the names that regressed '''
+    regressed = []
+    print('%-32s %14s %14s %9s' % ('benchmark', 'baseline', 'current', 'change'))
+    for name, current in results.items():
+        before = baseline.get(name)
+        if before is None or not before['value']:
+            print('%-32s %14s %14.3f %9s' % (name, '-', current['value'], 'new'))
+            continue
+
+        change = current['value'] / before['value'] - 1
+        worse = change if current['better'] == 'lower' else -change
+        flag = ''
+        if worse > tolerance:
+            regressed.append(name)
+            flag = '  REGRESSION'
+        print('%-32s %14.3f %14.3f %+8.1f%%%s' % (name, before['value'], current['value'], change * 100, flag))
+
+    return regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON file of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='relative slowdown allowed before a result counts as a regression')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--quick', action='store_true', help='skip the 1M line cases')
+    parser.add_argument('--only', help='comma separated groups: diff, highlight, gutter, open, find')
+    args = parser.parse_args(argv)
+
+    sizes = [size for size in SIZES if not args.quick or size < 1000000]
+    groups = set(args.only.split(',')) if args.only else {'diff', 'highlight', 'gutter', 'open', 'find'}
+
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+
+    from main import MainWindow
+    window = MainWindow()
+    window.resize(1200, 1000)
+    window.show()
+    window.start_services()
+
+    results = {}
+    if 'diff' in groups:
+        bench_diff(results, app, window, sizes, args.repeat)
+    if 'highlight' in groups:
+        bench_highlight(results, window, 20000, args.repeat)
+    if 'gutter' in groups:
+        bench_gutter(results, app, window, 100000, 200)
+    if 'open' in groups:
+        bench_open(results, app, window, [size for size in sizes if size >= 10000])
+    if 'find' in groups:
+        bench_find(results, 200000, args.repeat)
+    window.close()
+
+    if args.output:
+        report = {
+            'meta': {
+                'python': platform.python_version(),
+                'pyside': PySide6.__version__,
+                'machine': platform.machine(),
+                'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            },
+            'results': results,
+        }
+        with open(args.output, 'w') as out_file:
+            json.dump(report, out_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as in_file:
+            baseline = json.load(in_file)['results']
+        return 1 if compare(results, baseline, args.tolerance) else 0
+
+    for name, current in results.items():
+        print('%-32s %14.3f %s' % (name, current['value'], current['unit']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,64 +1,544 @@
+from array import array
+from bisect import bisect_right
+from itertools import islice
 import os
 from pathlib import Path
 import sys
 import re
-from PySide6.QtCore import (QFile, Qt, QTextStream, QRect)
+import time
+from PySide6.QtCore import (QFile, Qt, QTextStream, QRect, QRectF, QPointF, Signal, QObject, QTimer, QEvent,
+                            QThreadPool)
 from PySide6.QtGui import (QColor, QFont, QFontDatabase, QKeySequence, QBrush,
-                           QSyntaxHighlighter, QTextCharFormat, QTextFormat, QPainter, QPen)
+                           QSyntaxHighlighter, QTextCharFormat, QTextCursor, QTextFormat, QPainter, QPen,
+                           QStaticText, QTextLayout)
 from PySide6.QtWidgets import (QApplication, QFileDialog, QMainWindow,
-                               QPlainTextEdit, QFrame, QWidget, QTextEdit, QHBoxLayout)
+                               QPlainTextEdit, QFrame, QWidget, QTextEdit, QHBoxLayout, QGridLayout,
+                               QLineEdit, QCheckBox, QPushButton, QLabel)
+
+from diff_engine import diff_inline, diff_lines
+import instrument
+from search_index import Query, SearchIndex
+from text_buffer import TextBuffer
+
+
+class _BlockRanges:
+    ''' Sorted, disjoint half open ranges of block numbers '''
+
+    def __init__(self):
+        self._ranges = []
+
+    def __bool__(self):
+        return bool(self._ranges)
+
+    def clear(self):
+        self._ranges = []
+
+    def add(self, start, end):
+        if start >= end:
+            return
+        ranges = self._ranges
+        lo = bisect_right(ranges, start, key=lambda item: item[1]) if ranges else 0
+        # Ranges touching [start, end) are merged into it.
+        while lo > 0 and ranges[lo - 1][1] >= start:
+            lo -= 1
+        hi = lo
+        while hi < len(ranges) and ranges[hi][0] <= end:
+            start = min(start, ranges[hi][0])
+            end = max(end, ranges[hi][1])
+            hi += 1
+        ranges[lo:hi] = [(start, end)]
+
+    def remove(self, start, end):
+        kept = []
+        for lo, hi in self._ranges:
+            if hi <= start or lo >= end:
+                kept.append((lo, hi))
+                continue
+            if lo < start:
+                kept.append((lo, start))
+            if hi > end:
+                kept.append((end, hi))
+        self._ranges = kept
+
+    def replace(self, start, old_end, new_end):
+        ''' Blocks [start, old_end) became [start, new_end), shift the ranges after them '''
+        delta = new_end - old_end
+        kept = []
+        for lo, hi in self._ranges:
+            if hi <= start:
+                kept.append((lo, hi))
+                continue
+            if lo < start:
+                kept.append((lo, start))
+            if hi > old_end:
+                kept.append((max(lo, old_end) + delta, hi + delta))
+        self._ranges = []
+        for lo, hi in kept:
+            self.add(lo, hi)
+
+    def next(self, number):
+        ''' The first block at or after ``number`` in a range and the end of that range '''
+        ranges = self._ranges
+        index = bisect_right(ranges, number, key=lambda item: item[1])
+        if index == len(ranges):
+            return None, None
+        lo, hi = ranges[index]
+        return max(lo, number), hi
+
+
+@instrument.instrument_class
+class LazyHighlighter(QObject):
+    '''
+    QSyntaxHighlighter work-alike that highlights the visible blocks first.
+
+    QSyntaxHighlighter formats the whole document when it is attached, and
+    all blocks of a large insertion right away, so the first paint waits for
+    the whole file.  Here the blocks still to be highlighted are kept as
+    ranges.  Blocks about to be painted in the ``set_editor`` view, and
+    ``margin`` blocks around them, are highlighted right before the paint;
+    the rest in slices of ``slice_ms`` on idle timer ticks, starting at the
+    viewport, so scrolling moves the work along.  Edits touching at most
+    ``sync_blocks`` blocks are highlighted at once, as QSyntaxHighlighter
+    does.
+
+    Subclasses implement ``highlightBlock`` with ``setFormat``,
+    ``currentBlock``, ``previousBlockState`` and ``setCurrentBlockState``,
+    like for QSyntaxHighlighter; a block whose end state changes gets the
+    next block highlighted again.
+    '''
+    margin = 50
+    slice_ms = 8
+    sync_blocks = 100
+
+    def __init__(self, parent=None):
+        QObject.__init__(self, parent)
+
+        self._document = None
+        self._editor = None
+        self._block_count = 0
+        self._dirty = _BlockRanges()
+
+        # Block being highlighted, the (start, end, format) set on it and its
+        # end state.
+        self._block = None
+        self._formats = []
+        self._state = -1
+
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(0)
+        self._timer.timeout.connect(self._backfill)
+
+    def document(self):
+        return self._document
+
+    def setDocument(self, document):
+        if self._document is not None:
+            self._document.contentsChange.disconnect(self._contents_change)
+
+        self._document = document
+        self._dirty.clear()
+        if document is not None:
+            document.contentsChange.connect(self._contents_change)
+            self._block_count = document.blockCount()
+            self._dirty.add(0, self._block_count)
+            self._timer.start()
+
+    def set_editor(self, editor):
+        """ Highlight ahead of the paints of this QPlainTextEdit showing the document """
+        self._editor = editor
+        editor.viewport().installEventFilter(self)
+
+    def eventFilter(self, watched, event):
+        if event.type() == QEvent.Paint and self._dirty and self._document is not None:
+            editor = self._editor
+            if editor.document() is self._document:
+                first = editor.firstVisibleBlock().blockNumber()
+                rows = editor.viewport().height() // max(editor.fontMetrics().height(), 1) + 1
+                self._highlight_range(max(first - self.margin, 0),
+                                      min(first + rows + self.margin, self._block_count))
+        return False
+
+    def is_pending(self):
+        """ Whether some blocks still wait for highlighting """
+        return bool(self._dirty)
+
+    def rehighlight(self):
+        """ Highlight the whole document now """
+        if self._document is None:
+            return
+        self._dirty.clear()
+        self._dirty.add(0, self._block_count)
+        self._highlight_range(0, self._block_count)
+
+    def rehighlightBlock(self, block):
+        number = block.blockNumber()
+        self._dirty.add(number, number + 1)
+        self._highlight_range(number, number + 1)
+
+    def setFormat(self, start, count, format):
+        if count > 0:
+            self._formats.append((start, start + count, format))
+
+    def currentBlock(self):
+        return self._block
+
+    def currentBlockState(self):
+        return self._state
+
+    def setCurrentBlockState(self, state):
+        self._state = state
+
+    def previousBlockState(self):
+        previous = self._block.previous()
+        return previous.userState() if previous.isValid() else -1
 
+    def highlightBlock(self, text):
+        pass
+
+    def _contents_change(self, position, chars_removed, chars_added):
+        document = self._document
+        count = document.blockCount()
+        delta = count - self._block_count
+        self._block_count = count
+
+        first = document.findBlock(position).blockNumber()
+        last = document.findBlock(position + chars_added)
+        end = last.blockNumber() + 1 if last.isValid() else count
+        self._dirty.replace(first, end - delta, end)
+        self._dirty.add(first, end)
+
+        if end - first <= self.sync_blocks:
+            self._highlight_range(first, end)
+        if self._dirty:
+            self._timer.start()
+
+    @instrument.probe('highlight.backfill')
+    def _backfill(self):
+        if self._document is None or not self._dirty:
+            return
+
+        origin = self._editor.firstVisibleBlock().blockNumber() if self._editor is not None else 0
+        deadline = time.perf_counter() + self.slice_ms / 1000
+        if self._highlight_range(origin, self._block_count, deadline):
+            self._highlight_range(0, origin, deadline)
+        if self._dirty:
+            self._timer.start()
+
+    def _highlight_range(self, lo, hi, deadline=None):
+        """ Highlight the pending blocks in [lo, hi), False if ``deadline`` passed first """
+        document = self._document
+        dirty = self._dirty
+        start, stop = dirty.next(lo)
+        while start is not None and start < hi:
+            stop = min(stop, hi)
+            block = document.findBlockByNumber(start)
+            first_position = block.position()
+            carry = False
+            number = start
+            while number < stop and block.isValid():
+                carry = self._highlight(block)
+                number += 1
+                block = block.next()
+                if carry and number == stop and stop < hi:
+                    # The end state changed, the next block has to follow.
+                    stop += 1
+                if deadline is not None and time.perf_counter() > deadline:
+                    break
 
-class Highlighter(QSyntaxHighlighter):
+            dirty.remove(start, number)
+            if carry and number < self._block_count:
+                dirty.add(number, number + 1)
+            end_position = block.position() if block.isValid() else document.characterCount()
+            document.markContentsDirty(first_position, end_position - first_position)
+
+            if deadline is not None and time.perf_counter() > deadline:
+                return False
+            start, stop = dirty.next(number)
+
+        return True
+
+    def _highlight(self, block):
+        self._block = block
+        self._formats = []
+        self._state = -1
+        text = block.text()
+        self.highlightBlock(text)
+
+        previous_state = block.userState()
+        block.setUserState(self._state)
+        block.layout().setFormats(self._format_ranges(len(text)))
+        self._block = None
+
+        return self._state != previous_state
+
+    def _format_ranges(self, length):
+        formats = self._formats
+        segments = formats
+        position = 0
+        for start, end, _ in formats:
+            if start < position or end > length:
+                segments = self._resolve_formats(length)
+                break
+            position = end
+
+        ranges = []
+        for start, end, format in segments:
+            format_range = QTextLayout.FormatRange()
+            format_range.start = start
+            format_range.length = end - start
+            format_range.format = format
+            ranges.append(format_range)
+
+        return ranges
+
+    def _resolve_formats(self, length):
+        # A later setFormat wins where it overlaps an earlier one.
+        segments = []
+        for start, end, format in self._formats:
+            end = min(end, length)
+            if start >= end:
+                continue
+            kept = []
+            for segment in segments:
+                if segment[1] <= start or segment[0] >= end:
+                    kept.append(segment)
+                    continue
+                if segment[0] < start:
+                    kept.append((segment[0], start, segment[2]))
+                if segment[1] > end:
+                    kept.append((end, segment[1], segment[2]))
+            kept.append((start, end, format))
+            segments = kept
+
+        return sorted(segments, key=lambda segment: segment[0])
+
+
+@instrument.instrument_class
+class Highlighter(LazyHighlighter):
     def __init__(self, is_code=False, is_diff=False, parent=None):
-        QSyntaxHighlighter.__init__(self, parent)
+        LazyHighlighter.__init__(self, parent)
 
         self._mappings = {}
-        self._diff_mappings = {}
 
-        self.line_cnt = 1
+        # All mappings compiled into one alternation of named groups, so a
+        # block is scanned once; see _compile_mappings.
+        self._rules = None
+        self._rule_formats = {}
+
+        # (delimiter, format) of constructs that may span several blocks. A
+        # block left open inside mapping i ends with block state i + 1.
+        self._block_mappings = []
 
         self.is_code = is_code
         self.is_diff = is_diff
 
-        self.added_lines = []
-        self.removed_lines = []
+        # 1-based block numbers of added and removed lines, both drawn with
+        # one shared format each.
+        self.added_lines = set()
+        self.removed_lines = set()
+        self._added_format = QTextCharFormat()
+        self._removed_format = QTextCharFormat()
+
+        # Removed and added rows replacing each other, both ways; the parts
+        # that differ within such a pair get the stronger inline formats.
+        self.pairs = {}
+        # A diff_engine.ListingRows giving the marks and pairs instead, see
+        # set_diff_rows.
+        self.rows = None
+        self._added_inline_format = None
+        self._removed_inline_format = None
+        self._inline_ranges = {}
 
     def add_mapping(self, pattern, format):
         self._mappings[pattern] = format
-
-    def add_diff_mapping(self, line, format, status):
-        self._diff_mappings[line] = format
-
+        self._compile_mappings()
+
+    def _compile_mappings(self):
+        """ Combine the mappings into a single regex, earlier mappings win """
+        groups = []
+        self._rule_formats = {}
+        for index, (pattern, format) in enumerate(self._mappings.items()):
+            name = 'rule%d' % index
+            groups.append('(?P<%s>%s)' % (name, pattern))
+            self._rule_formats[name] = format
+
+        self._rules = re.compile('|'.join(groups))
+
+    def add_block_mapping(self, delimiter, format):
+        """ Format text between a pair of ``delimiter`` even across lines """
+        self._block_mappings.append((delimiter, format))
+
+    def set_diff_formats(self, added_format, removed_format, added_inline_format=None, removed_inline_format=None):
+        self._added_format = added_format
+        self._removed_format = removed_format
+        self._added_inline_format = added_inline_format
+        self._removed_inline_format = removed_inline_format
+
+    def add_diff_mapping(self, line, status):
         if status:
-            self.added_lines.append(line)
+            self.added_lines.add(line)
         else:
-            self.removed_lines.append(line)
+            self.removed_lines.add(line)
+
+    def set_diff(self, added, removed, rehighlight=True, pairs=None):
+        """
+        Replace the changed lines and the pairs of rows replacing each other.
+
+        With ``rehighlight`` only the blocks whose status differs from before
+        are highlighted again; leave it off when the text of those blocks is
+        being replaced anyway.
+        """
+        added = set(added)
+        removed = set(removed)
+        pairs = {} if pairs is None else pairs
+        changed = ()
+        if rehighlight:
+            changed = (self.added_lines ^ added) | (self.removed_lines ^ removed)
+            changed |= {line for line, _ in self.pairs.items() ^ pairs.items()}
+            if self.rows is not None:
+                changed |= {row + 1 for row in self.rows.marked_rows()}
+
+        self.added_lines = added
+        self.removed_lines = removed
+        self.pairs = pairs
+        self.rows = None
+
+        document = self.document()
+        if document is None:
+            return
+        for line in sorted(changed):
+            block = document.findBlockByNumber(line - 1)
+            if block.isValid():
+                self.rehighlightBlock(block)
+
+    def set_diff_rows(self, rows):
+        """
+        Take the changed lines and the pairs from ``rows``, a
+        ``diff_engine.ListingRows`` patched in place as the diff changes.
+
+        Nothing is highlighted again: the rows a patch changes are replaced
+        in the document right after it, which highlights them.
+        """
+        self.added_lines = set()
+        self.removed_lines = set()
+        self.pairs = {}
+        self.rows = rows
 
     def clear_diff(self):
-        self._diff_mappings = {}
-        self.added_lines = []
-        self.removed_lines = []
+        self.added_lines = set()
+        self.removed_lines = set()
+        self.pairs = {}
+        self.rows = None
 
+    @instrument.probe('highlightBlock')
     def highlightBlock(self, text):
 
-        if self.is_code:
-            for pattern, format in self._mappings.items():
-                for match in re.finditer(pattern, text):
-                    start, end = match.span()
-                    self.setFormat(start, end - start, format)
-
-        if self.is_diff and self._diff_mappings:
-            for line, format in self._diff_mappings.items():
-                if line == self.line_cnt:
-                    self.setFormat(0, len(text), format)
-
-        self.line_cnt += 1
-
-
+        if self.is_code and self._rules is not None:
+            # The rule's own group closes last, so lastgroup names the rule.
+            for match in self._rules.finditer(text):
+                start, end = match.span()
+                if end > start:
+                    self.setFormat(start, end - start, self._rule_formats[match.lastgroup])
+
+        if self.is_code and self._block_mappings:
+            self.highlight_block_mappings(text)
+
+        rows = self.rows
+        if self.is_diff and rows is not None and rows.marked:
+            row = self.currentBlock().blockNumber()
+            mark = rows.mark(row) if row < len(rows) else None
+            if mark is not None:
+                self.setFormat(0, len(text), self._added_format if mark == '+' else self._removed_format)
+                partner = rows.partner(row)
+                self.highlight_inline(None if partner is None else partner + 1, text, mark == '+')
+        elif self.is_diff and (self.added_lines or self.removed_lines):
+            # Block numbers stay right when Qt only rehighlights part of the
+            # document, a running counter does not.
+            line = self.currentBlock().blockNumber() + 1
+            if line in self.added_lines:
+                self.setFormat(0, len(text), self._added_format)
+                self.highlight_inline(self.pairs.get(line), text, True)
+            elif line in self.removed_lines:
+                self.setFormat(0, len(text), self._removed_format)
+                self.highlight_inline(self.pairs.get(line), text, False)
+
+    def highlight_inline(self, partner, text, added):
+        """ Mark the parts of ``text`` that differ from the 1-based row ``partner`` it is paired with """
+        format = self._added_inline_format if added else self._removed_inline_format
+        if format is None or partner is None:
+            return
+
+        block = self.document().findBlockByNumber(partner - 1)
+        if not block.isValid():
+            return
+
+        key = (block.text(), text) if added else (text, block.text())
+        ranges = self._inline_ranges.get(key, False)
+        if ranges is False:
+            if len(self._inline_ranges) > 4096:
+                self._inline_ranges.clear()
+            # Both rows of a pair look the same pair up, diff it only once.
+            ranges = self._inline_ranges[key] = diff_inline(*key)
+        if ranges is None:
+            return
+
+        for start, end in ranges[added]:
+            self.setFormat(start, end - start, format)
+
+    def highlight_block_mappings(self, text):
+        """
+        Format multi-line constructs and record in the block state whether
+        one is still open at the end of the block.
+
+        The highlighter only moves on to the next block when the state of
+        the current one changes, so opening or closing a delimiter only
+        rehighlights the blocks whose state really flips.
+        """
+        state = 0
+        pos = 0
+
+        previous = self.previousBlockState()
+        if 0 < previous <= len(self._block_mappings):
+            delimiter, format = self._block_mappings[previous - 1]
+            end = text.find(delimiter)
+            if end == -1:
+                self.setFormat(0, len(text), format)
+                self.setCurrentBlockState(previous)
+                return
+
+            pos = end + len(delimiter)
+            self.setFormat(0, pos, format)
+
+        while pos < len(text):
+            start = -1
+            for index, (delimiter, format) in enumerate(self._block_mappings):
+                found = text.find(delimiter, pos)
+                if found != -1 and (start == -1 or found < start):
+                    start, mapping = found, index
+            if start == -1:
+                break
+
+            delimiter, format = self._block_mappings[mapping]
+            end = text.find(delimiter, start + len(delimiter))
+            if end == -1:
+                self.setFormat(start, len(text) - start, format)
+                state = mapping + 1
+                break
+
+            pos = end + len(delimiter)
+            self.setFormat(start, pos - start, format)
+
+        self.setCurrentBlockState(state)
+
+
+@instrument.instrument_class
 class LNTextEdit(QFrame):
+    # Emitted once the index asked for by search_index is built.
+    search_index_ready = Signal()
+    _index_built = Signal(object)
 
-    def __init__(self, *args):
+    def __init__(self, *args, keep_buffer=True):
         QFrame.__init__(self, *args)
 
         self.setFrameStyle(QFrame.StyledPanel | QFrame.Sunken)
@@ -74,6 +554,219 @@ class LNTextEdit(QFrame):
 
         self.edit.blockCountChanged.connect(self.number_bar.adjustWidth)
         self.edit.updateRequest.connect(self.number_bar.updateContents)
+        self.edit.cursorPositionChanged.connect(self.number_bar.updateCurrentLine)
+
+        # Copy of the text that snapshots can be taken of in O(1), lines are
+        # separated by '\n' and keep their raw characters like block.text().
+        # Without ``keep_buffer`` it is only made when first asked for, a
+        # pane that is never searched keeps one copy of its text fewer.
+        self._buffer = TextBuffer() if keep_buffer else None
+        self.edit.document().contentsChange.connect(self.sync_buffer)
+
+        # Trigram index of the lines for find, built on the thread pool by
+        # the first search_index call and kept up to date from
+        # contentsChange; the edits made while it is built are logged and
+        # replayed onto it.  Signatures of edited chunks are computed again
+        # in slices on idle timer ticks.
+        self._search_index = None
+        self._index_log = None
+        self._block_count = self.edit.document().blockCount()
+        self._index_built.connect(self._index_ready)
+        self.edit.document().contentsChange.connect(self._update_index)
+        self._index_timer = QTimer(self)
+        self._index_timer.setSingleShot(True)
+        self._index_timer.setInterval(200)
+        self._index_timer.timeout.connect(self._refresh_index)
+
+        # Query whose matches in view are highlighted, and what they were
+        # last worked out for.
+        self._find_query = None
+        self._find_shown = None
+        self.edit.updateRequest.connect(self.update_find_highlight)
+
+    @property
+    def buffer(self):
+        if self._buffer is None:
+            self._buffer = TextBuffer(self.edit.document().toRawText().replace('\u2029', '\n'))
+        return self._buffer
+
+    def search_index(self):
+        """
+        The SearchIndex of the text, or None while it is built; search_index_ready
+        is emitted once it is there
+        """
+        if self._search_index is None and self._index_log is None:
+            self._index_log = []
+            snapshot = self.buffer.snapshot()
+            QThreadPool.globalInstance().start(lambda: self._index_built.emit(SearchIndex(snapshot.lines())))
+        return self._search_index
+
+    def _index_ready(self, index):
+        for change in self._index_log:
+            index.replace_lines(*change)
+        self._search_index = index
+        self._index_log = None
+        if index.is_dirty():
+            self._index_timer.start()
+        self.search_index_ready.emit()
+        self.update_find_highlight()
+
+    def _update_index(self, position, chars_removed, chars_added):
+        document = self.edit.document()
+        count = document.blockCount()
+        delta = count - self._block_count
+        self._block_count = count
+        if self._search_index is None and self._index_log is None:
+            return
+
+        first = document.findBlock(position).blockNumber()
+        last = document.findBlock(position + chars_added)
+        end = last.blockNumber() + 1 if last.isValid() else count
+        lines = []
+        block = document.findBlockByNumber(first)
+        for _ in range(end - first):
+            lines.append(block.text())
+            block = block.next()
+
+        change = (first, end - first - delta, lines)
+        if self._index_log is not None:
+            self._index_log.append(change)
+            return
+
+        if change[1] < 0 or first + change[1] > len(self._search_index):
+            # Out of sync with the document, start over.
+            self._search_index = None
+            self.search_index()
+            return
+        self._search_index.replace_lines(*change)
+        self._index_timer.start()
+
+    def _refresh_index(self):
+        index = self._search_index
+        if index is not None and not index.refresh(time.perf_counter() + 0.008):
+            QTimer.singleShot(0, self._refresh_index)
+
+    def set_find_query(self, query):
+        """ Highlight the matches of the search_index.Query ``query`` in view, None for none """
+        self._find_query = query
+        self._find_shown = None
+        self.update_find_highlight()
+
+    @instrument.probe('find.viewport')
+    def update_find_highlight(self, *args):
+        """ Highlight the matches in the rows in view, after a scroll or an edit """
+        edit = self.edit
+        query = self._find_query
+        index = self.search_index() if query is not None else None
+        if index is None:
+            # setExtraSelections asks for an update right away, only clear
+            # what is there.
+            self._find_shown = None
+            if edit._find_selections:
+                edit.set_find_selections([])
+            return
+
+        document = edit.document()
+        first = edit.firstVisibleBlock().blockNumber()
+        rows = edit.viewport().height() // max(edit.fontMetrics().height(), 1) + 1
+        key = (query, first, rows, document.revision())
+        if key == self._find_shown:
+            return
+
+        self._find_shown = key
+        ranges = []
+        for match in index.find(query, first, first + rows):
+            position = document.findBlockByNumber(match.row).position()
+            ranges.append((position + match.start, match.end - match.start))
+        edit.set_find_selections(ranges)
+
+    @instrument.probe('find.next')
+    def find_next(self, query, backward=False):
+        """ Select the next match of ``query`` from the cursor on, False if none or not indexed yet """
+        index = self.search_index()
+        if index is None:
+            return False
+
+        cursor = self.edit.textCursor()
+        position = cursor.selectionStart() if backward else cursor.selectionEnd()
+        block = self.edit.document().findBlock(position)
+        match = index.find_next(query, block.blockNumber(), position - block.position(), backward)
+        if match is None:
+            return False
+
+        self.select_match(match)
+        return True
+
+    def select_match(self, match):
+        position = self.edit.document().findBlockByNumber(match.row).position()
+        cursor = self.edit.textCursor()
+        cursor.setPosition(position + match.start)
+        cursor.setPosition(position + match.end, QTextCursor.KeepAnchor)
+        self.edit.setTextCursor(cursor)
+
+    def replace_match(self, query, template):
+        """
+        Replace the selected match of ``query`` by ``template`` and select the
+        next one; False if there is none
+        """
+        index = self.search_index()
+        if index is None or self.edit.isReadOnly():
+            return False
+
+        cursor = self.edit.textCursor()
+        if cursor.hasSelection():
+            block = self.edit.document().findBlock(cursor.selectionStart())
+            start = cursor.selectionStart() - block.position()
+            match = index.find_next(query, block.blockNumber(), start, wrap=False)
+            if (match is not None and match.row == block.blockNumber() and match.start == start
+                    and match.end == cursor.selectionEnd() - block.position()):
+                cursor.insertText(query.expand(match, template))
+                # Searching on after the replacement, not inside it.
+                self.edit.setTextCursor(cursor)
+        return self.find_next(query)
+
+    def replace_all(self, query, template):
+        """ Replace every match of ``query`` by ``template`` as one undoable edit, returns how many """
+        index = self.search_index()
+        if index is None or self.edit.isReadOnly():
+            return 0
+
+        matches = list(index.find(query))
+        document = self.edit.document()
+        cursor = QTextCursor(document)
+        cursor.beginEditBlock()
+        # From the bottom up so the positions of the earlier matches stay put.
+        for match in reversed(matches):
+            position = document.findBlockByNumber(match.row).position()
+            cursor.setPosition(position + match.start)
+            cursor.setPosition(position + match.end, QTextCursor.KeepAnchor)
+            cursor.insertText(query.expand(match, template))
+        cursor.endEditBlock()
+        return len(matches)
+
+    def sync_buffer(self, position, chars_removed, chars_added):
+        if self._buffer is None:
+            return
+
+        document = self.edit.document()
+        old_length = len(self._buffer)
+        new_length = document.characterCount() - 1
+
+        # Qt counts the final paragraph separator in some changes (e.g.
+        # setPlainText) and reports others in several steps; anything that
+        # does not add up is taken from the document as a whole.
+        if (position + chars_removed > old_length or position + chars_added > new_length
+                or new_length != old_length - chars_removed + chars_added):
+            self._buffer = TextBuffer(document.toRawText().replace('\u2029', '\n'))
+            return
+
+        text = ''
+        if chars_added:
+            cursor = QTextCursor(document)
+            cursor.setPosition(position)
+            cursor.setPosition(position + chars_added, QTextCursor.KeepAnchor)
+            text = cursor.selectedText().replace('\u2029', '\n')
+        self._buffer.replace(position, chars_removed, text)
 
     class NumberBar(QWidget):
 
@@ -83,16 +776,24 @@ class LNTextEdit(QFrame):
             self.edit = edit
             self.adjustWidth(10)
 
+            # Duration of the last paintEvent in seconds.
+            self.paint_time = 0.0
+            self._current_line = 0
+
         def paintEvent(self, event):
+            start = time.perf_counter()
             self.edit.numberbarPaint(self, event)
             QWidget.paintEvent(self, event)
+            self.paint_time = time.perf_counter() - start
 
         def adjustWidth(self, count):
             # width = self.fontMetrics().width(count)   # unicode(count)
             # if self.width() != width:
             #     self.setFixedWidth(width)
+            # Folded rows make line numbers larger than the row count.
+            count = max(count, self.edit._max_number)
             if self.edit.double_line_number:
-                if len(self.edit._added_lines) > 0 or len(self.edit._removed_lines) > 0:
+                if self.edit._has_diff:
                     self.setFixedWidth((len(str(count)) * 10) * 2 + 40)
                 else:
                     self.setFixedWidth((len(str(count)) * 10) * 2 + 20)
@@ -107,14 +808,25 @@ class LNTextEdit(QFrame):
             if scroll:
                 self.scroll(0, scroll)
             else:
-                # It would be nice to do
-                # self.update(0, rect.y(), self.width(), rect.height())
-                # But we can't because it will not remove the bold on the
-                # current line if word wrap is enabled and a new block is
-                # selected.
-                self.update()
-
+                # The bold current line is moved by updateCurrentLine.
+                self.update(0, rect.y(), self.width(), rect.height())
+
+        def updateCurrentLine(self):
+            line = self.edit.textCursor().blockNumber()
+            if line == self._current_line:
+                return
+
+            for number in (self._current_line, line):
+                block = self.edit.document().findBlockByNumber(number)
+                if block.isValid():
+                    rect = self.edit.blockBoundingGeometry(block).translated(self.edit.contentOffset()).toAlignedRect()
+                    self.update(0, rect.y(), self.width(), rect.height())
+            self._current_line = line
+
+    @instrument.instrument_class
     class PlainTextEdit(QPlainTextEdit):
+        # 0-based row clicked with the left button, e.g. to expand a fold.
+        clicked = Signal(int)
 
         def __init__(self, *args):
             QPlainTextEdit.__init__(self, *args)
@@ -122,19 +834,118 @@ class LNTextEdit(QFrame):
             #self.setFrameStyle(QFrame.NoFrame)
 
             self.setFrameStyle(QFrame.NoFrame)
+            # Matches of the find query in view, see set_find_selections.
+            self._find_selections = []
+            self._find_format = QTextCharFormat()
+            self._find_format.setBackground(QColor("#ffe26b"))
             self.highlight()
             #self.setLineWrapMode(QPlainTextEdit.NoWrap)
 
             self.cursorPositionChanged.connect(self.highlight)
 
             self.double_line_number = False
-            self._added_lines = []
-            self._removed_lines = []
-
-        def set_diff_line(self, added=[], removed=[]):
+            self._old_numbers = array('i')
+            self._new_numbers = array('i')
+            # ListingRows numbering the rows instead of the arrays, if any.
+            self._rows = None
+            self._has_diff = False
+            self._max_number = 0
+
+            # Gutter painting reuses these instead of building them per row.
+            self._gutter_brushes = {
+                None: QBrush(QColor("#FFD141")),
+                '+': QBrush(QColor("#dae8bc")),
+                '-': QBrush(QColor("#f29b9b")),
+                '\u2026': QBrush(QColor("#e4e9f2")),
+            }
+            self._gutter_pen = QPen(QColor("#05080f"))
+            # QStaticText of each number and marker, keyed by (text, bold).
+            self._gutter_text = {}
+
+        def set_diff_line(self, old_numbers=None, new_numbers=None, has_diff=False):
+            """
+            Show the old and new line number of each row, see
+            ``diff_engine.line_numbers``; -1 on both sides marks a folded row.
+            """
+            self.double_line_number = True
+            self._old_numbers = array('i') if old_numbers is None else old_numbers
+            self._new_numbers = array('i') if new_numbers is None else new_numbers
+            self._rows = None
+            self._has_diff = has_diff
+            self._max_number = max(self._last_number(self._old_numbers), self._last_number(self._new_numbers))
+
+        def set_diff_rows(self, rows, has_diff=False):
+            """
+            Show the old and new line number of each row from ``rows``, a
+            ``diff_engine.ListingRows`` that is patched in place; call again
+            after a patch to update the width
+            """
             self.double_line_number = True
-            self._added_lines = added
-            self._removed_lines = removed
+            self._old_numbers = array('i')
+            self._new_numbers = array('i')
+            self._rows = rows
+            self._has_diff = has_diff
+            self._max_number = rows.max_number
+
+        @staticmethod
+        def _last_number(numbers):
+            # Numbers only grow apart from the 0 and -1 rows, the last one
+            # above 0 is the largest.
+            for row in range(len(numbers) - 1, -1, -1):
+                if numbers[row] > 0:
+                    return numbers[row]
+            return 0
+
+        def mouseReleaseEvent(self, event):
+            QPlainTextEdit.mouseReleaseEvent(self, event)
+            if event.button() == Qt.LeftButton and not self.textCursor().hasSelection():
+                self.clicked.emit(self.cursorForPosition(event.position().toPoint()).blockNumber())
+
+        def replace_lines(self, row, count, lines):
+            """ Replace ``count`` lines starting at 0-based ``row`` by ``lines`` """
+            document = self.document()
+            cursor = QTextCursor(document)
+            block_count = document.blockCount()
+
+            if count and lines:
+                first = document.findBlockByNumber(row)
+                last = document.findBlockByNumber(row + count - 1)
+                cursor.setPosition(first.position())
+                cursor.setPosition(last.position() + last.length() - 1, QTextCursor.KeepAnchor)
+                cursor.insertText('\n'.join(lines))
+            elif lines:
+                if row < block_count:
+                    cursor.setPosition(document.findBlockByNumber(row).position())
+                    cursor.insertText('\n'.join(lines) + '\n')
+                else:
+                    cursor.movePosition(QTextCursor.End)
+                    cursor.insertText('\n' + '\n'.join(lines))
+            elif count:
+                if row + count < block_count:
+                    cursor.setPosition(document.findBlockByNumber(row).position())
+                    cursor.setPosition(document.findBlockByNumber(row + count).position(), QTextCursor.KeepAnchor)
+                else:
+                    # Removing the last lines also removes the line break before them.
+                    previous = document.findBlockByNumber(row - 1)
+                    cursor.setPosition(previous.position() + previous.length() - 1)
+                    cursor.movePosition(QTextCursor.End, QTextCursor.KeepAnchor)
+                cursor.removeSelectedText()
+
+        def splice_lines(self, old_keys, new_keys, get_lines):
+            """
+            Turn the document showing a line per key of ``old_keys`` into the
+            one of ``new_keys``, rewriting only the lines whose keys differ;
+            ``get_lines(start, end)`` gives the lines of ``new_keys[start:end]``.
+            Without ``old_keys`` the whole text is set.
+            """
+            if old_keys is None:
+                self.setPlainText('\n'.join(get_lines(0, len(new_keys))))
+                return
+
+            # From the bottom up so the rows of the earlier hunks stay put.
+            for hunk in reversed(diff_lines(old_keys, new_keys)):
+                self.replace_lines(hunk.old_start, hunk.old_end - hunk.old_start,
+                                   get_lines(hunk.new_start, hunk.new_end))
 
         def highlight(self):
             hi_selection = QTextEdit.ExtraSelection()
@@ -144,118 +955,112 @@ class LNTextEdit(QFrame):
             hi_selection.cursor = self.textCursor()
             hi_selection.cursor.clearSelection()
 
-            self.setExtraSelections([hi_selection])
+            self.setExtraSelections([hi_selection] + self._find_selections)
+
+        def set_find_selections(self, ranges):
+            """ Highlight the ``(position, length)`` of each match in view """
+            selections = []
+            for position, length in ranges:
+                selection = QTextEdit.ExtraSelection()
+                selection.format = self._find_format
+                selection.cursor = QTextCursor(self.document())
+                selection.cursor.setPosition(position)
+                selection.cursor.setPosition(position + length, QTextCursor.KeepAnchor)
+                selections.append(selection)
+            self._find_selections = selections
+            self.highlight()
 
+        def gutter_text(self, text, bold):
+            static_text = self._gutter_text.get((text, bold))
+            if static_text is None:
+                if len(self._gutter_text) > 4096:
+                    self._gutter_text.clear()
+                static_text = QStaticText(text)
+                static_text.setTextFormat(Qt.PlainText)
+                self._gutter_text[text, bold] = static_text
+            return static_text
+
+        @instrument.probe('numberbarPaint')
         def numberbarPaint(self, number_bar, event):
-            font_metrics = self.fontMetrics()
-            current_line = self.document().findBlock(self.textCursor().position()).blockNumber() + 1
+            current_line = self.textCursor().blockNumber() + 1
+            rect = event.rect()
+            top = rect.top()
+            bottom = rect.bottom()
+            width = number_bar.width()
 
             block = self.firstVisibleBlock()
-            line_count = block.blockNumber()
             painter = QPainter(number_bar)
-            painter.fillRect(event.rect(), self.palette().base())
+            painter.fillRect(rect, self.palette().base())
+            painter.setPen(self._gutter_pen)
+
+            font = painter.font()
+            bold_font = QFont(font)
+            bold_font.setBold(True)
+            row_height = self.fontMetrics().height()
 
-            added_line_cnt = 0
-            removed_line_cnt = 0
+            old_numbers = self._old_numbers
+            new_numbers = self._new_numbers
+            rows = self._rows
+            double_line_number = self.double_line_number
+            brushes = self._gutter_brushes
+            offset = self.contentOffset()
+
+            # Column layout of the double line numbers: new, old, marker.
+            bar_width = int(width / 2 - 4) + 1
+            marker_right = bar_width + 18 * 2
 
             # Iterate over all visible text blocks in the document.
             while block.isValid():
-                line_count += 1
-                block_top = self.blockBoundingGeometry(block).translated(self.contentOffset()).top()
+                row = block.blockNumber()
+                line_count = row + 1
+                block_top = self.blockBoundingGeometry(block).translated(offset).top()
 
                 # Check if the position of the block is out side of the visible
                 # area.
-                if not block.isVisible(): # or block_top & gt ;= event.rect().bottom():
+                if not block.isVisible() or block_top > bottom:
                     break
+                if block_top + row_height < top:
+                    block = block.next()
+                    continue
 
                 # We want the line number for the selected line to be bold.
-                font = painter.font()
-
-                if line_count == current_line:
-                    font.setBold(True)
-                else:
-                    font.setBold(False)
-
-                painter.setFont(font)
-
-                rect_colot = QColor("#FFD141")
-                if self.double_line_number:
-                    if line_count in self._added_lines:
-                        print('>>> line_count: ', line_count, ' , self._added_lines: ', self._added_lines)
-                        rect_colot = QColor("#dae8bc")
-
-                    if line_count in self._removed_lines:
-                        print('>>> line_count: ', line_count, ' , self._removed_lines: ', self._removed_lines)
-                        rect_colot = QColor("#f29b9b")
-
-                brush = QBrush()
-                brush.setColor(rect_colot)
-                brush.setStyle(Qt.SolidPattern)
-                painter.setBrush(brush)
-
-                pen = QPen()
-                # pen.setWidth(3)
-                pen.setColor(rect_colot)
-                painter.setPen(pen)
-
-                # Draw the line number right justified at the position of the line.
-                # print(">>>>>>>>> block_top: ", block_top)
-                # print(">>>>>>>>> number_bar.width(): ", number_bar.width())
-                # print(">>>>>>>>> font_metrics.height(): ", font_metrics.height())
-                if self.double_line_number:
-                    bar_width = int((number_bar.width()) / 2 - 4)
-                    marker_space = 18
-
-                    add_space = -1
-                    if len(self._added_lines) > 0 or len(self._removed_lines) > 0:
-                        add_space = -1
-
-                    # print('>>>>> bar_width: ', bar_width)
-                    # print('>>>>> add_space: ', add_space)
-
-                    paint_rect = QRect(0, block_top, bar_width-add_space, int(font_metrics.height()))
-                    paint_rect_d = QRect(bar_width-add_space, block_top, int(number_bar.width()) - marker_space, int(font_metrics.height()))
-                    paint_rect_m = QRect(bar_width-add_space+marker_space, block_top, marker_space, int(font_metrics.height()))
+                bold = line_count == current_line
+                if bold:
+                    painter.setFont(bold_font)
+
+                # Rows past the mapping (no diff yet) number both sides alike.
+                if rows is not None and row < len(rows):
+                    old_number, new_number = rows.numbers(row)
+                elif row < len(old_numbers):
+                    old_number = old_numbers[row]
+                    new_number = new_numbers[row]
                 else:
-                    paint_rect = QRect(0, block_top, int(number_bar.width()), int(font_metrics.height()))
-
-                painter.fillRect(paint_rect, brush)
-                if self.double_line_number:
-                    # print('>>>>> display double line for rect')
-                    painter.fillRect(paint_rect_d, brush)
-                    if len(self._added_lines) > 0 or len(self._removed_lines) > 0:
-                        painter.fillRect(paint_rect_m, brush)
-
-                pen.setColor(QColor("#05080f"))
-                painter.setPen(pen)
-
-                if self.double_line_number:
-                    # print('>>>>> display double line for text')
-                    line1_text = '  ' + str(line_count - removed_line_cnt)
-                    line2_text = '  ' + str(line_count - added_line_cnt)
-                    marker = ' '
-
-                    if line_count in self._added_lines:
-                        print('>>> line_count: ', line_count, ' , self._added_lines: ', self._added_lines)
-                        # line2_text = '  ' + str(line_count) + '  +'
-                        line1_text = '  ' + str(line_count - removed_line_cnt)
-                        line2_text = '  '
+                    old_number = new_number = line_count
+
+                marker = None
+                if double_line_number:
+                    if old_number < 0:
+                        marker = '\u2026'
+                    elif not old_number:
                         marker = '+'
-                        added_line_cnt += 1
-                    if line_count in self._removed_lines:
-                        print('>>> line_count: ', line_count, ' , self._removed_lines: ', self._removed_lines)
-                        # line2_text = '  ' + str(line_count) + '  -'
-                        line1_text = '  '
-                        line2_text = '  ' + str(line_count - added_line_cnt)
+                    elif not new_number:
                         marker = '-'
-                        removed_line_cnt += 1
 
-                    painter.drawText(paint_rect, Qt.AlignmentFlag.AlignLeft | Qt.TextFlag.TextWordWrap, line1_text)
-                    painter.drawText(paint_rect_d, Qt.AlignmentFlag.AlignLeft | Qt.TextFlag.TextWordWrap, line2_text)
-                    painter.drawText(paint_rect_m, Qt.AlignmentFlag.AlignRight | Qt.TextFlag.TextWordWrap, marker)
+                painter.fillRect(QRectF(0, block_top, width, row_height), brushes[marker])
+
+                if double_line_number:
+                    if new_number > 0:
+                        painter.drawStaticText(QPointF(0, block_top), self.gutter_text('  ' + str(new_number), bold))
+                    if old_number > 0:
+                        painter.drawStaticText(QPointF(bar_width, block_top), self.gutter_text('  ' + str(old_number), bold))
+                    if marker:
+                        static_text = self.gutter_text(marker, bold)
+                        painter.drawStaticText(QPointF(marker_right - static_text.size().width(), block_top), static_text)
                 else:
-                    line1_text = '  ' + str(line_count)
-                    painter.drawText(paint_rect, Qt.AlignmentFlag.AlignLeft | Qt.TextFlag.TextWordWrap, line1_text)
+                    painter.drawStaticText(QPointF(0, block_top), self.gutter_text('  ' + str(line_count), bold))
+
+                if bold:
+                    painter.setFont(font)
 
                 block = block.next()
 
@@ -275,3 +1080,153 @@ class LNTextEdit(QFrame):
 
     def setLineWrapMode(self, mode):
         self.edit.setLineWrapMode(mode)
+
+
+class FindBar(QWidget):
+    '''
+    Find and replace bar for LNTextEdit editors.
+
+    The matches of the query are highlighted in view in every editor given
+    to ``add_editor``; next, previous and replace act on the one that had
+    the focus last.  Searches go through the editor's SearchIndex, so typing
+    in the bar never scans the whole text.
+    '''
+    # Matches counted for the status, beyond that it shows "1000+".
+    count_limit = 1000
+
+    def __init__(self, parent=None):
+        QWidget.__init__(self, parent)
+
+        self._editors = []
+        self._current = None
+        self._query = None
+
+        self.find_edit = QLineEdit()
+        self.find_edit.setPlaceholderText(self.tr("Find"))
+        self.find_edit.textChanged.connect(self.update_query)
+        self.find_edit.returnPressed.connect(self.find_next)
+        self.replace_edit = QLineEdit()
+        self.replace_edit.setPlaceholderText(self.tr("Replace"))
+        self.replace_edit.returnPressed.connect(self.replace)
+        self.regex_box = QCheckBox(self.tr("Regex"))
+        self.regex_box.toggled.connect(self.update_query)
+        self.case_box = QCheckBox(self.tr("Match case"))
+        self.case_box.toggled.connect(self.update_query)
+        self.status = QLabel()
+
+        previous_button = QPushButton(self.tr("Previous"))
+        previous_button.clicked.connect(self.find_previous)
+        next_button = QPushButton(self.tr("Next"))
+        next_button.clicked.connect(self.find_next)
+        self._replace_button = QPushButton(self.tr("Replace"))
+        self._replace_button.clicked.connect(self.replace)
+        self._replace_all_button = QPushButton(self.tr("Replace All"))
+        self._replace_all_button.clicked.connect(self.replace_all)
+        close_button = QPushButton(self.tr("Close"))
+        close_button.clicked.connect(self.close_bar)
+
+        layout = QGridLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(self.find_edit, 0, 0)
+        layout.addWidget(previous_button, 0, 1)
+        layout.addWidget(next_button, 0, 2)
+        layout.addWidget(self.regex_box, 0, 3)
+        layout.addWidget(self.case_box, 0, 4)
+        layout.addWidget(close_button, 0, 5)
+        layout.addWidget(self.replace_edit, 1, 0)
+        layout.addWidget(self._replace_button, 1, 1)
+        layout.addWidget(self._replace_all_button, 1, 2)
+        layout.addWidget(self.status, 1, 3, 1, 3)
+        self._replace_widgets = (self.replace_edit, self._replace_button, self._replace_all_button)
+
+    def add_editor(self, editor):
+        self._editors.append(editor)
+        if self._current is None:
+            self._current = editor
+        editor.edit.installEventFilter(self)
+        editor.search_index_ready.connect(self.update_status)
+
+    def eventFilter(self, watched, event):
+        if event.type() == QEvent.FocusIn:
+            for editor in self._editors:
+                if editor.edit is watched and editor is not self._current:
+                    self._current = editor
+                    self.update_status()
+        return False
+
+    def keyPressEvent(self, event):
+        if event.key() == Qt.Key_Escape:
+            self.close_bar()
+            return
+        QWidget.keyPressEvent(self, event)
+
+    def open_bar(self, replace=False):
+        ''' Show the bar with the selected text of the current editor, if on one line '''
+        for widget in self._replace_widgets:
+            widget.setVisible(replace)
+        if self._current is not None:
+            selected = self._current.edit.textCursor().selectedText()
+            if selected and '\u2029' not in selected:
+                self.find_edit.setText(selected)
+        self.show()
+        self.find_edit.setFocus()
+        self.find_edit.selectAll()
+        self.update_query()
+
+    def close_bar(self):
+        self.hide()
+        for editor in self._editors:
+            editor.set_find_query(None)
+        if self._current is not None:
+            self._current.edit.setFocus()
+
+    def update_query(self):
+        self._query = None
+        pattern = self.find_edit.text()
+        if pattern and self.isVisible():
+            try:
+                self._query = Query(pattern, self.regex_box.isChecked(), self.case_box.isChecked())
+            except re.error as error:
+                self.status.setText(self.tr("Invalid pattern: %s") % error)
+                pattern = None
+        for editor in self._editors:
+            editor.set_find_query(self._query)
+        if pattern is not None:
+            self.update_status()
+
+    def update_status(self):
+        if self._query is None or self._current is None:
+            self.status.clear()
+            return
+
+        index = self._current.search_index()
+        if index is None:
+            self.status.setText(self.tr("Indexing\u2026"))
+            return
+
+        count = sum(1 for _ in islice(index.find(self._query), self.count_limit))
+        if not count:
+            self.status.setText(self.tr("No matches"))
+        elif count < self.count_limit:
+            self.status.setText(self.tr("%d matches") % count)
+        else:
+            self.status.setText(self.tr("%d+ matches") % count)
+
+    def find_next(self):
+        if self._query is not None and self._current is not None:
+            self._current.find_next(self._query)
+
+    def find_previous(self):
+        if self._query is not None and self._current is not None:
+            self._current.find_next(self._query, backward=True)
+
+    def replace(self):
+        if self._query is not None and self._current is not None:
+            self._current.replace_match(self._query, self.replace_edit.text())
+            self.update_status()
+
+    def replace_all(self):
+        if self._query is None or self._current is None:
+            return
+        count = self._current.replace_all(self._query, self.replace_edit.text())
+        self.status.setText(self.tr("Replaced %d") % count)
@@ -0,0 +1,73 @@
+'''
+Least recently used cache of diff results, bounded by memory.
+
+The editor keys it by the content digest of the working copy, so undoing,
+redoing or typing a change back brings back the diff computed for that text
+without running the diff again.  Every entry is stored with its size in
+bytes; the least recently used entries are dropped once the total exceeds
+``max_bytes``.
+
+>>> cache = DiffCache(max_bytes=100)
+>>> cache.put('a', 'diff of a', 60)
+>>> cache.put('b', 'diff of b', 30)
+>>> cache.get('a')
+'diff of a'
+>>> cache.put('c', 'diff of c', 30)
+>>> cache.get('b'), cache.hits, cache.misses
+(None, 1, 1)
+>>> sorted(cache.keys())
+['a', 'c']
+'''
+from collections import OrderedDict
+
+
+class DiffCache:
+    '''
+    Entries by key from the least to the most recently used, with hit and
+    miss counts of ``get``.
+    '''
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # key -> (value, size)
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, size):
+        ''' Store ``value`` as the most recently used entry, ``size`` in bytes '''
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.size -= previous[1]
+        if size > self.max_bytes:
+            return
+
+        self._entries[key] = (value, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, dropped) = self._entries.popitem(last=False)
+            self.size -= dropped
+
+    def keys(self):
+        return self._entries.keys()
+
+    def values(self):
+        return [value for value, _ in self._entries.values()]
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
@@ -0,0 +1,923 @@
+'''
+Line diff engine used by the editor panes.
+
+This module does not depend on Qt so it can be used from worker threads,
+worker processes and headless tools.  The diff itself is Myers' O(ND)
+algorithm in its linear space "middle snake" form, applied to any two
+sequences of hashable items (usually lists of lines).
+
+The result is a list of ``Hunk`` tuples with 0-based, half open ranges:
+
+>>> diff_lines(['a', 'b', 'c'], ['a', 'x', 'c'])
+[Hunk(old_start=1, old_end=2, new_start=1, new_end=2)]
+>>> diff_lines(['a', 'b'], ['a', 'b', 'c'])
+[Hunk(old_start=2, old_end=2, new_start=2, new_end=3)]
+>>> diff_lines(['a', 'b', 'c', 'd'], ['b', 'c', 'e'])
+[Hunk(old_start=0, old_end=1, new_start=0, new_end=0), Hunk(old_start=3, old_end=4, new_start=2, new_end=3)]
+>>> diff_lines('abcabba', 'cbabac')
+[Hunk(old_start=0, old_end=1, new_start=0, new_end=1), Hunk(old_start=2, old_end=3, new_start=2, new_end=2), Hunk(old_start=5, old_end=6, new_start=4, new_end=4), Hunk(old_start=7, old_end=7, new_start=5, new_end=6)]
+
+``build_view`` turns the hunks into the merged listing shown in the base
+pane, removed lines first and added lines after them:
+
+>>> view = build_view(['a', 'b', 'c'], ['a', 'x', 'c'], diff_lines(['a', 'b', 'c'], ['a', 'x', 'c']))
+>>> view.lines, view.added, view.removed
+(['a', 'b', 'x', 'c'], [3], [2])
+
+``line_numbers`` maps every row of that listing to its line in ``old`` and in
+``new``, 0 where the row does not exist on that side:
+
+>>> old_numbers, new_numbers = line_numbers(3, diff_lines(['a', 'b', 'c'], ['a', 'x', 'c']))
+>>> list(old_numbers), list(new_numbers)
+([1, 2, 0, 3], [1, 0, 2, 3])
+
+``fold_view`` builds the same listing with the unchanged lines further than
+``context`` lines from a change folded into one placeholder row each (-1):
+
+>>> old = ['a', 'b', 'c', 'd', 'e', 'f']
+>>> view = fold_view(old, old[:3] + ['x'] + old[4:], [Hunk(3, 4, 3, 4)], context=2)
+>>> view.lines, view.folds
+(['a', 'b', 'c', 'd', 'x', 'e', 'f'], {})
+>>> view = fold_view(old, old[:5] + ['x'], [Hunk(5, 6, 5, 6)], context=1)
+>>> view.lines, view.folds, list(view.old_numbers)
+([-1, 'e', 'f', 'x'], {0: (0, 4)}, [-1, 5, 6, 0])
+
+``merge3`` merges the changes two texts made to a common base, conflicting
+changes are kept between markers:
+
+>>> merge3(['a', 'b', 'c'], ['A', 'b', 'c'], ['a', 'b', 'C']).lines
+['A', 'b', 'C']
+>>> merge = merge3(['a', 'b', 'c'], ['a', 'x', 'c'], ['a', 'y', 'c'])
+>>> merge.lines, merge.conflicts
+(['a', '<<<<<<< ours', 'x', '=======', 'y', '>>>>>>> theirs', 'c'], [(1, 6)])
+
+``diff_inline`` narrows a changed line down to the character ranges that
+differ from the line it replaces, comparing words rather than characters:
+
+>>> diff_inline('total = price * count', 'total = price * amount')
+([(16, 21)], [(16, 22)])
+>>> diff_inline('a ' + 'x ' * 3000, 'b ' + 'x ' * 3000)
+([(0, 1)], [(0, 1)])
+'''
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from itertools import accumulate
+from math import isqrt
+import re
+
+
+Hunk = namedtuple('Hunk', ['old_start', 'old_end', 'new_start', 'new_end'])
+
+DiffView = namedtuple('DiffView', ['lines', 'added', 'removed'])
+
+ViewPatch = namedtuple('ViewPatch', ['row', 'count', 'lines'])
+
+FoldedView = namedtuple('FoldedView', ['lines', 'added', 'removed', 'pairs', 'old_numbers', 'new_numbers', 'folds'])
+
+MergeRegion = namedtuple('MergeRegion', ['base_start', 'base_end', 'ours_start', 'ours_end',
+                                         'theirs_start', 'theirs_end', 'kind'])
+
+Merge = namedtuple('Merge', ['lines', 'theirs', 'conflicts'])
+
+MERGE_MARKERS = ('<<<<<<< ours', '=======', '>>>>>>> theirs')
+
+
+class DiffCancelled(Exception):
+    ''' Raised by ``diff_lines`` when its ``cancelled`` callback returns True '''
+
+
+def diff_lines(old, new, max_cost=None, cancelled=None):
+    '''
+    Compute the hunks needed to turn ``old`` into ``new``.
+
+    :param old: sequence of lines of the original text
+    :param new: sequence of lines of the changed text
+    :param max_cost: bound on the edit distance explored for one sub-problem,
+                     by default derived from the input size; a sub-problem
+                     exceeding it is split at the furthest point its search
+                     reached, which keeps very different inputs from taking
+                     quadratic time at the price of a less minimal result
+    :param cancelled: optional callable polled while diffing, the diff stops
+                      with ``DiffCancelled`` as soon as it returns True
+    :return: list of ``Hunk`` sorted by position, adjacent hunks merged
+    '''
+    if max_cost is None:
+        max_cost = max(256, isqrt(len(old) + len(new)))
+    # Indexing an array boxes a new int every time, lists are faster to scan.
+    if isinstance(old, array):
+        old = old.tolist()
+    if isinstance(new, array):
+        new = new.tolist()
+
+    hunks = []
+    # Work items are explicit so that deep recursion cannot happen; the right
+    # half is pushed first so hunks come out in document order.
+    stack = [(0, len(old), 0, len(new))]
+
+    while stack:
+        if cancelled is not None and cancelled():
+            raise DiffCancelled()
+
+        old_lo, old_hi, new_lo, new_hi = stack.pop()
+
+        # Strip the common prefix and suffix, they never take part in a hunk.
+        while old_lo < old_hi and new_lo < new_hi and old[old_lo] == new[new_lo]:
+            old_lo += 1
+            new_lo += 1
+        while old_lo < old_hi and new_lo < new_hi and old[old_hi - 1] == new[new_hi - 1]:
+            old_hi -= 1
+            new_hi -= 1
+
+        if old_lo == old_hi and new_lo == new_hi:
+            continue
+
+        if old_lo == old_hi or new_lo == new_hi:
+            _append_hunk(hunks, Hunk(old_lo, old_hi, new_lo, new_hi))
+            continue
+
+        split = _middle_snake(old, old_lo, old_hi, new, new_lo, new_hi, max_cost, cancelled)
+        if split is None:
+            _append_hunk(hunks, Hunk(old_lo, old_hi, new_lo, new_hi))
+            continue
+
+        old_mid, new_mid = split
+        stack.append((old_mid, old_hi, new_mid, new_hi))
+        stack.append((old_lo, old_mid, new_lo, new_mid))
+
+    return hunks
+
+
+def _append_hunk(hunks, hunk):
+    if hunks:
+        last = hunks[-1]
+        if last.old_end == hunk.old_start and last.new_end == hunk.new_start:
+            hunks[-1] = Hunk(last.old_start, hunk.old_end, last.new_start, hunk.new_end)
+            return
+    hunks.append(hunk)
+
+
+def _middle_snake(old, old_lo, old_hi, new, new_lo, new_hi, max_cost, cancelled):
+    '''
+    Find the point where a forward and a reverse Myers search overlap.
+
+    Returns ``(old_index, new_index)`` to split the problem at.  When no
+    overlap is found within ``max_cost`` the furthest point reached by either
+    search is used instead, and ``None`` if that point makes no progress.
+    '''
+    n = old_hi - old_lo
+    m = new_hi - new_lo
+    max_d = min((n + m + 1) // 2, max_cost)
+    best = best_x = best_y = 0
+
+    offset = max_d + 1
+    size = 2 * offset + 1
+    forward = [-1] * size
+    reverse = [-1] * size
+    forward[offset + 1] = 0
+    reverse[offset + 1] = 0
+
+    delta = n - m
+    front = delta % 2 != 0
+
+    # Trim diagonals that ran off the grid so the loops stay bounded.
+    k1_start = k1_end = k2_start = k2_end = 0
+
+    for d in range(max_d):
+        if cancelled is not None and cancelled():
+            raise DiffCancelled()
+
+        for k1 in range(-d + k1_start, d + 1 - k1_end, 2):
+            k1_offset = offset + k1
+            if k1 == -d or (k1 != d and forward[k1_offset - 1] < forward[k1_offset + 1]):
+                x1 = forward[k1_offset + 1]
+            else:
+                x1 = forward[k1_offset - 1] + 1
+            y1 = x1 - k1
+            while x1 < n and y1 < m and old[old_lo + x1] == new[new_lo + y1]:
+                x1 += 1
+                y1 += 1
+            forward[k1_offset] = x1
+            if x1 + y1 > best and x1 <= n and y1 <= m:
+                best, best_x, best_y = x1 + y1, x1, y1
+            if x1 > n:
+                k1_end += 2
+            elif y1 > m:
+                k1_start += 2
+            elif front:
+                k2_offset = offset + delta - k1
+                if 0 <= k2_offset < size and reverse[k2_offset] != -1:
+                    if x1 >= n - reverse[k2_offset]:
+                        return old_lo + x1, new_lo + y1
+
+        for k2 in range(-d + k2_start, d + 1 - k2_end, 2):
+            k2_offset = offset + k2
+            if k2 == -d or (k2 != d and reverse[k2_offset - 1] < reverse[k2_offset + 1]):
+                x2 = reverse[k2_offset + 1]
+            else:
+                x2 = reverse[k2_offset - 1] + 1
+            y2 = x2 - k2
+            while x2 < n and y2 < m and old[old_hi - x2 - 1] == new[new_hi - y2 - 1]:
+                x2 += 1
+                y2 += 1
+            reverse[k2_offset] = x2
+            if x2 + y2 > best and x2 <= n and y2 <= m:
+                best, best_x, best_y = x2 + y2, n - x2, m - y2
+            if x2 > n:
+                k2_end += 2
+            elif y2 > m:
+                k2_start += 2
+            elif not front:
+                k1_offset = offset + delta - k2
+                if 0 <= k1_offset < size and forward[k1_offset] != -1:
+                    x1 = forward[k1_offset]
+                    y1 = offset + x1 - k1_offset
+                    if x1 >= n - x2:
+                        return old_lo + x1, new_lo + y1
+
+    if (best_x, best_y) in ((0, 0), (n, m)):
+        return None
+    return old_lo + best_x, new_lo + best_y
+
+
+def build_view(old, new, hunks):
+    '''
+    Build the merged listing of ``old`` and ``new`` for the base pane.
+
+    Unchanged lines appear once, every hunk shows its removed lines followed by
+    its added lines.  ``added`` and ``removed`` hold 1-based row numbers of the
+    listing, which is what ``Highlighter.add_diff_mapping`` expects.
+    '''
+    lines = []
+    added = []
+    removed = []
+    _extend_view(lines, added, removed, old, new, hunks, 0, len(old))
+
+    return DiffView(lines, added, removed)
+
+
+def _extend_view(lines, added, removed, old, new, hunks, old_lo, old_hi):
+    old_pos = old_lo
+    for hunk in hunks:
+        lines.extend(old[old_pos:hunk.old_start])
+
+        for line in old[hunk.old_start:hunk.old_end]:
+            lines.append(line)
+            removed.append(len(lines))
+        for line in new[hunk.new_start:hunk.new_end]:
+            lines.append(line)
+            added.append(len(lines))
+
+        old_pos = hunk.old_end
+
+    lines.extend(old[old_pos:old_hi])
+
+
+def line_numbers(old_len, hunks):
+    '''
+    Return the 1-based ``(old_numbers, new_numbers)`` of each listing row.
+
+    Both are ``array('i')`` with one entry per row of the merged listing, so
+    the line number bar can look any row up directly instead of counting the
+    added and removed rows above it.
+    '''
+    old_numbers, new_numbers, _, _ = _listing_rows(hunks, 0, old_len, 0)
+    return old_numbers, new_numbers
+
+
+def _listing_rows(hunks, old_lo, old_hi, new_lo):
+    # Numbers, marks and partner offsets of the listing rows of
+    # old[old_lo:old_hi] with ``hunks``, the new lines counted from new_lo.
+    old_numbers = array('i')
+    new_numbers = array('i')
+    marks = bytearray()
+    partners = array('i')
+    old_pos, new_pos = old_lo, new_lo
+    for hunk in hunks:
+        common = hunk.old_start - old_pos
+        removed = hunk.old_end - hunk.old_start
+        added = hunk.new_end - hunk.new_start
+        old_numbers.extend(_numbers(old_pos + 1, hunk.old_end + 1))
+        new_numbers.extend(_numbers(new_pos + 1, new_pos + 1 + common))
+        new_numbers.extend(_ZERO * removed)
+
+        old_numbers.extend(_ZERO * added)
+        new_numbers.extend(_numbers(hunk.new_start + 1, hunk.new_end + 1))
+        marks.extend(bytes(common) + _REMOVED * removed + _ADDED * added)
+
+        # Pairs as in IncrementalDiff.view_pairs.
+        paired = min(removed, added)
+        partners.extend(_ZERO * common)
+        partners.extend(array('i', [removed]) * paired)
+        partners.extend(_ZERO * (removed - paired))
+        partners.extend(array('i', [-removed]) * paired)
+        partners.extend(_ZERO * (added - paired))
+
+        old_pos, new_pos = hunk.old_end, hunk.new_end
+
+    old_numbers.extend(_numbers(old_pos + 1, old_hi + 1))
+    new_numbers.extend(_numbers(new_pos + 1, new_pos + 1 + old_hi - old_pos))
+    marks.extend(bytes(old_hi - old_pos))
+    partners.extend(_ZERO * (old_hi - old_pos))
+
+    return old_numbers, new_numbers, marks, partners
+
+
+def _numbers(start, stop):
+    # Slicing a prebuilt array copies memory, extending by a range would
+    # create every int object first.
+    global _COUNT
+    if stop > len(_COUNT):
+        _COUNT = array('i', range(max(stop, 2 * len(_COUNT))))
+    return _COUNT[start:stop]
+
+
+_ZERO = array('i', [0])
+_COUNT = array('i', range(1024))
+# Marks of the rows of ListingRows, unchanged rows are 0.
+_ADDED = b'\1'
+_REMOVED = b'\2'
+_MARK_TEXT = (None, '+', '-')
+_MARKED = re.compile(b'[^\0]+')
+
+
+class ListingRows:
+    '''
+    Marks, pairs and line numbers of the rows of the merged listing of an
+    ``IncrementalDiff``, patched over the rows ``realign`` replaces instead
+    of rebuilt.
+
+    Rows are 0-based.  ``mark`` is '+' for an added row, '-' for a removed
+    one and None otherwise, ``partner`` the row a removed or added row is
+    paired with, see ``IncrementalDiff.view_pairs``, and ``numbers`` the
+    1-based old and new line number, 0 on the side where the row does not
+    exist.  Pairs are stored as offsets and the rows after a patch keep
+    their stored numbers; the change in the count of new lines is kept as a
+    shift applying from the end of the patch on.  ``lines`` holds the line
+    of each row, like ``DiffView.lines``.
+
+    >>> diff = IncrementalDiff(['a', 'b', 'c'], ['a', 'x', 'c'])
+    >>> rows = diff.listing_rows()
+    >>> [(rows.mark(row), rows.partner(row), rows.numbers(row)) for row in range(len(rows))]
+    [(None, None, (1, 1)), ('-', 2, (2, 0)), ('+', 1, (0, 2)), (None, None, (3, 3))]
+    >>> diff.apply_edit(0, 0, ['y'])
+    >>> diff.realign()
+    ViewPatch(row=0, count=0, lines=['y'])
+    >>> [rows.numbers(row) for row in range(len(rows))], rows.max_number
+    ([(0, 1), (1, 2), (2, 0), (0, 3), (3, 4)], 4)
+    '''
+
+    def __init__(self, old, new, hunks):
+        old_len, new_len = len(old), len(new)
+        self._old_numbers, self._new_numbers, self._marks, self._partners = _listing_rows(hunks, 0, old_len, 0)
+        lines = []
+        _extend_view(lines, [], [], old, new, hunks, 0, old_len)
+        self.lines = array(new.typecode, lines) if isinstance(new, array) else lines
+        # Number of added and removed rows.
+        self.marked = len(self._marks) - self._marks.count(0)
+        self.max_number = max(old_len, new_len)
+        self._old_len = old_len
+        self._new_len = new_len
+        # [row, shift] sorted by row: the stored new numbers from that row
+        # on are short by the shift; and the running totals by row.
+        self._shifts = []
+        self._shift_rows = []
+        self._shift_totals = []
+
+    def __len__(self):
+        return len(self._marks)
+
+    def mark(self, row):
+        return _MARK_TEXT[self._marks[row]]
+
+    def partner(self, row):
+        offset = self._partners[row]
+        return row + offset if offset else None
+
+    def marked_rows(self):
+        ''' The added and removed rows '''
+        for match in _MARKED.finditer(self._marks):
+            yield from range(*match.span())
+
+    def numbers(self, row):
+        mark = self._marks[row]
+        if mark == _REMOVED[0]:
+            return self._old_numbers[row], 0
+        if mark == _ADDED[0]:
+            return 0, self._new_numbers[row] + self._shift(row)
+        return self._old_numbers[row], self._new_numbers[row] + self._shift(row)
+
+    def changed_rows(self, shown):
+        '''
+        Return ``(row, count, new_count)``: replacing ``count`` rows of the
+        listing ``shown`` from ``row`` on by ``new_count`` rows of this one
+        turns it into this listing.
+
+        Rows outside of that range have the same line, mark and partner in
+        both; the range covers whole runs of added and removed rows so a row
+        kept is never paired with one replaced.  The comparisons run in C.
+
+        >>> shown = IncrementalDiff(['a', 'b', 'c', 'd'], ['a', 'x', 'c', 'd']).listing_rows()
+        >>> rows = IncrementalDiff(['a', 'b', 'c', 'd'], ['a', 'y', 'c', 'd']).listing_rows()
+        >>> rows.changed_rows(shown)
+        (1, 2, 2)
+        >>> rows.lines[1:3]
+        ['b', 'y']
+        '''
+        lo = min(_common_prefix(self.lines, shown.lines), _common_prefix(self._marks, shown._marks),
+                 _common_prefix(self._partners, shown._partners))
+        tail = min(_common_prefix(self.lines[lo:][::-1], shown.lines[lo:][::-1]),
+                   _common_prefix(self._marks[lo:][::-1], shown._marks[lo:][::-1]),
+                   _common_prefix(self._partners[lo:][::-1], shown._partners[lo:][::-1]))
+        hi = len(self) - tail
+        shown_hi = len(shown) - tail
+
+        # The rows kept are the same in both listings, so are their marks.
+        lo = self._marks.rfind(0, 0, lo) + 1
+        end = self._marks.find(0, hi)
+        end = len(self) if end < 0 else end
+        return lo, shown_hi + end - hi - lo, end - lo
+
+    def _shift(self, row):
+        index = bisect_right(self._shift_rows, row)
+        return self._shift_totals[index - 1] if index else 0
+
+    def patch(self, row, count, lines, hunks, old_lo, old_hi, new_lo, delta):
+        '''
+        Replace ``count`` rows from ``row`` by the rows ``lines`` of
+        ``old[old_lo:old_hi]`` with ``hunks``, new lines counted from
+        ``new_lo``; the count of new lines changed by ``delta``.
+        '''
+        old_numbers, new_numbers, marks, partners = _listing_rows(hunks, old_lo, old_hi, new_lo)
+        end = row + count
+        grown = len(marks) - count
+        self.marked += len(marks) - marks.count(0) - (count - self._marks.count(0, row, end))
+
+        shift = self._shift(row)
+        if shift:
+            new_numbers = array('i', [number - shift for number in new_numbers])
+        self._old_numbers[row:end] = old_numbers
+        self._new_numbers[row:end] = new_numbers
+        self._marks[row:end] = marks
+        self._partners[row:end] = partners
+        self.lines[row:end] = array(self.lines.typecode, lines) if isinstance(self.lines, array) else lines
+
+        # Shifts within the patch keep applying to the rows after it.
+        shifts = {}
+        for shift_row, shift in self._shifts:
+            if shift_row > row:
+                shift_row = max(shift_row, end) + grown
+            shifts[shift_row] = shifts.get(shift_row, 0) + shift
+        if delta:
+            shifts[end + grown] = shifts.get(end + grown, 0) + delta
+        self._shifts = sorted([shift_row, shift] for shift_row, shift in shifts.items() if shift)
+        self._shift_rows = [shift_row for shift_row, _ in self._shifts]
+        self._shift_totals = list(accumulate(shift for _, shift in self._shifts))
+
+        self._new_len += delta
+        self.max_number = max(self._old_len, self._new_len)
+
+
+def fold_view(old, new, hunks, context=3, expanded=()):
+    '''
+    Build the merged listing with unchanged runs folded away.
+
+    Unchanged lines more than ``context`` lines away from a hunk, and not in
+    one of the ``expanded`` ``(old_start, old_end)`` ranges, are replaced by
+    a placeholder row: -1 in ``lines`` and in both number arrays, and a key
+    of ``folds`` mapping its 0-based row to the ``(old_start, old_end)`` it
+    hides.  A single hidden line is shown rather than folded.
+
+    ``added``, ``removed`` and ``pairs`` are 1-based rows like the ones of
+    ``IncrementalDiff.view_marks`` and ``view_pairs``, ``old_numbers`` and
+    ``new_numbers`` like ``line_numbers``, all of the folded listing.  The
+    cost follows the number of rows shown, not the size of the texts.
+    '''
+    lines = []
+    added = []
+    removed = []
+    pairs = {}
+    old_numbers = array('i')
+    new_numbers = array('i')
+    folds = {}
+    expanded = sorted(expanded)
+
+    def show(old_lo, old_hi, delta):
+        lines.extend(old[old_lo:old_hi])
+        old_numbers.extend(_numbers(old_lo + 1, old_hi + 1))
+        new_numbers.extend(_numbers(old_lo + delta + 1, old_hi + delta + 1))
+
+    def unchanged(old_lo, old_hi, delta, head, tail):
+        # ``head`` and ``tail``: whether the run borders a hunk at that end.
+        shown = [(lo, hi) for lo, hi in expanded if lo < old_hi and hi > old_lo]
+        if head:
+            shown.append((old_lo, old_lo + context))
+        if tail:
+            shown.append((old_hi - context, old_hi))
+
+        pos = old_lo
+        for lo, hi in sorted(shown):
+            lo = min(max(lo, pos), old_hi)
+            hi = min(hi, old_hi)
+            if lo >= hi:
+                continue
+            if lo - pos > 1:
+                folds[len(lines)] = (pos, lo)
+                lines.append(-1)
+                old_numbers.append(-1)
+                new_numbers.append(-1)
+            else:
+                lo = pos
+            show(lo, hi, delta)
+            pos = hi
+
+        if old_hi - pos > 1:
+            folds[len(lines)] = (pos, old_hi)
+            lines.append(-1)
+            old_numbers.append(-1)
+            new_numbers.append(-1)
+        else:
+            show(pos, old_hi, delta)
+
+    old_pos = new_pos = 0
+    for index, hunk in enumerate(hunks):
+        unchanged(old_pos, hunk.old_start, new_pos - old_pos, index > 0, True)
+
+        row = len(lines)
+        count = hunk.old_end - hunk.old_start
+        lines.extend(old[hunk.old_start:hunk.old_end])
+        removed.extend(range(row + 1, row + 1 + count))
+        old_numbers.extend(_numbers(hunk.old_start + 1, hunk.old_end + 1))
+        new_numbers.extend(_ZERO * count)
+
+        lines.extend(new[hunk.new_start:hunk.new_end])
+        added.extend(range(row + count + 1, len(lines) + 1))
+        old_numbers.extend(_ZERO * (hunk.new_end - hunk.new_start))
+        new_numbers.extend(_numbers(hunk.new_start + 1, hunk.new_end + 1))
+
+        for offset in range(min(count, hunk.new_end - hunk.new_start)):
+            pairs[row + offset + 1] = row + count + offset + 1
+            pairs[row + count + offset + 1] = row + offset + 1
+
+        old_pos, new_pos = hunk.old_end, hunk.new_end
+
+    unchanged(old_pos, len(old), new_pos - old_pos, bool(hunks), False)
+
+    return FoldedView(lines, added, removed, pairs, old_numbers, new_numbers, folds)
+
+
+def merge_regions(base, ours, theirs, ours_hunks=None, theirs_hunks=None):
+    '''
+    Return the ``MergeRegion`` of every part of ``base`` changed by either side.
+
+    Hunks of the two diffs against ``base`` that overlap or touch are joined
+    into one region, so the walk is linear in the number of hunks.  ``kind``
+    is 'ours' or 'theirs' when only that side changed the region, 'both'
+    when both made the same change and 'conflict' otherwise.  The ranges are
+    0-based and half open; the parts of ``base`` between regions are
+    unchanged on both sides.  Pass hunks already known to skip their diff.
+    '''
+    if ours_hunks is None:
+        ours_hunks = diff_lines(base, ours)
+    if theirs_hunks is None:
+        theirs_hunks = diff_lines(base, theirs)
+
+    regions = []
+    i = j = 0
+    # Line offsets of each side against base after the hunks consumed.
+    ours_delta = theirs_delta = 0
+    while i < len(ours_hunks) or j < len(theirs_hunks):
+        if j == len(theirs_hunks) or (i < len(ours_hunks) and ours_hunks[i].old_start <= theirs_hunks[j].old_start):
+            lo = hi = ours_hunks[i].old_start
+        else:
+            lo = hi = theirs_hunks[j].old_start
+
+        ours_before, theirs_before = ours_delta, theirs_delta
+        ours_changed = theirs_changed = False
+        while True:
+            if i < len(ours_hunks) and ours_hunks[i].old_start <= hi:
+                hunk = ours_hunks[i]
+                i += 1
+                ours_changed = True
+                ours_delta = hunk.new_end - hunk.old_end
+            elif j < len(theirs_hunks) and theirs_hunks[j].old_start <= hi:
+                hunk = theirs_hunks[j]
+                j += 1
+                theirs_changed = True
+                theirs_delta = hunk.new_end - hunk.old_end
+            else:
+                break
+            hi = max(hi, hunk.old_end)
+
+        region = MergeRegion(lo, hi, lo + ours_before, hi + ours_delta, lo + theirs_before, hi + theirs_delta, None)
+        if not theirs_changed:
+            kind = 'ours'
+        elif not ours_changed:
+            kind = 'theirs'
+        elif ours[region.ours_start:region.ours_end] == theirs[region.theirs_start:region.theirs_end]:
+            kind = 'both'
+        else:
+            kind = 'conflict'
+        regions.append(region._replace(kind=kind))
+
+    return regions
+
+
+def merge3(base, ours, theirs, markers=MERGE_MARKERS, base_marker=None, ours_hunks=None, theirs_hunks=None):
+    '''
+    Merge the changes ``ours`` and ``theirs`` made to ``base``, like diff3.
+
+    Conflicting regions are written as ``markers[0]``, the lines of ours,
+    ``markers[1]``, the lines of theirs and ``markers[2]``; with a
+    ``base_marker`` the lines of base follow it before ``markers[1]``.  The
+    markers are inserted as they are, so with texts of line ids pass ids.
+
+    Returns a ``Merge``: the merged ``lines`` and the 0-based, half open row
+    ranges of ``lines`` taken from ``theirs`` and of the ``conflicts``,
+    markers included.  The cost is the two diffs plus a linear walk, or only
+    the walk for the hunks passed in.
+    '''
+    lines = []
+    from_theirs = []
+    conflicts = []
+    pos = 0
+    for region in merge_regions(base, ours, theirs, ours_hunks, theirs_hunks):
+        lines.extend(base[pos:region.base_start])
+        start = len(lines)
+        if region.kind == 'theirs':
+            lines.extend(theirs[region.theirs_start:region.theirs_end])
+            if len(lines) > start:
+                from_theirs.append((start, len(lines)))
+        elif region.kind != 'conflict':
+            lines.extend(ours[region.ours_start:region.ours_end])
+        else:
+            lines.append(markers[0])
+            lines.extend(ours[region.ours_start:region.ours_end])
+            if base_marker is not None:
+                lines.append(base_marker)
+                lines.extend(base[region.base_start:region.base_end])
+            lines.append(markers[1])
+            lines.extend(theirs[region.theirs_start:region.theirs_end])
+            lines.append(markers[2])
+            conflicts.append((start, len(lines)))
+        pos = region.base_end
+    lines.extend(base[pos:])
+
+    return Merge(lines, from_theirs, conflicts)
+
+
+# Bounds of ``diff_inline``: longer differing parts and costlier token diffs
+# are not worth narrowing down, the whole line is marked instead.
+INLINE_MAX_LENGTH = 2000
+INLINE_MAX_COST = 128
+
+_TOKEN = re.compile(r'\w+|\s+|[^\w\s]')
+
+
+def diff_inline(old, new, max_length=INLINE_MAX_LENGTH, max_cost=INLINE_MAX_COST):
+    '''
+    Return the ``(old_ranges, new_ranges)`` that differ between two lines.
+
+    Ranges are 0-based, half open ``(start, end)`` character offsets.  The
+    lines are compared token by token (words, runs of white space and single
+    punctuation characters) after their common prefix and suffix are dropped,
+    so a small change in a very long line stays cheap.
+
+    Returns ``None`` when a differing part is longer than ``max_length``,
+    the token diff needs more than ``max_cost`` edits or the lines share too
+    little to be shown as one edited line; mark the whole lines then.
+    '''
+    lo = _common_prefix(old, new)
+    # Compare whole words: back up to the start of a word cut by the prefix.
+    while lo and _is_word(old[lo - 1]) and (_is_word(old[lo:lo + 1]) or _is_word(new[lo:lo + 1])):
+        lo -= 1
+
+    tail = _common_prefix(old[lo:][::-1], new[lo:][::-1])
+    old_hi = len(old) - tail
+    new_hi = len(new) - tail
+    while old_hi < len(old) and _is_word(old[old_hi]) and (
+            _is_word(old[old_hi - 1:old_hi]) or _is_word(new[new_hi - 1:new_hi])):
+        old_hi += 1
+        new_hi += 1
+
+    if max(old_hi, new_hi) - lo > max_length:
+        return None
+
+    old_tokens = _TOKEN.findall(old, lo, old_hi)
+    new_tokens = _TOKEN.findall(new, lo, new_hi)
+    budget = [max_cost]
+
+    def cancelled():
+        budget[0] -= 1
+        return budget[0] < 0
+
+    try:
+        hunks = diff_lines(old_tokens, new_tokens, 64, cancelled)
+    except DiffCancelled:
+        return None
+
+    old_ranges = _token_ranges(old_tokens, lo, [(hunk.old_start, hunk.old_end) for hunk in hunks])
+    new_ranges = _token_ranges(new_tokens, lo, [(hunk.new_start, hunk.new_end) for hunk in hunks])
+
+    changed = sum(end - start for start, end in old_ranges) + sum(end - start for start, end in new_ranges)
+    if 3 * (len(old) + len(new) - changed) < len(old) + len(new):
+        return None
+
+    return old_ranges, new_ranges
+
+
+def _common_prefix(a, b):
+    # Bisect on slice comparisons, which run in C, instead of a Python loop
+    # over the characters.
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+
+    return lo
+
+
+def _is_word(char):
+    return char.isalnum() or char == '_'
+
+
+def _token_ranges(tokens, offset, spans):
+    ranges = []
+    pos = offset
+    index = 0
+    for start, end in spans:
+        pos += sum(map(len, tokens[index:start]))
+        length = sum(map(len, tokens[start:end]))
+        if length:
+            ranges.append((pos, pos + length))
+        pos += length
+        index = end
+
+    return ranges
+
+
+class IncrementalDiff:
+    '''
+    Diff of a fixed ``old`` text against a ``new`` text that keeps changing.
+
+    Edits to ``new`` are recorded with ``apply_edit`` and folded into the
+    hunks by ``realign``.  Only the lines touched by the edits and the hunks
+    overlapping them are diffed again, hunks after them are just shifted, so
+    the cost follows the size of the edit rather than the size of the file.
+
+    >>> diff = IncrementalDiff(['a', 'b', 'c'], ['a', 'b', 'c'])
+    >>> diff.apply_edit(1, 1, ['x', 'y'])
+    >>> diff.realign()
+    ViewPatch(row=1, count=1, lines=['b', 'x', 'y'])
+    >>> diff.hunks
+    [Hunk(old_start=1, old_end=2, new_start=1, new_end=3)]
+    >>> diff.apply_edit(1, 2, ['b'])
+    >>> diff.realign()
+    ViewPatch(row=1, count=3, lines=['b'])
+    >>> diff.hunks
+    []
+    '''
+
+    def __init__(self, old, new, hunks=None):
+        # ``old`` is never modified and is not copied; ``new`` is, and stays
+        # an array if it is one (e.g. line ids of a ``TextModel``).
+        self.old = old
+        self.new = array(new.typecode, new) if isinstance(new, array) else list(new)
+        self.hunks = diff_lines(self.old, self.new) if hunks is None else list(hunks)
+
+        # Range of ``new`` touched since the last realign, in current line
+        # numbers, and how many lines the edits added overall.
+        self._dirty = None
+        self._delta = 0
+        self._rows = None
+
+    def view(self):
+        return build_view(self.old, self.new, self.hunks)
+
+    def view_marks(self):
+        '''
+        Return the 1-based ``(added, removed)`` rows of the merged listing.
+        '''
+        added = []
+        removed = []
+        shown = 0
+        for hunk in self.hunks:
+            row = hunk.old_start + shown
+            removed.extend(range(row + 1, row + 1 + hunk.old_end - hunk.old_start))
+            row += hunk.old_end - hunk.old_start
+            added.extend(range(row + 1, row + 1 + hunk.new_end - hunk.new_start))
+            shown += hunk.new_end - hunk.new_start
+
+        return added, removed
+
+    def view_pairs(self):
+        '''
+        Pair the removed and added rows of the merged listing, both ways.
+
+        Within a hunk the n-th removed line is taken as replaced by the n-th
+        added line; rows are 1-based like the ones of ``view_marks``.
+        '''
+        pairs = {}
+        shown = 0
+        for hunk in self.hunks:
+            removed = hunk.old_end - hunk.old_start
+            added = hunk.new_end - hunk.new_start
+            row = hunk.old_start + shown + 1
+            for offset in range(min(removed, added)):
+                pairs[row + offset] = row + removed + offset
+                pairs[row + removed + offset] = row + offset
+            shown += added
+
+        return pairs
+
+    def line_numbers(self):
+        return line_numbers(len(self.old), self.hunks)
+
+    def listing_rows(self):
+        ''' ``ListingRows`` of the merged listing, patched by every ``realign`` from now on '''
+        if self._rows is None:
+            self._rows = ListingRows(self.old, self.new, self.hunks)
+        return self._rows
+
+    def apply_edit(self, start, removed, lines):
+        '''
+        Replace ``removed`` lines of ``new`` starting at ``start`` by ``lines``.
+        '''
+        self.new[start:start + removed] = lines
+        added = len(lines)
+
+        if self._dirty is None:
+            dirty_start, dirty_end = start, start + added
+        else:
+            dirty_start, dirty_end = self._dirty
+            if dirty_end >= start + removed:
+                dirty_end += added - removed
+            elif dirty_end > start:
+                dirty_end = start + added
+            dirty_start = min(dirty_start, start)
+            dirty_end = max(dirty_end, start + added)
+
+        self._dirty = (dirty_start, dirty_end)
+        self._delta += added - removed
+
+    def realign(self):
+        '''
+        Re-diff the lines touched since the last call.
+
+        Returns a ``ViewPatch`` replacing ``count`` rows of the merged listing
+        starting at the 0-based ``row``, or ``None`` if nothing was edited.
+        '''
+        if self._dirty is None:
+            return None
+
+        dirty_start, dirty_end = self._dirty
+        delta = self._delta
+        self._dirty = None
+        self._delta = 0
+
+        hunks = self.hunks
+        # The hunks still use the line numbers from before the edits.
+        first = bisect_left(hunks, dirty_start, key=lambda hunk: hunk.new_end)
+        last = first
+        while last < len(hunks) and hunks[last].new_start <= dirty_end - delta:
+            last += 1
+
+        new_lo = dirty_start
+        new_hi = dirty_end - delta
+        if first < last:
+            new_lo = min(new_lo, hunks[first].new_start)
+            new_hi = max(new_hi, hunks[last - 1].new_end)
+
+        # Outside of hunks ``old`` and ``new`` only differ by an offset.
+        before = hunks[first - 1] if first else Hunk(0, 0, 0, 0)
+        old_lo = new_lo + before.old_end - before.new_end
+        after = hunks[last - 1] if first < last else before
+        old_hi = new_hi + after.old_end - after.new_end
+
+        row = old_lo
+        for hunk in hunks[:first]:
+            row += hunk.new_end - hunk.new_start
+        count = old_hi - old_lo
+        for hunk in hunks[first:last]:
+            count += hunk.new_end - hunk.new_start
+
+        window = [
+            Hunk(hunk.old_start + old_lo, hunk.old_end + old_lo,
+                 hunk.new_start + new_lo, hunk.new_end + new_lo)
+            for hunk in diff_lines(self.old[old_lo:old_hi], self.new[new_lo:new_hi + delta])
+        ]
+        shifted = [
+            Hunk(hunk.old_start, hunk.old_end, hunk.new_start + delta, hunk.new_end + delta)
+            for hunk in hunks[last:]
+        ] if delta else hunks[last:]
+        self.hunks = hunks[:first] + window + shifted
+
+        lines = []
+        _extend_view(lines, [], [], self.old, self.new, window, old_lo, old_hi)
+        if self._rows is not None:
+            self._rows.patch(row, count, lines, window, old_lo, old_hi, new_lo, delta)
+
+        return ViewPatch(row, count, lines)
@@ -1,7 +1,7 @@
 import QtQuick
 import QtQuick.Controls
 import QtQuick.Dialogs
-import CodeEditor 1.0
+import editor 1.0
 
 Item {
     id: root
@@ -11,117 +11,115 @@ Item {
     property alias fileName: backend.fileName
     property bool changedSinceLastSave: false
     property bool isUnsavedFile: true
+    // Called once the running save succeeded.
+    property var savedCallback
 
     function open(fileUrl) {
         backend.fileUrl = fileUrl
         backend.load()
-        textArea.text = backend.text
-        isUnsavedFile = false
-        changedSinceLastSave = false
     }
 
     function save(cb) {
         backend.text = textArea.text
-        if(fileName === "untitled") {
+        if(isUnsavedFile) {
             fileDialogSave.cb = function() {
                 save(cb)
-                fileDialogSave.cb = undefined
             }
-            fileDialogSave.visible = true
+            fileDialogSave.open()
         } else {
-            if(backend.save()) {
-                changedSinceLastSave = false
-                isUnsavedFile = false
-                if(cb != undefined) cb()
-            }
+            savedCallback = cb
+            backend.save()
         }
     }
 
     function saveAs() {
         backend.text = textArea.text
         fileDialogSave.cb = function() {
+            isUnsavedFile = false
             save()
-            fileDialogSave.cb = undefined
         }
-        fileDialogSave.visible = true
+        fileDialogSave.open()
+    }
+
+    CodeEditorBackend {
+        id: backend
+        fileName: "untitled"
+
+        // The file is read off the UI thread, the text arrives here.
+        onLoaded: function(ok) {
+            if(ok) {
+                textArea.text = backend.text
+                isUnsavedFile = false
+                changedSinceLastSave = false
+            }
+        }
+
+        onSaved: function(ok) {
+            if(ok) {
+                changedSinceLastSave = false
+                isUnsavedFile = false
+                if(savedCallback != undefined) savedCallback()
+            }
+            savedCallback = undefined
+        }
     }
 
+    // Only numbers are bound: scrolling or moving the cursor never copies
+    // the text.
     LineNumbers {
         id: lineNumbers
         height: parent.height
         width: 40
+        lineCount: textArea.lineCount
+        lineHeight: textArea.lineCount > 0 ? textArea.contentHeight / textArea.lineCount : 16
+        scrollY: flickable.contentY - textArea.topPadding
+        currentLine: Math.floor((textArea.cursorRectangle.y - textArea.topPadding) / lineHeight)
     }
 
-    CodeEditorBackend {
-        id: backend
-        fileName: "untitled"
-    }
-
-    TextArea {
-        id: textArea
+    Flickable {
+        id: flickable
         height: parent.height
         width: parent.width-lineNumbers.width
         anchors.left: lineNumbers.right
-        wrapMode: TextEdit.NoWrap
-
-        function update() {
-            var lineHeight = 16;//(contentHeight-8) / lineCount
-            lineNumbers.lineCount = lineCount
-            lineNumbers.scrollY = flickableItem.contentY
-            lineNumbers.lineHeight = lineHeight
-            lineNumbers.cursorPosition = cursorPosition
-            lineNumbers.selectionStart = selectionStart
-            lineNumbers.selectionEnd = selectionEnd
-            lineNumbers.text = text
-            lineNumbers.update()
-        }
+        clip: true
+        boundsBehavior: Flickable.StopAtBounds
+        ScrollBar.vertical: ScrollBar {}
+        ScrollBar.horizontal: ScrollBar {}
 
-        Component.onCompleted: {
-            flickableItem.contentYChanged.connect(update)
-            update()
-        }
+        TextArea.flickable: TextArea {
+            id: textArea
+            wrapMode: TextEdit.NoWrap
+            selectByMouse: true
 
-        onTextChanged: {
-            changedSinceLastSave = true
+            onTextChanged: {
+                changedSinceLastSave = true
+            }
         }
-
-        onLineCountChanged: update()
-        onHeightChanged: update()
-        onCursorPositionChanged: update()
     }
 
     FileDialog {
         id: fileDialogSave
-        selectExisting : false
+        fileMode: FileDialog.SaveFile
         property var cb
         title: "Please choose a location to save"
 
         onAccepted: {
-            backend.fileUrl = fileDialogSave.fileUrl
+            backend.fileUrl = selectedFile
+            isUnsavedFile = false
             if(cb != undefined) {
-                cb()
-                cb = null
+                var callback = cb
+                cb = undefined
+                callback()
             }
         }
+        onRejected: cb = undefined
     }
 
     FileDialog {
         id: fileDialogLoad
-        selectExisting : true
-        property var cb
+        fileMode: FileDialog.OpenFile
         title: "Please choose a file"
 
-        onAccepted: {
-            backend.fileUrl = fileDialogSave.fileUrl
-            if(cb != undefined) {
-                cb()
-                cancelCloseEditor = false
-                cb = null
-            }
-        }
-        onRejected: {
-            cancelCloseEditor = true
-            cb = null
-        }
+        onAccepted: open(selectedFile)
     }
-}
\ No newline at end of file
+}
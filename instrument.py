@@ -0,0 +1,225 @@
+'''
+Timers and counters for the editor, off unless enabled.
+
+Methods marked with ``probe`` run as they are until ``enable`` swaps timed
+versions into their classes; ``disable`` puts the originals back, so a
+disabled probe costs nothing.  Spans that are not one call, like a file
+load or the time a job waits in the thread pool, are recorded with
+``record``, which returns at once while disabled.
+
+>>> @instrument_class
+... class Parser:
+...     @probe('parse')
+...     def parse(self, text):
+...         return text.split()
+>>> recorder = enable()
+>>> Parser().parse('a b')
+['a', 'b']
+>>> count('files')
+>>> recorder.stats()['parse']['count'], recorder.counters['files']
+(1, 1)
+>>> disable() is recorder
+True
+
+Recorded spans are written as JSONL or as a Chrome trace (chrome://tracing,
+Perfetto).
+
+The start of the application is timed apart from that: after
+``profile_startup``, every ``phase`` call ends a phase, and
+``startup_report`` lists them.
+
+>>> profile_startup(perf_counter())
+>>> phase('window')
+>>> [line.split()[0] for line in startup_report().splitlines()]
+['phase', 'window']
+'''
+from collections import deque
+import functools
+import json
+import os
+import threading
+from time import perf_counter
+
+
+_recorder = None
+# (class, attribute, original function, span name) of every probe.
+_probes = []
+# (name, end) of the startup phases, the first one giving the start; None
+# unless profiling the startup.
+_phases = None
+
+
+class Recorder:
+    '''
+    Spans and counters recorded while instrumentation is enabled.
+
+    Only the latest ``max_events`` spans are kept for the trace.  Statistics
+    are kept per name apart from it, the count, total and max of every span
+    and the latest ``samples`` durations for the percentiles, so frequent
+    spans never push rare ones out.  Spans are added from any thread.
+    '''
+
+    def __init__(self, max_events=200000, samples=1000):
+        self.origin = perf_counter()
+        self.events = deque(maxlen=max_events)
+        self.counters = {}
+        self.samples = samples
+        # Name to [count, total, max, deque of the latest durations].
+        self._spans = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, start, duration):
+        self.events.append((name, start, duration, threading.get_ident()))
+        with self._lock:
+            span = self._spans.get(name)
+            if span is None:
+                span = self._spans[name] = [0, 0.0, 0.0, deque(maxlen=self.samples)]
+            span[0] += 1
+            span[1] += duration
+            if duration > span[2]:
+                span[2] = duration
+            span[3].append(duration)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def stats(self):
+        '''
+        Count, total and max in milliseconds of all the spans by name, p50 and
+        p99 of the latest ones
+        '''
+        with self._lock:
+            spans = [(name, count, total, longest, sorted(durations))
+                     for name, (count, total, longest, durations) in self._spans.items()]
+
+        stats = {}
+        for name, count, total, longest, values in spans:
+            stats[name] = {
+                'count': count,
+                'total': total * 1000,
+                'max': longest * 1000,
+                'p50': values[len(values) // 2] * 1000,
+                'p99': values[int(len(values) * 0.99)] * 1000,
+            }
+
+        return stats
+
+    def write(self, path):
+        ''' Write the spans as JSONL if ``path`` ends with .jsonl, else as a Chrome trace '''
+        events = list(self.events)
+        with open(path, 'w') as out_file:
+            if path.endswith('.jsonl'):
+                for name, start, duration, thread in events:
+                    out_file.write(json.dumps({'name': name, 'start': start - self.origin,
+                                               'duration': duration, 'thread': thread}) + '\n')
+                for name, value in self.counters.items():
+                    out_file.write(json.dumps({'counter': name, 'value': value}) + '\n')
+                return
+
+            pid = os.getpid()
+            trace = [{'name': name, 'ph': 'X', 'pid': pid, 'tid': thread,
+                      'ts': (start - self.origin) * 1e6, 'dur': duration * 1e6}
+                     for name, start, duration, thread in events]
+            end = (perf_counter() - self.origin) * 1e6
+            trace.extend({'name': name, 'ph': 'C', 'pid': pid, 'ts': end, 'args': {name: value}}
+                         for name, value in self.counters.items())
+            json.dump({'traceEvents': trace}, out_file)
+
+
+def current():
+    ''' The active ``Recorder``, None while disabled '''
+    return _recorder
+
+
+def enable(max_events=200000):
+    global _recorder
+    if _recorder is None:
+        _recorder = Recorder(max_events)
+        for cls, attribute, fn, name in _probes:
+            setattr(cls, attribute, _timed(fn, name, _recorder))
+
+    return _recorder
+
+
+def disable():
+    ''' Put the untimed methods back, return the recorder that was active '''
+    global _recorder
+    recorder, _recorder = _recorder, None
+    for cls, attribute, fn, _ in _probes:
+        setattr(cls, attribute, fn)
+
+    return recorder
+
+
+def probe(name):
+    ''' Mark a method to be timed as ``name``; the class needs ``instrument_class`` '''
+    def mark(fn):
+        fn._probe_name = name
+        return fn
+
+    return mark
+
+
+def instrument_class(cls):
+    ''' Class decorator registering the methods marked with ``probe`` '''
+    for attribute, fn in list(vars(cls).items()):
+        name = getattr(fn, '_probe_name', None)
+        if name is not None:
+            _probes.append((cls, attribute, fn, name))
+            if _recorder is not None:
+                setattr(cls, attribute, _timed(fn, name, _recorder))
+
+    return cls
+
+
+def _timed(fn, name, recorder):
+    @functools.wraps(fn)
+    def timed(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            recorder.add(name, start, perf_counter() - start)
+
+    return timed
+
+
+def record(name, start, end=None):
+    ''' Record a span from ``start`` (a perf_counter value) to ``end`` or now '''
+    recorder = _recorder
+    if recorder is not None:
+        recorder.add(name, start, (perf_counter() if end is None else end) - start)
+
+
+def count(name, n=1):
+    recorder = _recorder
+    if recorder is not None:
+        recorder.count(name, n)
+
+
+def profile_startup(started):
+    ''' Time the startup phases from ``started`` (a perf_counter value) on '''
+    global _phases
+    _phases = [(None, started)]
+
+
+def phase(name, end=None):
+    ''' End the startup phase ``name`` now or at ``end``, also as a span when enabled '''
+    phases = _phases
+    if phases is not None:
+        end = perf_counter() if end is None else end
+        record('startup.' + name, phases[-1][1], end)
+        phases.append((name, end))
+
+
+def startup_report():
+    ''' The startup phases so far, in milliseconds each and since the start '''
+    lines = ['%-24s %9s %9s' % ('phase', 'ms', 'total')]
+    if _phases is None:
+        return lines[0]
+
+    origin = previous = _phases[0][1]
+    for name, end in _phases[1:]:
+        lines.append('%-24s %9.1f %9.1f' % (name, (end - previous) * 1000, (end - origin) * 1000))
+        previous = end
+    return '\n'.join(lines)
@@ -1,20 +1,33 @@
-from PySide6.QtWidgets import (QVBoxLayout, QHBoxLayout, QLabel, QPushButton, QWidget,
-                               QMainWindow, QApplication, QFrame, QWidgetItem)
-from PySide6.QtCore import QTimer, QRunnable, Slot, Signal, QObject, QThreadPool, QUrl
-from PySide6.QtQuick import QQuickView
-from PySide6.QtCore import (QFile, Qt, QTextStream)
-from PySide6.QtGui import (QColor, QFont, QFontDatabase, QKeySequence, QBrush,
-                           QSyntaxHighlighter, QTextCharFormat)
-from PySide6.QtWidgets import (QApplication, QFileDialog, QMainWindow,
-                               QPlainTextEdit, QFrame)
-
-import re
-import signal
+import argparse
+import hashlib
+import mmap
+import os
 import sys
+import threading
 import time
 import traceback
+from array import array
 
-from code_editor import Highlighter, LNTextEdit
+# Where --startup-profile starts counting.
+_import_started = time.perf_counter()
+
+from PySide6.QtCore import (QEvent, QFileSystemWatcher, QObject, QRunnable, QStandardPaths, Qt, QThreadPool,
+                            QTimer, Signal, Slot)
+from PySide6.QtGui import QBrush, QColor, QFont, QFontDatabase, QKeySequence, QTextCharFormat, QTextCursor
+from PySide6.QtWidgets import (QApplication, QDockWidget, QFileDialog, QHBoxLayout, QLabel, QMainWindow,
+                               QMessageBox, QPlainTextEdit, QProgressDialog, QPushButton, QVBoxLayout, QWidget)
+
+_qt_imported = time.perf_counter()
+
+from autosave import PatchJournal, apply_hunks, atomic_write, read_journal, remove_journal, write_journal
+from code_editor import FindBar, Highlighter, LNTextEdit
+from diff_cache import DiffCache
+from diff_engine import DiffCancelled, IncrementalDiff, diff_lines, fold_view, merge3
+import instrument
+from text_buffer import TextBuffer
+from text_model import TextModel
+
+_imported = time.perf_counter()
 
 
 class WorkerSignals(QObject):
@@ -68,6 +81,7 @@ class Worker(QRunnable):
 
         # Add the callback to our kwargs
         self.kwargs['progress_callback'] = self.signals.progress
+        self.queued = time.perf_counter()
 
     @Slot()
     def run(self):
@@ -75,6 +89,8 @@ class Worker(QRunnable):
         Initialise the runner function with passed args, kwargs.
         '''
 
+        instrument.record('worker.wait', self.queued)
+
         # Retrieve args/kwargs here; and fire processing using them
         try:
             result = self.fn(*self.args, **self.kwargs)
@@ -88,17 +104,429 @@ class Worker(QRunnable):
             self.signals.finished.emit()  # Done
 
 
+class DiffJob:
+    ''' One scheduled diff: the revision and snapshot it works on '''
+
+    def __init__(self, revision, old, new):
+        self.revision = revision
+        self.old = old
+        self.new = new
+        self.cancelled = threading.Event()
+        self.future = None
+
+    def cancel(self):
+        self.cancelled.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    def materialize(self):
+        ''' Turn lazy snapshot parts into sequences, on the worker thread '''
+        if callable(self.old):
+            self.old = self.old()
+        if callable(self.new):
+            self.new = self.new()
+
+
+@instrument.instrument_class
+class DiffScheduler(QObject):
+    '''
+    Runs diff jobs in the background, at most one useful job at a time.
+
+    Requests are debounced so that a burst of edits starts a single job.
+    Every job is tagged with the document revision it was requested for; a
+    running job is asked to stop as soon as a newer revision is requested and
+    results of outdated revisions are dropped, so the last delivered result
+    always belongs to the latest revision.
+
+    Jobs never touch Qt objects: ``snapshot`` is called on the GUI thread
+    when a job starts and returns the ``(old, new)`` sequences to diff.
+    Either may instead be a callable returning the sequence, which is then
+    called on the worker thread; that keeps building the lines of a large
+    snapshot off the GUI thread.  Jobs run on ``threadpool``; inputs above
+    ``process_threshold`` lines are handed on to a process pool, which keeps
+    the pure Python diff from holding the GIL of the GUI.  ``backend``
+    selects 'auto' (the default), 'thread' or 'process'.  A job whose
+    process pool fails, for instance with BrokenProcessPool, is diffed on
+    the thread instead, and 'auto' uses no process pool after that.
+
+    ``result`` is emitted on the GUI thread with the revision and a tuple
+    ``(old, new, hunks)``.
+    '''
+    result = Signal(int, object)
+
+    def __init__(self, snapshot, threadpool, debounce=150, backend='auto', parent=None):
+        super(DiffScheduler, self).__init__(parent)
+
+        self.snapshot = snapshot
+        self.threadpool = threadpool
+        self.backend = backend
+        self.process_threshold = 200000
+
+        # Latest requested revision, None when there is nothing to do.
+        self.revision = None
+        self._job = None
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._process_failed = False
+
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(debounce)
+        self._timer.timeout.connect(self._start)
+
+    @property
+    def debounce(self):
+        return self._timer.interval()
+
+    @debounce.setter
+    def debounce(self, msec):
+        self._timer.setInterval(msec)
+
+    def request(self, revision):
+        self.revision = revision
+        if self._job is not None and self._job.revision != revision:
+            self._job.cancel()
+
+        self._timer.start()
+
+    def cancel(self):
+        self.revision = None
+        self._timer.stop()
+        if self._job is not None:
+            self._job.cancel()
+
+    def shutdown(self):
+        self.cancel()
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def _use_process(self, job):
+        if self.backend == 'auto':
+            return not self._process_failed and len(job.old) + len(job.new) > self.process_threshold
+        return self.backend == 'process'
+
+    def _start(self):
+        if self.revision is None or self._job is not None:
+            # The running job is cancelled, _finished starts the next one.
+            return
+
+        old, new = self.snapshot()
+        job = self._job = DiffJob(self.revision, old, new)
+
+        worker = Worker(self._run, job)
+        worker.signals.result.connect(self._thread_finished)
+        self.threadpool.start(worker)
+
+    @instrument.probe('diff.full')
+    def _run(self, job, progress_callback):
+        # Always return the job, _thread_finished has to see every job end.
+        try:
+            job.materialize()
+            if self._use_process(job):
+                try:
+                    return job, self._run_process(job)
+                except Exception:
+                    traceback.print_exc()
+                    self._process_broken()
+            return job, diff_lines(job.old, job.new, cancelled=job.cancelled.is_set)
+        except DiffCancelled:
+            return job, None
+        except Exception:
+            traceback.print_exc()
+            return job, None
+
+    def _run_process(self, job):
+        with self._executor_lock:
+            if job.cancelled.is_set():
+                return None
+            if self._executor is None:
+                # Imported on first use, most sessions never get here.
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                # Forking a process that runs Qt threads is not safe.
+                self._executor = ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context('spawn'))
+            job.future = self._executor.submit(diff_lines, job.old, job.new)
+
+        from concurrent.futures import wait
+        # A process cannot be interrupted; on cancel stop waiting for it and
+        # let it finish unobserved.
+        while not wait([job.future], timeout=0.05).done:
+            if job.cancelled.is_set():
+                job.future.cancel()
+                return None
+
+        if job.future.cancelled():
+            return None
+        return job.future.result()
+
+    def _process_broken(self):
+        # Called on a worker thread; the next process job starts a new pool.
+        with self._executor_lock:
+            self._process_failed = True
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def _thread_finished(self, result):
+        job, hunks = result
+        self._result(job, hunks)
+        self._finished(job)
+
+    def _result(self, job, hunks):
+        if hunks is None or job.cancelled.is_set() or job.revision != self.revision:
+            return
+
+        self.revision = None
+        self.result.emit(job.revision, (job.old, job.new, hunks))
+
+    def _finished(self, job):
+        if job is not self._job:
+            return
+
+        self._job = None
+        if self.revision is not None and not self._timer.isActive():
+            self._start()
+
+
+class LoadJob:
+    ''' One file being read by FileLoader '''
+
+    def __init__(self, path):
+        self.path = path
+        self.cancelled = threading.Event()
+        # Chunks read ahead of the GUI; keeps a fast disk from queueing the
+        # whole file as events.
+        self.slots = threading.Semaphore(2)
+
+    def cancel(self):
+        self.cancelled.set()
+        self.slots.release()
+
+
+class FileLoader(QObject):
+    '''
+    Reads a text file on the thread pool and hands it out in chunks.
+
+    The file is memory-mapped where possible and cut at line breaks, so every
+    ``chunk`` but the last ends with a newline and appending them in order
+    rebuilds the text.  Text is decoded as UTF-8 with "\\r\\n" turned into
+    "\\n", like QTextStream on a QFile opened with QFile.Text.
+
+    ``chunk`` and ``progress`` (0-100) are emitted on the GUI thread while the
+    file is read, then ``finished`` with True, or False when the load was
+    cancelled or failed.
+    '''
+    chunk = Signal(str)
+    progress = Signal(int)
+    finished = Signal(bool)
+    _chunk_read = Signal(object, str, int)
+    _done = Signal(object, bool)
+
+    def __init__(self, threadpool, chunk_size=256 * 1024, parent=None):
+        super(FileLoader, self).__init__(parent)
+
+        self.threadpool = threadpool
+        self.chunk_size = chunk_size
+        self._job = None
+
+        self._chunk_read.connect(self._chunk_ready)
+        self._done.connect(self._finished)
+
+    def load(self, path):
+        self.cancel()
+        job = self._job = LoadJob(path)
+        self.threadpool.start(Worker(self._read, job))
+
+    def cancel(self):
+        if self._job is not None:
+            self._job.cancel()
+            self._job = None
+            self.finished.emit(False)
+
+    def is_loading(self):
+        return self._job is not None
+
+    def _read(self, job, progress_callback):
+        try:
+            with open(job.path, 'rb') as in_file:
+                size = os.fstat(in_file.fileno()).st_size
+                try:
+                    data = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+                except (OSError, ValueError):
+                    data = in_file.read()
+
+                try:
+                    complete = self._read_chunks(job, data)
+                finally:
+                    if isinstance(data, mmap.mmap):
+                        data.close()
+        except OSError:
+            traceback.print_exc()
+            complete = False
+
+        self._done.emit(job, complete)
+
+    def _read_chunks(self, job, data):
+        size = len(data)
+        encoding = 'utf-8-sig'
+        pos = 0
+        while pos < size:
+            end = data.rfind(b'\n', pos, pos + self.chunk_size) + 1
+            if pos + self.chunk_size >= size:
+                end = size
+            elif end <= pos:
+                # A line longer than a chunk is handed out whole.
+                end = data.find(b'\n', pos + self.chunk_size) + 1 or size
+
+            text = data[pos:end].decode(encoding, 'replace').replace('\r\n', '\n')
+            encoding = 'utf-8'
+            pos = end
+
+            job.slots.acquire()
+            if job.cancelled.is_set():
+                return False
+            self._chunk_read.emit(job, text, pos * 100 // size)
+
+        return not job.cancelled.is_set()
+
+    def _chunk_ready(self, job, text, percent):
+        if job is not self._job:
+            return
+
+        self.chunk.emit(text)
+        self.progress.emit(percent)
+        job.slots.release()
+
+    def _finished(self, job, complete):
+        if job is not self._job:
+            return
+
+        self._job = None
+        self.finished.emit(complete)
+
+
+class StatsPanel(QDockWidget):
+    '''
+    Dock listing the count and latency percentiles of every instrumented
+    span, refreshed every second while visible.
+    '''
+
+    def __init__(self, parent=None):
+        super(StatsPanel, self).__init__(parent.tr("Statistics") if parent else "Statistics", parent)
+
+        self._text = QPlainTextEdit()
+        self._text.setReadOnly(True)
+        self._text.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        self.setWidget(self._text)
+
+        self._timer = QTimer(self)
+        self._timer.setInterval(1000)
+        self._timer.timeout.connect(self.refresh)
+        self._timer.start()
+
+    def refresh(self):
+        recorder = instrument.current()
+        if recorder is None or not self.isVisible():
+            return
+
+        lines = ['%-20s %8s %10s %10s %10s %10s' % ('span', 'count', 'p50 ms', 'p99 ms', 'max ms', 'total ms')]
+        for name, stats in sorted(recorder.stats().items()):
+            lines.append('%-20s %8d %10.3f %10.3f %10.3f %10.1f' % (
+                name, stats['count'], stats['p50'], stats['p99'], stats['max'], stats['total']))
+        for name, value in sorted(recorder.counters.items()):
+            lines.append('%-20s %8d' % (name, value))
+        self._text.setPlainText('\n'.join(lines))
+
+
 """ MainWindow using to start and use PySide6 """
+@instrument.instrument_class
 class MainWindow(QMainWindow):
+    # Emitted once the services started and the file given to open_on_start,
+    # if any, is loaded.
+    started = Signal()
 
     def __init__(self, *args, **kwargs):
         super(MainWindow, self).__init__(*args, **kwargs)
 
         self.counter = 0
-        self.base_text = ''
-        self.code_text = ''
-        self.original_text = ''
-        self.worker_on_work = False
+
+        # Interned lines of the original and the working copy, None until
+        # there is an original to diff against.
+        self._model = None
+        # Diff of the original against the working copy as line ids, kept up
+        # to date from the editor's contentsChange; None while a full diff is
+        # pending.
+        self._diff = None
+        # Buffer snapshot of the working copy that _diff describes, and the
+        # diffs of earlier working copies by the digest of their text, so
+        # that undo or typing a change back needs no new diff.
+        self._diff_snapshot = None
+        self._diff_cache = DiffCache()
+        self._revision = 0
+        self._loading = False
+        # Edits touching more lines than this are diffed on the thread pool.
+        self.incremental_limit = 2000
+        self._loaded_model = None
+        # perf_counter at the start of the running load, for the open_file span.
+        self._open_started = 0.0
+        self._stats_panel = None
+
+        # Fold unchanged runs of the base pane further than context_lines
+        # from a change; _expanded holds the (old_start, old_end) ranges
+        # opened by a click.  _folded_keys describes the rows of the pane so
+        # that an update only rewrites the rows that changed.
+        self.fold_unchanged = False
+        self.context_lines = 3
+        self._expanded = []
+        self._folded = None
+        self._folded_keys = None
+
+        # While another version of the original is merged in, the base pane
+        # shows the merge of the working copy and ``_theirs`` (line ids of
+        # the model, with their hunks against the original) instead of the
+        # diff.  _merge_keys are the line ids shown, like _folded_keys.
+        self._theirs = None
+        self._theirs_hunks = None
+        self._theirs_name = ''
+        self._merge = None
+        self._merge_keys = None
+        self._merge_timer = QTimer(self)
+        self._merge_timer.setSingleShot(True)
+        self._merge_timer.setInterval(150)
+        self._merge_timer.timeout.connect(self.update_merge)
+
+        # File shown, which holds the original while _original_on_disk.
+        # Unsaved edits are journaled as hunks against the original every
+        # autosave_interval ms; _journal is None until the first autosave
+        # after the original changed.
+        self._file_path = None
+        self._original_on_disk = False
+        self._journal = None
+        self.autosave_interval = 30000
+        self._autosave_timer = QTimer(self)
+        self._autosave_timer.setInterval(self.autosave_interval)
+        self._autosave_timer.timeout.connect(self.autosave)
+        self._autosave_timer.start()
+
+        # Changes made to the file by other programs are applied to the
+        # working copy as edits, and to the original too with reload_base
+        # while the file holds it.  _disk is (stat, sha1, snapshot) of the
+        # file as last read or written, snapshot a BufferSnapshot of its
+        # text; a new stat is only read when the sha1 differs as well.
+        # Stat and sha1 are None while the file is missing, its directory
+        # is watched then.
+        self.reload_base = True
+        self._disk = None
+        self._saving = 0
+        self._checking = False
+        self._reloading = False
+        # Events come in bursts while a file is written.
+        self._watch_timer = QTimer(self)
+        self._watch_timer.setSingleShot(True)
+        self._watch_timer.setInterval(200)
+        self._watch_timer.timeout.connect(self.check_file)
 
         self.setWindowTitle("Widgets App")
 
@@ -115,14 +543,19 @@ class MainWindow(QMainWindow):
         button.setFixedWidth(200)
         button.setStyleSheet("QPushButton { background-color: #86a950; color: black;}")
         button.pressed.connect(self.make_original)
+        self._original_button = button
         self._highlighter = Highlighter(True, False)
         self._highlighter_baseDiff = Highlighter(True, True)
 
-        ln_editor = LNTextEdit()
+        # Find and replace in both panes, hidden until asked for.
+        self._find_bar = FindBar()
+        self._find_bar.hide()
 
         self.setup_file_menu()
 
         self.init_editors()
+        self._find_bar.add_editor(self._editor)
+        self._find_bar.add_editor(self._editor_base)
         # self.setup_base_diff()
 
         # editor = CodeEditor()
@@ -151,6 +584,7 @@ class MainWindow(QMainWindow):
             # self.label,
             # ln_editor,
             button,
+            self._find_bar,
             editors_widget
         ]
 
@@ -163,22 +597,105 @@ class MainWindow(QMainWindow):
         self.setCentralWidget(central_widget)
         # self.show()
 
+        # Highlighting and the diff, load and save machinery wait for the
+        # first paint, see start_services; so does the file given to
+        # open_on_start.
+        self._started = False
+        self._startup_file = None
+        self._loading_startup_file = False
+        self._load_progress = None
+        self._editor.edit.viewport().installEventFilter(self)
+
+    def open_on_start(self, path):
+        """ Open ``path`` once the window painted and the services started """
+        self._startup_file = path
+
+    def eventFilter(self, watched, event):
+        if event.type() == QEvent.Paint and watched is self._editor.edit.viewport():
+            watched.removeEventFilter(self)
+            # Right after this paint is done.
+            QTimer.singleShot(0, self.first_paint_done)
+        return super(MainWindow, self).eventFilter(watched, event)
+
+    def first_paint_done(self):
+        instrument.phase('first paint')
+        self.start_services()
+
+        path, self._startup_file = self._startup_file, None
+        if path:
+            self._loading_startup_file = True
+            self.open_file(path)
+        else:
+            self.started.emit()
+
+    def start_services(self):
+        """
+        Set up the highlighters and the diff, load and save machinery.
+
+        Left out of __init__ so the window shows first; runs after the first
+        paint, or earlier for the first action needing them.
+        """
+        if self._started:
+            return
+        self._started = True
+
+        self.highlighter_codePattern()
+        self.highlighter_diffPattern()
+        for highlighter, editor in ((self._highlighter, self._editor), (self._highlighter_baseDiff, self._editor_base)):
+            highlighter.setDocument(editor.edit.document())
+            highlighter.set_editor(editor.edit)
+        instrument.phase('highlighters')
+
         self.threadpool = QThreadPool()
-        print("Multithreading with maximum %d threads" % self.threadpool.maxThreadCount())
+        # Once per window, so the counter reads the pool size.
+        instrument.count('threadpool.max_threads', self.threadpool.maxThreadCount())
+
+        self._diff_scheduler = DiffScheduler(self.diff_snapshot, self.threadpool, parent=self)
+        self._diff_scheduler.result.connect(self.diff_ready)
+
+        self._file_loader = FileLoader(self.threadpool, parent=self)
+        self._file_loader.chunk.connect(self.load_chunk)
+        self._file_loader.finished.connect(self.load_finished)
+
+        # Saves and autosaves run here one at a time, in the order queued.
+        self._disk_pool = QThreadPool(self)
+        self._disk_pool.setMaxThreadCount(1)
+
+        self._watcher = QFileSystemWatcher(self)
+        self._watcher.fileChanged.connect(self.file_changed)
+        self._watcher.directoryChanged.connect(self.directory_changed)
+        instrument.phase('diff machinery')
 
     def make_original(self):
+        if self._theirs is not None:
+            self.accept_merge()
+            return
+
         text = self._editor.edit.document().toPlainText()
-        self._highlighter_baseDiff.clear_diff()
-        self._editor_base.edit.set_diff_line(self._highlighter_baseDiff.added_lines,
-                                             self._highlighter_baseDiff.removed_lines)
-        self._editor_base.edit.clear()
-        self.show_diff()
-        # time.sleep(1)
-        self._editor_base.edit.setPlainText(text)
-        # time.sleep(1)
-        self.code_text = text
-        self.base_text = text
-        self.original_text = text
+        self.reset_diff(TextModel(text.split('\n')))
+        self._original_on_disk = False
+        if not self.fold_unchanged:
+            self._editor_base.edit.setPlainText(text)
+
+    def reset_diff(self, model):
+        """ Start a new diff where the working copy equals the original of ``model`` """
+        self.start_services()
+        self._model = model
+        self._diff = IncrementalDiff(model.original, model.original, [])
+        self._diff_snapshot = self._editor.buffer.snapshot()
+        # Cached line ids belong to the previous model.
+        self._diff_cache.clear()
+        # The journal is against the previous original.
+        self._journal = None
+        # A full diff still running was made against the previous original.
+        self._diff_scheduler.cancel()
+
+        self._expanded = []
+        if self.fold_unchanged:
+            self._folded_keys = None
+            self.update_folded_view()
+        else:
+            self.set_diff_marks(self._diff)
 
     def progress_fn(self, n):
         # print("%d%% done" % n)
@@ -191,16 +708,294 @@ class MainWindow(QMainWindow):
 
         return "Done."
 
-    def print_output(self, s):
-        # print('>>>>>> len new base: ', len(s))
-        self._editor_base.edit.clear()
-        self._editor_base.edit.set_diff_line(self._highlighter_baseDiff.added_lines, self._highlighter_baseDiff.removed_lines)
-        self._editor_base.edit.setPlainText(s)
-        self.show_diff()
+    def closeEvent(self, event):
+        if self._started:
+            self._file_loader.cancel()
+            self._diff_scheduler.shutdown()
+        super(MainWindow, self).closeEvent(event)
+
+    def diff_snapshot(self):
+        """ Line ids of both documents for a diff job, GUI thread only """
+        model = self._model
+        snapshot = self._editor.buffer.snapshot()
+        # The working copy is split and interned by the worker.
+        return array('i', model.original), lambda: model.intern_lines(snapshot.lines())
+
+    def diff_ready(self, revision, result):
+        if revision == self._revision:
+            base_ids, code_ids, hunks = result
+            self.print_output(IncrementalDiff(base_ids, code_ids, hunks))
+            # No edit since the request: the buffer holds the text diffed.
+            self._diff_snapshot = self._editor.buffer.snapshot()
+            self.cache_diff()
+
+    def cache_diff(self):
+        """ Keep the current diff for the text it was made for """
+        diff = self._diff
+        if diff is None or self._diff_snapshot is None:
+            return
+
+        # IncrementalDiff copies what it is given, so the entry never changes.
+        new = array('i', diff.new)
+        hunks = list(diff.hunks)
+        self._diff_cache.put(self._diff_snapshot.digest(), (new, hunks),
+                             new.itemsize * len(new) + 100 * len(hunks) + 200)
+
+    @instrument.probe('diff.apply')
+    def print_output(self, diff):
+        if diff is None:
+            return
+
+        self._diff = diff
+        if self._theirs is not None:
+            self.update_merge()
+            return
+        if self.fold_unchanged:
+            self.update_folded_view()
+            return
+
+        # Marks first, then the listing.  Rows the pane already shows with
+        # the same line, mark and pair are kept, e.g. all but the rows around
+        # an undone edit; otherwise the whole listing is set in one go.
+        shown = self._highlighter_baseDiff.rows
+        self.set_diff_marks(diff)
+        rows = diff.listing_rows()
+        if shown is None or len(shown) != self._editor_base.edit.blockCount():
+            self._editor_base.edit.setPlainText(self._model.text(rows.lines))
+            return
+        row, count, new_count = rows.changed_rows(shown)
+        self._editor_base.edit.replace_lines(row, count, self._model.get_lines(rows.lines[row:row + new_count]))
+
+    def set_diff_marks(self, diff, rehighlight=False):
+        if diff is None:
+            self._highlighter_baseDiff.set_diff([], [], rehighlight)
+            self._editor_base.edit.set_diff_line()
+        else:
+            # Both read the rows realign keeps patched, see apply_diff_patch.
+            self._highlighter_baseDiff.set_diff_rows(diff.listing_rows())
+            self._editor_base.edit.set_diff_rows(diff.listing_rows(), bool(diff.hunks))
+        self._editor_base.number_bar.adjustWidth(self._editor_base.edit.blockCount())
+        self._editor_base.number_bar.update()
+
+    def apply_diff_patch(self, patch):
+        if patch is None:
+            return
+        if self._theirs is not None:
+            # Merged again once typing pauses.
+            self._merge_timer.start()
+            return
+        if self.fold_unchanged:
+            self.update_folded_view()
+            return
+
+        # realign already patched the marks, pairs and numbers of the rows
+        # replaced below, which rehighlights them; the rows after them only
+        # moved.  Only the width and the numbers from the patch down change.
+        diff = self._diff
+        edit = self._editor_base.edit
+        number_bar = self._editor_base.number_bar
+        rows = diff.listing_rows()
+        if self._highlighter_baseDiff.rows is not rows:
+            self._highlighter_baseDiff.set_diff_rows(rows)
+        edit.set_diff_rows(rows, bool(diff.hunks))
+        edit.replace_lines(patch.row, patch.count, self._model.get_lines(patch.lines))
+
+        number_bar.adjustWidth(edit.blockCount())
+        block = edit.document().findBlockByNumber(patch.row)
+        top = int(edit.blockBoundingGeometry(block).translated(edit.contentOffset()).top()) if block.isValid() else 0
+        if top < number_bar.height():
+            top = max(top, 0)
+            number_bar.update(0, top, number_bar.width(), number_bar.height() - top)
+
+    def set_folding(self, enabled):
+        """ Switch the base pane between the whole listing and the folded one """
+        self.fold_unchanged = enabled
+        self._folded = None
+        self._folded_keys = None
+        if self._diff is None or self._model is None or self._theirs is not None:
+            # A pending full diff, or the diff once the merge is over, is
+            # shown in the new mode.
+            return
+
+        if enabled:
+            self.update_folded_view()
+        else:
+            self.print_output(self._diff)
+
+    def update_folded_view(self):
+        """
+        Show the diff with unchanged runs folded into placeholder rows.
+
+        The pane only holds the rows shown, so layout, highlighting and the
+        gutter never see the folded lines.  Rows are compared by text, mark
+        and paired text with the rows already shown, and only the rows that
+        differ are rewritten, which keeps the scroll position and the
+        highlighting of the others.
+        """
+        diff = self._diff
+        view = fold_view(diff.old, diff.new, diff.hunks, self.context_lines, self._expanded)
+
+        lines = self._model.lines
+        text = [lines[line] if line >= 0 else self.fold_text(*view.folds[row])
+                for row, line in enumerate(view.lines)]
+        marks = dict.fromkeys(view.added, '+')
+        marks.update(dict.fromkeys(view.removed, '-'))
+        pairs = view.pairs
+        keys = [(line, marks.get(row), text[pairs[row] - 1] if row in pairs else None)
+                for row, line in enumerate(text, 1)]
+
+        self._folded = view
+        self._highlighter_baseDiff.set_diff(view.added, view.removed, False, pairs)
+        edit = self._editor_base.edit
+        edit.set_diff_line(view.old_numbers, view.new_numbers, bool(diff.hunks))
+
+        edit.splice_lines(self._folded_keys, keys, lambda start, end: text[start:end])
+        self._folded_keys = keys
+
+        self._editor_base.number_bar.adjustWidth(edit.blockCount())
+        self._editor_base.number_bar.update()
+
+    def fold_text(self, old_start, old_end):
+        return self.tr("\u22ef %d unchanged lines") % (old_end - old_start)
+
+    def expand_fold(self, row):
+        if not self.fold_unchanged or self._folded is None or self._theirs is not None:
+            return
+
+        fold = self._folded.folds.get(row)
+        if fold is not None:
+            self._expanded.append(fold)
+            self.update_folded_view()
+
+    def merge_file(self, path=""):
+        """
+        Merge another version of the original into the working copy.
+
+        The merge is shown in the base pane, conflicts between markers, and
+        follows the edits of the working copy until make_original accepts
+        it or abort_merge drops it.  The file is read and diffed against
+        the original on the thread pool.
+        """
+        if self._model is None:
+            self.statusBar().showMessage(self.tr("Make an original to merge against first"), 5000)
+            return
+        self.start_services()
 
-    def thread_complete(self):
-        print("THREAD COMPLETE!")
-        self.worker_on_work = False
+        file_name = path
+        if not file_name:
+            file_name, _ = QFileDialog.getOpenFileName(self, self.tr("Merge File"), "",
+                                                       "Python Files (*.py)")
+        if not file_name:
+            return
+
+        # The worker gets the lines themselves, ids may be renumbered by a
+        # compaction while it runs.
+        model = self._model
+        worker = Worker(self.read_theirs, file_name, model, model.lines, array('i', model.original))
+        worker.signals.result.connect(self.merge_ready)
+        worker.signals.error.connect(
+            lambda error: self.statusBar().showMessage(self.tr("Cannot merge: %s") % error[1], 5000))
+        self.threadpool.start(worker)
+
+    def read_theirs(self, path, model, lines, original, progress_callback):
+        with open(path, encoding='utf-8-sig', errors='replace', newline='') as in_file:
+            theirs = in_file.read().replace('\r\n', '\n').split('\n')
+
+        return model, path, theirs, diff_lines(list(map(lines.__getitem__, original)), theirs)
+
+    def merge_ready(self, result):
+        model, path, theirs, hunks = result
+        if model is not self._model:
+            # Another file was opened or made original meanwhile.
+            return
+
+        self._theirs = model.intern_lines(theirs)
+        self._theirs_hunks = hunks
+        self._theirs_name = os.path.basename(path)
+        self._merge_keys = None
+        self._original_button.setText(self.tr("Accept Merge"))
+        self._abort_merge_act.setEnabled(True)
+        self.update_merge()
+
+    def update_merge(self):
+        """
+        Merge the working copy and theirs again and show it in the base pane.
+
+        The hunks of the working copy come from the live diff and those of
+        theirs are kept, so only the merge walk runs; the rows are compared
+        with the ones shown and only those that differ are rewritten.
+        """
+        self._merge_timer.stop()
+        diff = self._diff
+        if self._theirs is None or diff is None:
+            # A pending full diff merges again when it is ready.
+            return
+
+        model = self._model
+        markers = [model.intern(marker) for marker in (
+            self.tr("<<<<<<< working copy"), "=======", self.tr(">>>>>>> %s") % self._theirs_name)]
+        merge = merge3(diff.old, diff.new, self._theirs, markers,
+                       ours_hunks=diff.hunks, theirs_hunks=self._theirs_hunks)
+        keys = array('i', merge.lines)
+
+        edit = self._editor_base.edit
+        edit.splice_lines(self._merge_keys, keys, lambda start, end: model.get_lines(keys[start:end]))
+        self._merge_keys = keys
+        self._merge = merge
+
+        # Rows coming from theirs are shown as added, conflicts as removed.
+        added = [row + 1 for start, end in merge.theirs for row in range(start, end)]
+        removed = [row + 1 for start, end in merge.conflicts for row in range(start, end)]
+        self._highlighter_baseDiff.set_diff(added, removed)
+        edit.set_diff_line()
+        self._editor_base.number_bar.adjustWidth(edit.blockCount())
+        self._editor_base.number_bar.update()
+
+        if merge.conflicts:
+            self.statusBar().showMessage(self.tr("Conflicts: %d") % len(merge.conflicts))
+        else:
+            self.statusBar().showMessage(self.tr("Merged without conflicts"))
+
+    def accept_merge(self):
+        """
+        Take the merge as the working copy and the merged version as the
+        original, so the diff shows what the working copy adds to it
+        """
+        self.update_merge()
+        model = self._model
+        merged = model.text(self._merge_keys)
+        theirs = model.get_lines(self._theirs)
+        self.end_merge()
+
+        self.reset_diff(TextModel(theirs))
+        self._original_on_disk = False
+        # The working copy only becomes the merge below.
+        self._diff_snapshot = None
+        if not self.fold_unchanged:
+            self._editor_base.edit.setPlainText('\n'.join(theirs))
+
+        # One edit, so the merge can be undone in the working copy.
+        cursor = QTextCursor(self._editor.edit.document())
+        cursor.select(QTextCursor.Document)
+        cursor.insertText(merged)
+
+    def abort_merge(self):
+        """ Drop the merge, the base pane shows the diff again """
+        self.end_merge()
+        if self._diff is not None:
+            self.print_output(self._diff)
+
+    def end_merge(self):
+        self._merge_timer.stop()
+        self._theirs = None
+        self._theirs_hunks = None
+        self._merge = None
+        self._merge_keys = None
+        # The base pane holds the merge, a folded view starts over.
+        self._folded_keys = None
+        self._original_button.setText(self.tr("Make Original"))
+        self._abort_merge_act.setEnabled(False)
+        self.statusBar().clearMessage()
 
     # def test(self):
     #     # Pass the function to execute
@@ -213,122 +1008,82 @@ class MainWindow(QMainWindow):
     #     self.threadpool.start(worker)
 
     def base_text_change(self):
-        print('>>>>> base_text_change start !')
+        instrument.count('base_text_change')
 
     def code_text_change(self):
-        print('>>>>> code_text_change start !')
-        worker = Worker(self.merge_and_diff)
-        worker.signals.result.connect(self.print_output)
-        worker.signals.finished.connect(self.thread_complete)
-        worker.signals.progress.connect(self.progress_fn)
-
-        # Execute
-        if not self.worker_on_work:
-            self.threadpool.start(worker)
-            self.worker_on_work = True
-
-    def merge_and_diff(self, progress_callback):
-        print('>>>>> merge_and_diff start !')
-        # QApplication.processEvents()
-        code_block_cnt = self._editor.edit.document().blockCount()
-        base_block_cnt = self._editor_base.edit.document().blockCount()
-        print('>>>>>>> code_block_cnt: ', code_block_cnt)
-        print('>>>>>>> base_block_cnt: ', base_block_cnt)
-
-        new_base_text = ''
-
-        base_cnt = 1
-        code_cnt = 1
-        additional_cnt = 0
-
-        if base_block_cnt <= 1:
-            return self.base_text
-        else:
-            self._editor_base.edit.setPlainText(self.original_text)
-            self._highlighter_baseDiff.clear_diff()
-
-        block = self._editor.edit.document().firstBlock()
-        base_block = self._editor_base.edit.document().firstBlock()
-
-        while block.isValid():
-            code_line = block.text()
-            base_line = base_block.text()
-            # print('>>>>>>> code_cnt: ', code_cnt)
-            # print('>>>>>>> base_cnt: ', base_cnt)
-            # print('>>>>>>> additional_cnt: ', additional_cnt)
-            # print('>>>>>>> code_line: ', code_line)
-            # print('>>>>>>> base_line: ', base_line)
-
-            if code_line == base_line:
-                new_base_text += (base_line + '\n') if (base_block.next().isValid() or block.next().isValid()) else base_line
-                base_cnt += 1
-                code_cnt += 1
-
-                block = block.next()
-                if base_block.next().isValid():
-                    base_block = base_block.next()
-            else:
-                base_text = self._editor_base.edit.document().toPlainText()
-                code_text = self._editor.edit.document().toPlainText()
-
-                base_text = base_text.split('\n')[base_cnt:]
-                code_text = code_text.split('\n')[code_cnt:]
-
-                # print('>>>>> block.isValid(): ', block.isValid(), ' , base_line in code_text: ', base_line in code_text, ' , code_line != base_line: ', code_line != base_line)
-
-                if (base_line in code_text) and block.isValid():
-                    # print('>>>>>>> base_line in code: ', code_text[0])
-                    new_base_text += (code_line + '\n') if (base_block.next().isValid() or block.next().isValid()) else base_line
-                    self.highlighter_diffPattern(True, base_cnt + additional_cnt, '1')
-                    code_cnt += 1
-                    additional_cnt += 1
-                    while code_line != base_line and block.isValid():
-                        block = block.next()
-                        code_line = block.text()
-                        if code_line != base_line:
-                            new_base_text += (code_line + '\n') if (base_block.next().isValid() or block.next().isValid()) else base_line
-                            self.highlighter_diffPattern(True, base_cnt + additional_cnt, '2')
-                            code_cnt += 1
-                            additional_cnt += 1
-                        if code_cnt > (code_block_cnt + base_block_cnt + 10) or base_cnt > (
-                                code_block_cnt + base_block_cnt + 10):
-                            break
-
-                # print('>>>>> base_block.isValid(): ', base_block.isValid(), ' , code_line in base_text: ', code_line in base_text, ' , code_line != base_line: ', code_line != base_line)
-                # print('>>>>>>> next code_line: ', code_line)
-                # print('>>>>>>> next base_line: ', base_line)
-
-                if (code_line in base_text) and code_line != base_line and base_block.isValid():
-                    new_base_text += (base_line + '\n') if (base_block.next().isValid() or block.next().isValid()) else base_line
-                    self.highlighter_diffPattern(False, base_cnt + additional_cnt, '3')
-                    base_cnt += 1
-                    while code_line != base_line and base_block.isValid():
-                        base_block = base_block.next()
-                        base_line = base_block.text()
-                        if code_line != base_line:
-                            new_base_text += (base_line + '\n') if (base_block.next().isValid() or block.next().isValid()) else base_line
-                            self.highlighter_diffPattern(False, base_cnt + additional_cnt, '4')
-                            base_cnt += 1
-                        if code_cnt > (code_block_cnt + base_block_cnt + 10) or base_cnt > (
-                                code_block_cnt + base_block_cnt + 10):
-                            break
-
-                if (code_line not in base_text) and code_line != base_line and (base_block.isValid() or block.isValid()) and (base_line not in code_text):
-                    new_base_text += (code_line + '\n') if (base_block.next().isValid() or block.next().isValid()) else base_line
-                    self.highlighter_diffPattern(True, base_cnt + additional_cnt, '5')
-                    code_cnt += 1
-                    new_base_text += (base_line + '\n') if (base_block.next().isValid() or block.next().isValid()) else base_line
-                    base_cnt += 1
-                    self.highlighter_diffPattern(False, base_cnt + additional_cnt, '6')
-                    additional_cnt += 1
-                    base_block = base_block.next()
-                    block = block.next()
-            progress_callback.emit(base_cnt * 100 / base_block_cnt)
-            if code_cnt > (code_block_cnt + base_block_cnt + 10) or base_cnt > (code_block_cnt + base_block_cnt + 10):
-                break
-
-        QApplication.processEvents()
-        return new_base_text
+        # Small edits, undone or not, are realigned in place by
+        # code_contents_change; only the ones re-diffed in full come here
+        # and look the text up in the cache.
+        instrument.count('code_text_change')
+        # The text being left may come back with an undo.
+        self.cache_diff()
+        self._diff = None
+        self._diff_snapshot = None
+
+        snapshot = self._editor.buffer.snapshot()
+        cached = self._diff_cache.get(snapshot.digest())
+        if cached is None:
+            instrument.count('diff_cache.miss')
+            self._diff_scheduler.request(self._revision)
+            return
+
+        instrument.count('diff_cache.hit')
+        # A job still running was made for an older revision.
+        self._diff_scheduler.cancel()
+        code_ids, hunks = cached
+        self.print_output(IncrementalDiff(self._model.original, code_ids, hunks))
+        self._diff_snapshot = snapshot
+
+    @instrument.probe('diff.incremental')
+    def code_contents_change(self, position, chars_removed, chars_added):
+        self._revision += 1
+        if self._loading or self._model is None or self._reloading:
+            return
+
+        if self._diff is None:
+            self.code_text_change()
+            return
+
+        document = self._editor.edit.document()
+        end = min(position + chars_added, document.characterCount() - 1)
+        start_line = document.findBlock(position).blockNumber()
+        added = document.findBlock(end).blockNumber() - start_line + 1
+        removed = added - (document.blockCount() - len(self._diff.new))
+
+        if removed < 1 or start_line + removed > len(self._diff.new):
+            # Out of sync with the document, start over.
+            self.code_text_change()
+            return
+
+        if removed + added > self.incremental_limit:
+            self.code_text_change()
+            return
+
+        lines = []
+        block = document.findBlockByNumber(start_line)
+        for _ in range(added):
+            lines.append(block.text())
+            block = block.next()
+
+        ids = self._model.intern_lines(lines)
+        if removed == added and ids == self._diff.new[start_line:start_line + removed]:
+            # Format only change, e.g. the highlighter marking blocks dirty.
+            return
+
+        self._diff.apply_edit(start_line, removed, ids)
+        self._diff_snapshot = self._editor.buffer.snapshot()
+        self.apply_diff_patch(self._diff.realign())
+
+        if len(self._model) > 2 * (len(self._diff.old) + len(self._diff.new)) + 4096:
+            # Drop the line versions typed over; no job in flight can use the
+            # old ids, it belongs to an older revision.
+            merging = () if self._theirs is None else (self._theirs,) + (
+                () if self._merge_keys is None else (self._merge_keys,))
+            cached = [ids for ids, _ in self._diff_cache.values()]
+            self._model.compact(self._diff.old, self._diff.new, *merging, *cached)
+            if self._journal is not None:
+                # It compares hunks by their line ids.
+                self._journal.forget()
 
     def setup_file_menu(self):
         file_menu = self.menuBar().addMenu(self.tr("&File"))
@@ -341,14 +1096,81 @@ class MainWindow(QMainWindow):
         open_file_act.setShortcut(QKeySequence(QKeySequence.Open))
         open_file_act.triggered.connect(self.open_file)
 
+        save_file_act = file_menu.addAction(self.tr("&Save"))
+        save_file_act.setShortcut(QKeySequence(QKeySequence.Save))
+        save_file_act.triggered.connect(self.save_file)
+
+        save_as_act = file_menu.addAction(self.tr("Save &As..."))
+        save_as_act.setShortcut(QKeySequence(QKeySequence.SaveAs))
+        save_as_act.triggered.connect(self.save_file_as)
+
+        merge_file_act = file_menu.addAction(self.tr("&Merge With..."))
+        merge_file_act.triggered.connect(self.merge_file)
+
+        self._abort_merge_act = file_menu.addAction(self.tr("&Abort Merge"))
+        self._abort_merge_act.setEnabled(False)
+        self._abort_merge_act.triggered.connect(self.abort_merge)
+
         quit_act = file_menu.addAction(self.tr("E&xit"))
         quit_act.setShortcut(QKeySequence(QKeySequence.Quit))
         quit_act.triggered.connect(self.close)
 
+        edit_menu = self.menuBar().addMenu(self.tr("&Edit"))
+
+        find_act = edit_menu.addAction(self.tr("&Find..."))
+        find_act.setShortcut(QKeySequence(QKeySequence.Find))
+        find_act.triggered.connect(lambda: self._find_bar.open_bar())
+
+        replace_act = edit_menu.addAction(self.tr("&Replace..."))
+        replace_act.setShortcut(QKeySequence(QKeySequence.Replace))
+        replace_act.triggered.connect(lambda: self._find_bar.open_bar(replace=True))
+
+        find_next_act = edit_menu.addAction(self.tr("Find &Next"))
+        find_next_act.setShortcut(QKeySequence(QKeySequence.FindNext))
+        find_next_act.triggered.connect(self._find_bar.find_next)
+
+        find_previous_act = edit_menu.addAction(self.tr("Find &Previous"))
+        find_previous_act.setShortcut(QKeySequence(QKeySequence.FindPrevious))
+        find_previous_act.triggered.connect(self._find_bar.find_previous)
+
+        view_menu = self.menuBar().addMenu(self.tr("&View"))
+
+        fold_act = view_menu.addAction(self.tr("&Collapse Unchanged Lines"))
+        fold_act.setCheckable(True)
+        fold_act.toggled.connect(self.set_folding)
+
+        self._stats_act = view_menu.addAction(self.tr("&Statistics"))
+        self._stats_act.setCheckable(True)
+        self._stats_act.toggled.connect(self.show_stats)
+
+    def show_stats(self, visible=True):
+        """ Show the latency panel; showing it turns the instrumentation on """
+        if visible and self._stats_panel is None:
+            instrument.enable()
+            self._stats_panel = StatsPanel(self)
+            self._stats_panel.visibilityChanged.connect(self._stats_act.setChecked)
+            self.addDockWidget(Qt.BottomDockWidgetArea, self._stats_panel)
+
+        if self._stats_panel is not None:
+            self._stats_panel.setVisible(visible)
+        self._stats_act.setChecked(visible)
+
     def new_file(self):
-        self.code_text = ''
-        self.base_text = ''
-        self.original_text = ''
+        self.start_services()
+        self._file_loader.cancel()
+        self.end_merge()
+        self._model = None
+        self._diff = None
+        self._diff_snapshot = None
+        self._diff_cache.clear()
+        self._file_path = None
+        self._original_on_disk = False
+        self._journal = None
+        self.unwatch_file()
+        self._diff_scheduler.cancel()
+        self.set_diff_marks(None)
+        self._folded = None
+        self._folded_keys = None
         self._editor_base.edit.clear()
         self._editor.edit.clear()
 
@@ -360,24 +1182,390 @@ class MainWindow(QMainWindow):
                                                        "Python Files (*.py)")
 
         if file_name:
-            in_file = QFile(file_name)
-            if in_file.open(QFile.ReadOnly | QFile.Text):
-                stream = QTextStream(in_file)
-                text = stream.readAll()
+            self.new_file()
+            self._file_path = file_name
+            self._open_started = time.perf_counter()
+
+            # Both panes are filled chunk by chunk with highlighting and
+            # diffing off; load_finished turns them back on.
+            self._loading = True
+            self._loaded_model = TextModel()
+            self._highlighter.setDocument(None)
+            self._highlighter_baseDiff.setDocument(None)
+            self._editor.edit.setReadOnly(True)
+            self._editor.edit.document().setUndoRedoEnabled(False)
+
+            self._load_progress = QProgressDialog(self.tr("Loading %s") % os.path.basename(file_name),
+                                                  self.tr("Cancel"), 0, 100, self)
+            self._load_progress.setMinimumDuration(500)
+            self._load_progress.canceled.connect(self._file_loader.cancel)
+            self._file_loader.progress.connect(self._load_progress.setValue)
+
+            self._file_loader.load(file_name)
+
+    @instrument.probe('open_file.chunk')
+    def load_chunk(self, text):
+        self._loaded_model.append_text(text)
+        # The folded base pane is filled from the diff once loaded.
+        editors = (self._editor,) if self.fold_unchanged else (self._editor, self._editor_base)
+        for editor in editors:
+            cursor = QTextCursor(editor.edit.document())
+            cursor.movePosition(QTextCursor.End)
+            cursor.insertText(text)
+
+    def load_finished(self, complete):
+        if self._load_progress is not None:
+            self._file_loader.progress.disconnect(self._load_progress.setValue)
+            self._load_progress.canceled.disconnect(self._file_loader.cancel)
+            self._load_progress.reset()
+            self._load_progress.deleteLater()
+            self._load_progress = None
+
+        model = self._loaded_model
+        self._loaded_model = None
+        self._loading = False
+        if self._loading_startup_file:
+            self._loading_startup_file = False
+            instrument.phase('open file')
+            QTimer.singleShot(0, self.started.emit)
+
+        self._editor.edit.document().setUndoRedoEnabled(True)
+        self._editor.edit.setReadOnly(False)
+        # Only the viewport is highlighted before the next paint, the rest
+        # of the file on idle ticks.
+        self._highlighter.setDocument(self._editor.edit.document())
+        self._highlighter_baseDiff.setDocument(self._editor_base.edit.document())
+
+        if not complete:
+            self.new_file()
+            return
+
+        # The base pane already holds the text.
+        self.reset_diff(model)
+        self._original_on_disk = True
+        instrument.record('open_file', self._open_started)
+        self.watch_file(self._file_path, self._editor.buffer.snapshot())
+        self.recover()
 
-                self._highlighter_baseDiff.clear_diff()
+    def save_file(self):
+        if self._file_path is None:
+            self.save_file_as()
+        else:
+            self.write_file(self._file_path)
 
-                self.code_text = text
-                self.base_text = text
-                self.original_text = text
+    def save_file_as(self):
+        file_name, _ = QFileDialog.getSaveFileName(self, self.tr("Save File"), self._file_path or "",
+                                                   "Python Files (*.py)")
+        if file_name:
+            self.write_file(file_name)
+
+    def write_file(self, path):
+        """
+        Save the working copy to ``path`` on the disk thread, through a
+        temporary file replacing the file once complete
+        """
+        self.start_services()
+        old_journal = self.journal_path(self._file_path) if self._file_path is not None else None
+        if path != self._file_path:
+            self.unwatch_file()
+        self._file_path = path
+        # The file no longer holds the original, unless nothing was changed;
+        # a new journal says so in its header.
+        self._original_on_disk = self._diff is not None and not self._diff.hunks
+        self._journal = None
+
+        # The watcher sees the file replaced; it is checked once saved.
+        self._saving += 1
+        worker = Worker(self._write_file, path, self._editor.buffer.snapshot(), old_journal)
+        worker.signals.result.connect(self.file_saved)
+        worker.signals.error.connect(self.save_failed)
+        self._disk_pool.start(worker)
+
+    def _write_file(self, path, snapshot, old_journal, progress_callback):
+        data = snapshot.text().encode('utf-8', 'surrogatepass')
+        atomic_write(path, data)
+        # The edits are in the file now.
+        if old_journal is not None:
+            remove_journal(old_journal)
+        # Hashed here rather than by the first check on the GUI thread.
+        snapshot.digest()
+        return path, (self.stat_key(os.stat(path)), hashlib.sha1(data).hexdigest(), snapshot)
+
+    def file_saved(self, result):
+        self._saving -= 1
+        self.statusBar().showMessage(self.tr("Saved %s") % result[0], 5000)
+        self.file_watched(result)
+
+    def save_failed(self, error):
+        self._saving -= 1
+        self.statusBar().showMessage(self.tr("Cannot save: %s") % error[1])
+
+    @staticmethod
+    def stat_key(stat):
+        """ What changes in the stat of a file written or replaced """
+        return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+    def watch_file(self, path, snapshot):
+        """
+        Watch the file at ``path`` for changes by other programs, ``snapshot``
+        holding its text; its stat and hash are taken on the disk thread
+        """
+        worker = Worker(self.file_state, path, snapshot)
+        worker.signals.result.connect(self.file_watched)
+        self._disk_pool.start(worker)
+
+    def file_state(self, path, snapshot, progress_callback):
+        snapshot.digest()
+        try:
+            with open(path, 'rb') as in_file:
+                stat = os.fstat(in_file.fileno())
+                sha1 = hashlib.sha1(in_file.read()).hexdigest()
+        except OSError:
+            # Deleted or renamed meanwhile.
+            return path, (None, None, snapshot)
+        return path, (self.stat_key(stat), sha1, snapshot)
+
+    def file_watched(self, result):
+        path, disk = result
+        if path != self._file_path:
+            return
+
+        # A missing file cannot be watched, its directory shows it coming back.
+        watched = [path] if disk[0] is not None else [os.path.dirname(os.path.abspath(path))]
+        if self._watcher.files() + self._watcher.directories() != watched:
+            self.unwatch_file()
+            self._watcher.addPaths(watched)
+        self._disk = disk
+
+    def unwatch_file(self):
+        self._disk = None
+        self._watch_timer.stop()
+        paths = self._watcher.files() + self._watcher.directories()
+        if paths:
+            self._watcher.removePaths(paths)
+
+    def file_changed(self, path):
+        # A file replaced by a rename is no longer watched, its successor is.
+        if path == self._file_path and path not in self._watcher.files() and os.path.exists(path):
+            self._watcher.addPath(path)
+        self._watch_timer.start()
+
+    def directory_changed(self, directory):
+        path = self._file_path
+        if path is not None and self._disk is not None and self._disk[0] is None and os.path.exists(path):
+            self._watcher.removePath(directory)
+            self._watcher.addPath(path)
+            self._watch_timer.start()
+
+    def check_file(self):
+        """
+        Look for a change of the file shown by another program.
+
+        The stat is compared first, then the hash of the contents on the
+        thread pool, so touching the file reads it but changes nothing.
+        What changed is diffed against the working copy when it equals the
+        file, against the original otherwise.
+        """
+        path = self._file_path
+        if path is None or self._disk is None or self._model is None:
+            return
+        if self._loading or self._saving or self._checking or self._diff is None:
+            # Checked again once they are done.
+            self._watch_timer.start()
+            return
 
-                # time.sleep(1)
-                self._editor_base.edit.clear()
-                self._editor_base.edit.setPlainText(text)
-                # time.sleep(1)
-                self._editor.edit.clear()
-                self._editor.edit.setPlainText(text)
-                # time.sleep(1)
+        try:
+            stat = self.stat_key(os.stat(path))
+        except OSError:
+            # Gone; the working copy is kept as it is until the file is back.
+            if self._disk[0] is not None:
+                self.file_watched((path, (None, None, self._disk[2])))
+                self.statusBar().showMessage(self.tr("%s deleted on disk") % os.path.basename(path))
+            return
+        if stat == self._disk[0]:
+            return
+
+        model = self._model
+        edited = self._editor.buffer.snapshot().digest() != self._disk[2].digest()
+        old = model.original if edited else self._diff.new
+        self._checking = True
+        worker = Worker(self.read_changes, path, self._revision, edited, self._disk[1],
+                        model, model.lines, array('i', old))
+        worker.signals.result.connect(self.file_reloaded)
+        worker.signals.error.connect(self.check_failed)
+        self.threadpool.start(worker)
+
+    def read_changes(self, path, revision, edited, sha1, model, lines, old, progress_callback):
+        with open(path, 'rb') as in_file:
+            stat = self.stat_key(os.fstat(in_file.fileno()))
+            data = in_file.read()
+        new_sha1 = hashlib.sha1(data).hexdigest()
+        if new_sha1 == sha1:
+            return path, revision, edited, model, stat, new_sha1, None, None, None
+
+        # Decoded like FileLoader does.
+        text = data.decode('utf-8-sig', 'replace').replace('\r\n', '\n')
+        disk = TextBuffer(text)
+        disk.digest()
+        new = text.split('\n')
+        hunks = diff_lines(list(map(lines.__getitem__, old)), new)
+        return path, revision, edited, model, stat, new_sha1, disk, new, hunks
+
+    def check_failed(self, error):
+        self._checking = False
+
+    def file_reloaded(self, result):
+        """ Apply what another program changed in the file shown """
+        self._checking = False
+        path, revision, edited, model, stat, sha1, disk, lines, hunks = result
+        if path != self._file_path or model is not self._model or self._disk is None:
+            return
+        if disk is None:
+            # Only touched: same contents.
+            self._disk = (stat, sha1, self._disk[2])
+            return
+        if revision != self._revision or self._diff is None or self._saving:
+            # Edited or saved meanwhile, the hunks are stale.
+            self._watch_timer.start()
+            return
+
+        self._disk = (stat, sha1, disk)
+        if edited:
+            # Unsaved edits: the new version is merged in and shown for
+            # review, like File > Merge With.
+            self.merge_ready((model, path, lines, hunks))
+            self.statusBar().showMessage(self.tr("%s changed on disk, merged with the working copy")
+                                         % os.path.basename(path))
+            return
+
+        self.apply_reload(lines, hunks)
+        self._disk = (stat, sha1, self._diff_snapshot)
+        self.statusBar().showMessage(self.tr("Reloaded %s") % os.path.basename(path), 5000)
+
+    def apply_reload(self, lines, hunks):
+        """
+        Apply ``hunks`` from the working copy to ``lines`` as one undoable
+        edit of the working copy.
+
+        The original takes the same edits while the file held it and the
+        diff stays empty; otherwise the diff is realigned around the hunks,
+        a run of nearby hunks at a time.
+        """
+        model = self._model
+        diff = self._diff
+        ids = model.intern_lines(lines)
+        base = (self.reload_base and self._original_on_disk and not diff.hunks
+                and self._theirs is None)
+        base_edit = None if self.fold_unchanged or not base else self._editor_base.edit
+
+        # Qt reports the edit block as one change, which the hunks below
+        # already describe.
+        self._reloading = True
+        cursor = QTextCursor(self._editor.edit.document())
+        cursor.beginEditBlock()
+        try:
+            # Bottom up, the rows of a hunk are then still the rows of the
+            # original, the base pane and the live diff.
+            dirty = None
+            for hunk in reversed(hunks):
+                count = hunk.old_end - hunk.old_start
+                new = ids[hunk.new_start:hunk.new_end]
+                self._editor.edit.replace_lines(hunk.old_start, count, model.get_lines(new))
+                if base:
+                    model.original[hunk.old_start:hunk.old_end] = new
+                    if base_edit is not None:
+                        base_edit.replace_lines(hunk.old_start, count, model.get_lines(new))
+                    continue
+
+                if dirty is not None and dirty - hunk.old_end > self.incremental_limit:
+                    self.apply_diff_patch(diff.realign())
+                diff.apply_edit(hunk.old_start, count, new)
+                dirty = hunk.old_start
+        finally:
+            cursor.endEditBlock()
+            self._reloading = False
+
+        if base:
+            self.reset_diff(model)
+            self._original_on_disk = True
+        else:
+            self.apply_diff_patch(diff.realign())
+        self._diff_snapshot = self._editor.buffer.snapshot()
+
+    def journal_path(self, path):
+        directory = QStandardPaths.writableLocation(QStandardPaths.AppLocalDataLocation)
+        name = hashlib.sha1(os.path.abspath(path).encode('utf-8', 'surrogateescape')).hexdigest()
+        return os.path.join(directory, 'autosave', name + '.journal')
+
+    def journal_header(self):
+        model = self._model
+        text = model.text(model.original)
+        header = {'path': self._file_path, 'sha1': hashlib.sha1(text.encode('utf-8', 'surrogatepass')).hexdigest()}
+        if not self._original_on_disk:
+            # Nothing to replay the hunks onto after a crash otherwise.
+            header['original'] = model.get_lines(model.original)
+        return header
+
+    def autosave(self):
+        """
+        Journal the hunks that changed since the last autosave, written on
+        the disk thread
+        """
+        diff = self._diff
+        if self._file_path is None or self._model is None or diff is None:
+            return
+        if self._journal is None:
+            if self._original_on_disk and not diff.hunks:
+                return
+            self._journal = PatchJournal(self.journal_path(self._file_path), self.journal_header())
+
+        model = self._model
+        hunks = {(hunk.old_start, hunk.old_end): diff.new[hunk.new_start:hunk.new_end] for hunk in diff.hunks}
+        data, rewrite = self._journal.update(hunks, lambda key, ids: model.get_lines(ids))
+        if data is None:
+            return
+
+        journal = self._journal
+        worker = Worker(lambda progress_callback: write_journal(journal.path, data, rewrite))
+        # Start over with a complete journal after a failed write.
+        worker.signals.error.connect(lambda error: journal.forget())
+        self._disk_pool.start(worker)
+
+    def recover(self):
+        """ Offer the edits journaled for the file just opened, left by a crash """
+        path = self.journal_path(self._file_path)
+        journal = read_journal(path)
+        if journal is None:
+            return
+
+        header, hunks = journal
+        original = header.get('original')
+        if original is None:
+            model = self._model
+            text = model.text(model.original)
+            if hashlib.sha1(text.encode('utf-8', 'surrogatepass')).hexdigest() != header.get('sha1'):
+                # Journaled against another version of the file.
+                self._disk_pool.start(Worker(lambda progress_callback: remove_journal(path)))
+                return
+
+        answer = QMessageBox.question(
+            self, self.tr("Recover"),
+            self.tr("%s has unsaved changes from an earlier session. Recover them?") % os.path.basename(self._file_path))
+        if answer != QMessageBox.Yes:
+            self._disk_pool.start(Worker(lambda progress_callback: remove_journal(path)))
+            return
+
+        if original is not None:
+            self.reset_diff(TextModel(original))
+            self._original_on_disk = False
+            if not self.fold_unchanged:
+                self._editor_base.edit.setPlainText('\n'.join(original))
+
+        lines = apply_hunks(self._model.get_lines(self._model.original), hunks)
+        # One edit, so the recovery can be undone.
+        cursor = QTextCursor(self._editor.edit.document())
+        cursor.select(QTextCursor.Document)
+        cursor.insertText('\n'.join(lines))
 
     def highlighter_codePattern(self):
         """ Try to add patterns for code style """
@@ -414,74 +1602,100 @@ class MainWindow(QMainWindow):
         # comment_format.setBackground(QColor("#999999"))
         comment_format.setForeground(QColor("#999999"))
         comment_format.setFontItalic(True)
-        # pattern = r"(\'{3}((.|\n)*?)\'{3})"
-        pattern = r"(((\'{3})|(\"{3}))((.|\n|\s|\0|\t|\r)*?)((\'{3})|(\"{3})))"
-        self._highlighter.add_mapping(pattern, comment_format)
-        self._highlighter_baseDiff.add_mapping(pattern, comment_format)
-
-    def highlighter_diffPattern(self, is_new, line, marker=''):
-        # print('>>>>> highlighter_diffPattern --> is_new: ', is_new, ' , line: ', line, ' , marker: ', marker)
-        if is_new:
-            diff_format_add = QTextCharFormat()
-            brush = QBrush(QColor("#dae8bc"), Qt.SolidPattern)
-            # diff_format_add.setForeground(QColor("#999999"))
-            # diff_format_add.setFontItalic(True)
-            # diff_format_add.setBackground(QColor("#dae8bc"))
-            diff_format_add.setBackground(brush)
-            self._highlighter_baseDiff.add_diff_mapping(line, diff_format_add, is_new)
-        else:
-            diff_format_remove = QTextCharFormat()
-            brush = QBrush(QColor("#f29b9b"), Qt.SolidPattern)
-            # keyword.setForeground(brush)
-            # diff_format_remove.setForeground(QColor("#999999"))
-            # diff_format_remove.setFontItalic(True)
-            diff_format_remove.setBackground(brush)
-            # diff_format_remove.setBackground(QColor("#f29b9b"))
-            self._highlighter_baseDiff.add_diff_mapping(line, diff_format_remove, is_new)
-
-    def show_diff(self):
-        self._highlighter_baseDiff.line_cnt = 1
-        font2 = QFontDatabase.systemFont(QFontDatabase.FixedFont)
-        self._editor_base.edit.setFont(font2)
-        self._highlighter_baseDiff.setDocument(self._editor_base.edit.document())
+        # Strings and docstrings may span lines, a regex only ever sees one
+        # block, so they are tracked with block states instead.
+        for delimiter in ("'''", '"""'):
+            self._highlighter.add_block_mapping(delimiter, comment_format)
+            self._highlighter_baseDiff.add_block_mapping(delimiter, comment_format)
+
+    def highlighter_diffPattern(self):
+        """
+        Formats for added and removed lines, shared by every changed line, and
+        the darker ones for the words that changed within a line.
+        """
+        diff_format_add = QTextCharFormat()
+        brush = QBrush(QColor("#dae8bc"), Qt.SolidPattern)
+        diff_format_add.setBackground(brush)
+
+        diff_format_remove = QTextCharFormat()
+        brush = QBrush(QColor("#f29b9b"), Qt.SolidPattern)
+        diff_format_remove.setBackground(brush)
+
+        inline_format_add = QTextCharFormat()
+        inline_format_add.setBackground(QBrush(QColor("#a9cc6a"), Qt.SolidPattern))
+
+        inline_format_remove = QTextCharFormat()
+        inline_format_remove.setBackground(QBrush(QColor("#e0625f"), Qt.SolidPattern))
+
+        self._highlighter_baseDiff.set_diff_formats(diff_format_add, diff_format_remove,
+                                                    inline_format_add, inline_format_remove)
+
+        conflict_format = QTextCharFormat()
+        conflict_format.setFontWeight(QFont.Bold)
+        conflict_format.setBackground(QBrush(QColor("#e0625f"), Qt.SolidPattern))
+        self._highlighter_baseDiff.add_mapping(r'^(<{7}|={7}|>{7})( .*)?$', conflict_format)
 
     def init_editors(self):
-        self.highlighter_codePattern()
-        # self.highlighter_diffPattern(True, 17)
-        # self.highlighter_diffPattern(False, 20)
-
         font = QFontDatabase.systemFont(QFontDatabase.FixedFont)
 
         # self._editor = QPlainTextEdit()
         self._editor = LNTextEdit()
 
         self._editor.edit.setFont(font)
-        self._editor.edit.textChanged.connect(self.code_text_change)
-        self._highlighter.setDocument(self._editor.edit.document())
+        self._editor.edit.document().contentsChange.connect(self.code_contents_change)
 
         font2 = QFontDatabase.systemFont(QFontDatabase.FixedFont)
 
         # self._editor_base = QPlainTextEdit()
-        self._editor_base = LNTextEdit()
+        # Snapshots are only taken of the working copy.
+        self._editor_base = LNTextEdit(keep_buffer=False)
 
         self._editor_base.edit.setFont(font2)
         # self._editor_base.edit.textChanged.connect(self.base_text_change)
         self._editor_base.edit.setReadOnly(True)
-        self._editor_base.edit.set_diff_line(self._highlighter_baseDiff.added_lines, self._highlighter_baseDiff.removed_lines)
-        self._highlighter_baseDiff.setDocument(self._editor_base.edit.document())
-
+        self._editor_base.edit.document().setUndoRedoEnabled(False)
+        self._editor_base.edit.set_diff_line()
+        self._editor_base.edit.clicked.connect(self.expand_fold)
 
-QML_IMPORT_NAME = "editor"
-QML_IMPORT_MAJOR_VERSION = 1
 
 if __name__ == "__main__":
-    app = QApplication(sys.argv)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file', nargs='?', help='file to open once the window shows')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='record timings and write them on exit, as JSONL for a .jsonl FILE, '
+                             'else as a Chrome trace')
+    parser.add_argument('--stats', action='store_true', help='show the statistics panel')
+    parser.add_argument('--startup-profile', action='store_true',
+                        help='print the time taken by each phase of the startup')
+    args, qt_args = parser.parse_known_args()
+
+    if args.trace:
+        instrument.enable()
+    if args.startup_profile:
+        instrument.profile_startup(_import_started)
+        instrument.phase('import Qt', _qt_imported)
+        instrument.phase('import editor', _imported)
+        instrument.phase('parse arguments')
+
+    app = QApplication(sys.argv[:1] + qt_args)
+    instrument.phase('QApplication')
 
     app.setOrganizationName('Chaboss')
     app.setOrganizationDomain('ChabossWorld')
 
     window = MainWindow()
+    instrument.phase('main window')
     window.resize(1200, 800)
+    if args.stats:
+        window.show_stats()
+    if args.file:
+        window.open_on_start(os.path.abspath(args.file))
+    if args.startup_profile:
+        window.started.connect(lambda: print(instrument.startup_report(), file=sys.stderr))
     window.show()
-    app.exec()
+    instrument.phase('show')
+    status = app.exec()
 
+    if args.trace:
+        instrument.disable().write(args.trace)
+    sys.exit(status)
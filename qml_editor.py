@@ -0,0 +1,281 @@
+'''
+Python types behind gui/qml/CodeEditor.qml, registered with QML as
+``import editor 1.0``.
+
+``CodeEditorBackend`` reads and writes the file on the thread pool and
+reports the outcome with ``loaded`` and ``saved``.  ``LineNumbers`` paints
+the gutter from the line count, the scroll offset and the cursor line alone,
+so scrolling the editor never hands the document text to it.
+
+    python qml_editor.py [FILE]
+'''
+import math
+import os
+import sys
+
+from PySide6.QtCore import Property, QObject, QRectF, Qt, QThreadPool, QUrl, Signal, Slot
+from PySide6.QtGui import QColor, QFont
+from PySide6.QtQml import QmlElement
+from PySide6.QtQuick import QQuickPaintedItem
+
+from autosave import atomic_write
+
+QML_IMPORT_NAME = "editor"
+QML_IMPORT_MAJOR_VERSION = 1
+
+
+@QmlElement
+class CodeEditorBackend(QObject):
+    '''
+    File of a QML CodeEditor: ``text`` is read by ``load`` and written by
+    ``save``, both on the thread pool.
+
+    ``loaded`` and ``saved`` are emitted on the GUI thread with True on
+    success; the result of a load superseded by a newer one is dropped.
+    Saving replaces the file in one step through a temporary file.
+    Text is decoded like FileLoader does: UTF-8, "\\r\\n" turned into "\\n".
+    '''
+    textChanged = Signal()
+    fileUrlChanged = Signal()
+    fileNameChanged = Signal()
+    busyChanged = Signal()
+    loaded = Signal(bool)
+    saved = Signal(bool)
+    _read_done = Signal(int, object)
+    _write_done = Signal(int, bool)
+
+    def __init__(self, parent=None):
+        super(CodeEditorBackend, self).__init__(parent)
+
+        self._text = ''
+        self._file_url = QUrl()
+        self._file_name = ''
+        # Number of the latest load or save, and how many are still running.
+        self._job = 0
+        self._running = 0
+
+        self._read_done.connect(self._read_finished)
+        self._write_done.connect(self._write_finished)
+
+    def _get_text(self):
+        return self._text
+
+    def _set_text(self, text):
+        if text != self._text:
+            self._text = text
+            self.textChanged.emit()
+
+    text = Property(str, _get_text, _set_text, notify=textChanged)
+
+    def _get_file_url(self):
+        return self._file_url
+
+    def _set_file_url(self, url):
+        url = QUrl(url)
+        if url != self._file_url:
+            self._file_url = url
+            self.fileUrlChanged.emit()
+            self._set_file_name(url.fileName())
+
+    fileUrl = Property(QUrl, _get_file_url, _set_file_url, notify=fileUrlChanged)
+
+    def _get_file_name(self):
+        return self._file_name
+
+    def _set_file_name(self, name):
+        if name != self._file_name:
+            self._file_name = name
+            self.fileNameChanged.emit()
+
+    fileName = Property(str, _get_file_name, _set_file_name, notify=fileNameChanged)
+
+    def _get_busy(self):
+        return self._running > 0
+
+    busy = Property(bool, _get_busy, notify=busyChanged)
+
+    @Slot(result=bool)
+    def load(self):
+        ''' Start reading ``fileUrl``, False if it is not a local file '''
+        path = self._file_url.toLocalFile()
+        if not path:
+            return False
+
+        job = self._start()
+        QThreadPool.globalInstance().start(lambda: self._read(job, path))
+        return True
+
+    @Slot(result=bool)
+    def save(self):
+        ''' Start writing ``text`` to ``fileUrl``, False if it is not a local file '''
+        path = self._file_url.toLocalFile()
+        if not path:
+            return False
+
+        job = self._start()
+        text = self._text
+        QThreadPool.globalInstance().start(lambda: self._write(job, path, text))
+        return True
+
+    def _start(self):
+        self._job += 1
+        self._running += 1
+        if self._running == 1:
+            self.busyChanged.emit()
+        return self._job
+
+    def _finish(self):
+        self._running -= 1
+        if not self._running:
+            self.busyChanged.emit()
+
+    def _read(self, job, path):
+        try:
+            with open(path, 'rb') as in_file:
+                text = in_file.read().decode('utf-8-sig', 'replace').replace('\r\n', '\n')
+        except OSError as error:
+            print('Cannot read %s: %s' % (path, error), file=sys.stderr)
+            text = None
+        self._read_done.emit(job, text)
+
+    def _write(self, job, path, text):
+        try:
+            atomic_write(path, text.encode('utf-8'))
+        except OSError as error:
+            print('Cannot write %s: %s' % (path, error), file=sys.stderr)
+            self._write_done.emit(job, False)
+        else:
+            self._write_done.emit(job, True)
+
+    def _read_finished(self, job, text):
+        self._finish()
+        if job != self._job:
+            return
+
+        if text is not None:
+            self._set_text(text)
+        self.loaded.emit(text is not None)
+
+    def _write_finished(self, job, ok):
+        self._finish()
+        self.saved.emit(ok)
+
+
+@QmlElement
+class LineNumbers(QQuickPaintedItem):
+    '''
+    Line number gutter of a QML text editor.
+
+    Bound to the editor's ``lineCount``, its scroll offset ``scrollY`` and
+    ``lineHeight`` in pixels and the 0-based ``currentLine``; only the
+    numbers of the lines in view are painted, the current one in bold.
+    '''
+    lineCountChanged = Signal()
+    scrollYChanged = Signal()
+    lineHeightChanged = Signal()
+    currentLineChanged = Signal()
+
+    def __init__(self, parent=None):
+        super(LineNumbers, self).__init__(parent)
+
+        self._line_count = 1
+        self._scroll_y = 0.0
+        self._line_height = 16.0
+        self._current_line = 0
+
+        self.setFillColor(QColor('#f0f0f0'))
+        self.setOpaquePainting(True)
+
+    def _get_line_count(self):
+        return self._line_count
+
+    def _set_line_count(self, count):
+        if count != self._line_count:
+            self._line_count = count
+            self.lineCountChanged.emit()
+            self.update()
+
+    lineCount = Property(int, _get_line_count, _set_line_count, notify=lineCountChanged)
+
+    def _get_scroll_y(self):
+        return self._scroll_y
+
+    def _set_scroll_y(self, y):
+        if y != self._scroll_y:
+            self._scroll_y = y
+            self.scrollYChanged.emit()
+            self.update()
+
+    scrollY = Property(float, _get_scroll_y, _set_scroll_y, notify=scrollYChanged)
+
+    def _get_line_height(self):
+        return self._line_height
+
+    def _set_line_height(self, height):
+        if height > 0 and height != self._line_height:
+            self._line_height = height
+            self.lineHeightChanged.emit()
+            self.update()
+
+    lineHeight = Property(float, _get_line_height, _set_line_height, notify=lineHeightChanged)
+
+    def _get_current_line(self):
+        return self._current_line
+
+    def _set_current_line(self, line):
+        if line != self._current_line:
+            self._current_line = line
+            self.currentLineChanged.emit()
+            self.update()
+
+    currentLine = Property(int, _get_current_line, _set_current_line, notify=currentLineChanged)
+
+    def visible_lines(self):
+        ''' The 0-based ``range`` of the lines in view '''
+        first = max(0, int(self._scroll_y // self._line_height))
+        last = min(self._line_count, int(math.ceil((self._scroll_y + self.height()) / self._line_height)))
+        return range(first, max(first, last))
+
+    def paint(self, painter):
+        width = self.width() - 4
+        height = self._line_height
+        font = painter.font()
+        bold = QFont(font)
+        bold.setBold(True)
+
+        painter.setPen(QColor('#808080'))
+        for line in self.visible_lines():
+            current = line == self._current_line
+            if current:
+                painter.setFont(bold)
+                painter.setPen(QColor('#202020'))
+            painter.drawText(QRectF(0, line * height - self._scroll_y, width, height),
+                             Qt.AlignRight | Qt.AlignVCenter, str(line + 1))
+            if current:
+                painter.setFont(font)
+                painter.setPen(QColor('#808080'))
+
+
+def main(argv=None):
+    from PySide6.QtGui import QGuiApplication
+    from PySide6.QtQuick import QQuickView
+
+    argv = sys.argv if argv is None else argv
+    app = QGuiApplication(argv[:1])
+
+    view = QQuickView()
+    view.setResizeMode(QQuickView.SizeRootObjectToView)
+    view.setSource(QUrl.fromLocalFile(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                   'gui', 'qml', 'CodeEditor.qml')))
+    if view.status() == QQuickView.Error:
+        return 1
+    if len(argv) > 1:
+        view.rootObject().open(QUrl.fromLocalFile(os.path.abspath(argv[1])))
+    view.resize(800, 600)
+    view.show()
+
+    return app.exec()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,289 @@
+'''
+Trigram index of the lines of a document, for find and replace.
+
+The lines are kept in chunks of about ``chunk_lines`` lines.  Each chunk has
+a signature: a bit mask with one bit set per trigram of its case folded
+text, hashed to ``MASK_BITS`` bits.  A query sets the bits of the trigrams
+every match has to contain, and only the chunks whose signature has all of
+them are searched; the others cannot hold a match.  Bits shared by hashing
+only let a chunk through that gets searched for nothing.
+
+An edit replaces the lines of the chunks it touches and clears their
+signatures; a chunk without one is always searched, until ``refresh``
+computes it again.
+
+>>> index = SearchIndex(['def load(path):', '    return open(path)', '', 'x = load("a")'])
+>>> [(match.row, match.start, match.end) for match in index.find(Query('load'))]
+[(0, 4, 8), (3, 4, 8)]
+>>> index.replace_lines(1, 1, ['    return None'])
+>>> [match.row for match in index.find(Query(r'open|None', regex=True))]
+[1]
+>>> index.find_next(Query('LOAD', case_sensitive=True), 0, 0) is None
+True
+>>> index.find_next(Query('load'), 3, 0, backward=True).row
+0
+>>> sorted(required_literals(r'foo(bar)+\\d|x')), sorted(required_literals(r'foo(bar)+\\d'))
+([], ['bar', 'foo'])
+'''
+from bisect import bisect_right
+from collections import namedtuple
+from itertools import accumulate
+import re
+import time
+
+try:
+    from re import _parser as _sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse as _sre_parse
+
+MASK_BITS = 1 << 14
+
+_REPEATS = tuple(getattr(_sre_parse, name) for name in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT')
+                 if hasattr(_sre_parse, name))
+
+# One match within a line: 0-based row, start and end column, and the
+# re.Match for expanding a replacement.
+Match = namedtuple('Match', 'row start end match')
+
+
+def _grams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _mask(grams):
+    bits = bytearray(MASK_BITS // 8)
+    for gram in grams:
+        bit = hash(gram) & (MASK_BITS - 1)
+        bits[bit >> 3] |= 1 << (bit & 7)
+    return int.from_bytes(bits, 'little')
+
+
+def required_literals(pattern, flags=0):
+    '''
+    Strings found in every match of the regular expression ``pattern``: the
+    runs of literal characters outside alternatives and optional parts
+    '''
+    try:
+        parsed = _sre_parse.parse(pattern, flags)
+    except (re.error, TypeError):
+        return []
+
+    literals = []
+    _collect_literals(parsed, literals)
+    return literals
+
+
+def _collect_literals(items, literals):
+    run = []
+    for op, value in items:
+        if op is _sre_parse.LITERAL:
+            run.append(chr(value))
+            continue
+
+        if run:
+            literals.append(''.join(run))
+            run = []
+        if op is _sre_parse.SUBPATTERN:
+            _collect_literals(value[-1], literals)
+        elif op in _REPEATS and value[0] >= 1:
+            _collect_literals(value[2], literals)
+    if run:
+        literals.append(''.join(run))
+
+
+class Query:
+    '''
+    What to find: ``pattern`` as a literal string or, with ``regex``, as a
+    regular expression.  Matches never span lines; empty ones are skipped.
+
+    Raises re.error for an invalid regular expression.
+    '''
+
+    def __init__(self, pattern, regex=False, case_sensitive=False):
+        self.pattern = pattern
+        self.regex = regex
+        self.case_sensitive = case_sensitive
+
+        flags = re.MULTILINE if case_sensitive else re.MULTILINE | re.IGNORECASE
+        self.compiled = re.compile(pattern if regex else re.escape(pattern), flags)
+        literals = required_literals(pattern, flags) if regex else [pattern]
+        self.mask = _mask(set().union(*(_grams(literal.casefold()) for literal in literals)))
+
+    def expand(self, match, template):
+        ''' Text replacing ``match``: ``template`` with group references expanded for a regex '''
+        return match.match.expand(template) if self.regex else template
+
+
+class _Chunk:
+    __slots__ = ('lines', 'text', 'starts', 'mask')
+
+    def __init__(self, lines):
+        self.lines = lines
+        # Joined text, offsets of its lines and signature, made when needed.
+        self.text = None
+        self.starts = None
+        self.mask = None
+
+    def get_text(self):
+        if self.text is None:
+            self.text = '\n'.join(self.lines)
+        return self.text
+
+    def get_starts(self):
+        if self.starts is None:
+            self.starts = [0]
+            self.starts.extend(accumulate(len(line) + 1 for line in self.lines[:-1]))
+        return self.starts
+
+
+class SearchIndex:
+    '''
+    Lines of a document cut into chunks with trigram signatures.
+
+    Building one computes every signature, which is best left to a worker
+    thread for a large document; after that only the chunks touched by
+    ``replace_lines`` need ``refresh``.
+    '''
+
+    def __init__(self, lines=(), chunk_lines=256):
+        self.chunk_lines = chunk_lines
+        lines = list(lines)
+        self._chunks = [_Chunk(lines[start:start + chunk_lines]) for start in range(0, len(lines), chunk_lines)]
+        # First row of every chunk, None after an edit until needed.
+        self._rows = None
+        self._dirty = set(self._chunks)
+        self.refresh()
+
+    def __len__(self):
+        rows = self._chunk_rows()
+        return rows[-1] + len(self._chunks[-1].lines) if rows else 0
+
+    def _chunk_rows(self):
+        if self._rows is None:
+            self._rows = [0]
+            self._rows.extend(accumulate(len(chunk.lines) for chunk in self._chunks[:-1]))
+            if not self._chunks:
+                self._rows = []
+        return self._rows
+
+    def _chunk_at(self, row):
+        ''' Index of the chunk holding ``row`` '''
+        return max(bisect_right(self._chunk_rows(), row) - 1, 0)
+
+    def replace_lines(self, row, count, lines):
+        ''' Replace ``count`` lines starting at the 0-based ``row`` by ``lines`` '''
+        chunks = self._chunks
+        if not chunks:
+            self._chunks = [_Chunk(list(lines))]
+            self._rows = None
+            self._dirty.add(self._chunks[0])
+            return
+
+        rows = self._chunk_rows()
+        first = self._chunk_at(row)
+        last = self._chunk_at(row + count - 1) if count else first
+        start = rows[first]
+        joined = []
+        for chunk in chunks[first:last + 1]:
+            joined.extend(chunk.lines)
+            self._dirty.discard(chunk)
+        joined[row - start:row - start + count] = lines
+
+        # Tiny chunks are merged into the next one.
+        if len(joined) < self.chunk_lines // 2 and last + 1 < len(chunks):
+            last += 1
+            joined.extend(chunks[last].lines)
+            self._dirty.discard(chunks[last])
+
+        size = self.chunk_lines
+        if len(joined) <= 2 * size:
+            replaced = [_Chunk(joined)] if joined else []
+        else:
+            replaced = [_Chunk(joined[pos:pos + size]) for pos in range(0, len(joined), size)]
+        chunks[first:last + 1] = replaced
+        self._dirty.update(replaced)
+        self._rows = None
+
+    def is_dirty(self):
+        return bool(self._dirty)
+
+    def refresh(self, deadline=None):
+        ''' Compute the missing signatures, False if ``deadline`` (perf_counter) passed first '''
+        dirty = self._dirty
+        while dirty:
+            chunk = dirty.pop()
+            chunk.mask = _mask(_grams(chunk.get_text().casefold()))
+            if deadline is not None and time.perf_counter() > deadline:
+                return not dirty
+        return True
+
+    def find(self, query, first=0, last=None):
+        ''' Matches of ``query`` in rows ``first`` to ``last`` (excluded), in order '''
+        rows = self._chunk_rows()
+        wanted = query.mask
+        for number in range(self._chunk_at(first), len(self._chunks)):
+            chunk_row = rows[number]
+            if last is not None and chunk_row >= last:
+                return
+            chunk = self._chunks[number]
+            if chunk.mask is not None and wanted & ~chunk.mask:
+                continue
+
+            lo = max(first - chunk_row, 0)
+            hi = len(chunk.lines) if last is None else min(last - chunk_row, len(chunk.lines))
+            if lo < hi:
+                yield from self._find_in_chunk(query, chunk, chunk_row, lo, hi)
+
+    def _find_in_chunk(self, query, chunk, chunk_row, lo, hi):
+        text = chunk.get_text()
+        starts = chunk.get_starts()
+        search = query.compiled.search
+        pos = starts[lo]
+        end = starts[hi - 1] + len(chunk.lines[hi - 1])
+        while pos <= end:
+            match = search(text, pos, end)
+            if match is None:
+                return
+
+            line = bisect_right(starts, match.start()) - 1
+            line_end = starts[line] + len(chunk.lines[line])
+            if match.end() > line_end:
+                # Ran into the next line; look again within this one.
+                match = search(text, match.start(), line_end)
+                if match is None:
+                    pos = line_end + 1
+                    continue
+
+            if match.end() > match.start():
+                yield Match(chunk_row + line, match.start() - starts[line], match.end() - starts[line], match)
+                pos = match.end()
+            else:
+                pos = match.end() + 1
+
+    def find_next(self, query, row, column, backward=False, wrap=True):
+        '''
+        First match starting at or after ``column`` of ``row``, or with
+        ``backward`` the last one ending at or before it; around the end of
+        the document with ``wrap``.  None if there is none.
+        '''
+        if not backward:
+            for match in self.find(query, row):
+                if match.row > row or match.start >= column:
+                    return match
+            return next(self.find(query, 0, row + 1), None) if wrap else None
+
+        # Chunk by chunk towards the start, the last match in each wins.
+        rows = self._chunk_rows()
+        numbers = list(range(self._chunk_at(row), -1, -1))
+        if wrap:
+            numbers += list(range(len(self._chunks) - 1, numbers[0] - 1 if numbers else -1, -1))
+        for pass_number, number in enumerate(numbers):
+            chunk_row = rows[number]
+            found = None
+            for match in self.find(query, chunk_row, chunk_row + len(self._chunks[number].lines)):
+                if pass_number == 0 and (match.row > row or match.row == row and match.end > column):
+                    break
+                found = match
+            if found is not None:
+                return found
+        return None
@@ -0,0 +1,265 @@
+'''
+Persistent text buffer for the editor panes.
+
+The text is kept as a balanced tree of string pieces.  Inserting and
+deleting only copies the O(log n) nodes on the path to the change, never the
+text, so the previous tree stays valid and ``snapshot`` is O(1): a snapshot
+keeps reading the text as it was, whatever happens to the buffer later.  Every
+node counts the characters and line breaks below it, which gives line lookups
+in O(log n) as well.  Nodes also remember a hash of the text below them
+once it was asked for, so ``digest`` identifies the content of a snapshot
+in O(log n) after an edit, however the text was cut into pieces by the
+edits that made it.
+
+>>> buffer = TextBuffer('one\\ntwo')
+>>> before = buffer.snapshot()
+>>> buffer.insert(4, 'and a half\\n')
+>>> buffer.delete(0, 4)
+>>> buffer.text(), buffer.line(1), buffer.line_count()
+('and a half\\ntwo', 'two', 2)
+>>> before.text(), before.lines()
+('one\\ntwo', ['one', 'two'])
+>>> buffer.replace(0, 11, 'one\\n')
+>>> buffer.digest() == before.digest()
+True
+
+Nothing here depends on Qt, so snapshots can be read from worker threads.
+'''
+import random
+
+
+# Longest piece created from inserted text; keeps splitting a piece cheap.
+MAX_PIECE = 4096
+
+# The hash of a text is its UTF-8 bytes read as a base 256 number modulo a
+# 64 bit prime.  With the hash and 256 ** bytes of two texts, the hash of
+# their concatenation takes two multiplications.
+_MODULUS = (1 << 64) - 59
+
+
+class _Node:
+    __slots__ = ('left', 'right', 'piece', 'piece_newlines', 'count', 'length', 'newlines',
+                 'piece_digest', 'digest')
+
+    def __init__(self, left, right, piece, piece_newlines, piece_digest=None):
+        self.left = left
+        self.right = right
+        self.piece = piece
+        self.piece_newlines = piece_newlines
+        # (hash, 256 ** bytes) of the piece and of the subtree, computed by
+        # _digest when first asked for; nodes never change, so they stay valid.
+        self.piece_digest = piece_digest
+        self.digest = None
+
+        count = 1
+        length = len(piece)
+        newlines = piece_newlines
+        if left is not None:
+            count += left.count
+            length += left.length
+            newlines += left.newlines
+        if right is not None:
+            count += right.count
+            length += right.length
+            newlines += right.newlines
+        self.count = count
+        self.length = length
+        self.newlines = newlines
+
+
+def _leaf(piece, left=None, right=None):
+    return _Node(left, right, piece, piece.count('\n'))
+
+
+def _with_children(node, left, right):
+    return _Node(left, right, node.piece, node.piece_newlines, node.piece_digest)
+
+
+def _digest(node):
+    if node is None:
+        return 0, 1
+
+    digest = node.digest
+    if digest is None:
+        piece_digest = node.piece_digest
+        if piece_digest is None:
+            data = node.piece.encode('utf-8', 'surrogatepass')
+            piece_digest = node.piece_digest = (int.from_bytes(data, 'big') % _MODULUS,
+                                                pow(256, len(data), _MODULUS))
+        left_hash, left_power = _digest(node.left)
+        right_hash, right_power = _digest(node.right)
+        hash, power = piece_digest
+        digest = node.digest = (((left_hash * power + hash) * right_power + right_hash) % _MODULUS,
+                                left_power * power * right_power % _MODULUS)
+
+    return digest
+
+
+def _build(pieces, lo, hi):
+    if lo >= hi:
+        return None
+
+    mid = (lo + hi) // 2
+    return _leaf(pieces[mid], _build(pieces, lo, mid), _build(pieces, mid + 1, hi))
+
+
+def _tree(text):
+    pieces = [text[pos:pos + MAX_PIECE] for pos in range(0, len(text), MAX_PIECE)]
+    return _build(pieces, 0, len(pieces))
+
+
+def _merge(left, right, rng):
+    # Randomized by subtree sizes (Martinez and Roura), so the tree stays
+    # balanced in expectation without storing priorities.
+    if left is None:
+        return right
+    if right is None:
+        return left
+
+    if rng.randrange(left.count + right.count) < left.count:
+        return _with_children(left, left.left, _merge(left.right, right, rng))
+    return _with_children(right, _merge(left, right.left, rng), right.right)
+
+
+def _split(node, pos, rng):
+    ''' Split into the trees of the first ``pos`` characters and the rest '''
+    if node is None:
+        return None, None
+
+    left_length = node.left.length if node.left is not None else 0
+    if pos <= left_length:
+        left, right = _split(node.left, pos, rng)
+        return left, _with_children(node, right, node.right)
+
+    pos -= left_length
+    if pos >= len(node.piece):
+        left, right = _split(node.right, pos - len(node.piece), rng)
+        return _with_children(node, node.left, left), right
+
+    left = _merge(node.left, _leaf(node.piece[:pos]), rng)
+    right = _merge(_leaf(node.piece[pos:]), node.right, rng)
+    return left, right
+
+
+class BufferSnapshot:
+    ''' Read-only view of a ``TextBuffer`` at one point in time '''
+
+    def __init__(self, root=None):
+        self._root = root
+
+    def __len__(self):
+        return self._root.length if self._root is not None else 0
+
+    def line_count(self):
+        return self._root.newlines + 1 if self._root is not None else 1
+
+    def digest(self):
+        '''
+        ``(length, hash)`` of the text, equal for equal texts whatever edits
+        made them; different texts share it with a chance of about 2 ** -64.
+
+        The first call hashes the whole text, later ones only the nodes
+        created by the edits in between.
+        '''
+        return (len(self), _digest(self._root)[0])
+
+    def text(self, start=0, end=None):
+        length = len(self)
+        end = length if end is None else min(end, length)
+        if start >= end:
+            return ''
+
+        parts = []
+        # In-order walk that skips the subtrees outside [start, end).
+        stack = []
+        node = self._root
+        offset = 0
+        while stack or node is not None:
+            if node is not None:
+                left_length = node.left.length if node.left is not None else 0
+                if offset + left_length > start:
+                    stack.append((node, offset))
+                    node = node.left
+                    continue
+                stack.append((node, offset))
+                node = None
+                continue
+
+            node, offset = stack.pop()
+            left_length = node.left.length if node.left is not None else 0
+            piece_start = offset + left_length
+            piece_end = piece_start + len(node.piece)
+            if piece_start >= end:
+                break
+            if piece_end > start:
+                parts.append(node.piece[max(start - piece_start, 0):end - piece_start])
+
+            offset = piece_end
+            node = node.right
+
+        return ''.join(parts)
+
+    def line_start(self, line):
+        ''' Offset of the first character of the 0-based ``line`` '''
+        if line <= 0:
+            return 0
+
+        node = self._root
+        offset = 0
+        while node is not None:
+            left_newlines = node.left.newlines if node.left is not None else 0
+            if line <= left_newlines:
+                node = node.left
+                continue
+
+            line -= left_newlines
+            offset += node.left.length if node.left is not None else 0
+            if line <= node.piece_newlines:
+                rest = node.piece.split('\n', line)[-1]
+                return offset + len(node.piece) - len(rest)
+
+            line -= node.piece_newlines
+            offset += len(node.piece)
+            node = node.right
+
+        raise IndexError('line out of range')
+
+    def line(self, line):
+        if not 0 <= line < self.line_count():
+            raise IndexError('line out of range')
+
+        start = self.line_start(line)
+        if line + 1 < self.line_count():
+            return self.text(start, self.line_start(line + 1) - 1)
+        return self.text(start)
+
+    def lines(self):
+        return self.text().split('\n')
+
+
+class TextBuffer(BufferSnapshot):
+    '''
+    Editable text with O(log n) edits and O(1) snapshots.
+    '''
+
+    def __init__(self, text=''):
+        super(TextBuffer, self).__init__(_tree(text))
+        self._rng = random.Random(0)
+
+    def snapshot(self):
+        return BufferSnapshot(self._root)
+
+    def insert(self, pos, text):
+        self.replace(pos, 0, text)
+
+    def delete(self, pos, length):
+        self.replace(pos, length, '')
+
+    def replace(self, pos, length, text):
+        if not 0 <= pos <= pos + length <= len(self):
+            raise IndexError('range out of the buffer')
+
+        rng = self._rng
+        left, rest = _split(self._root, pos, rng)
+        _, right = _split(rest, length, rng)
+        self._root = _merge(_merge(left, _tree(text), rng), right, rng)
@@ -0,0 +1,105 @@
+'''
+Line-interned text model shared by the editor panes.
+
+Every distinct line of a file is stored once and texts are ``array('i')`` of
+line ids, so the original and the working copy of a file cost one copy of
+its lines plus four bytes per line each.  The diff engine compares the ids.
+The documents of the two panes are Qt's own and still hold a copy each.
+
+>>> model = TextModel(['a', 'b', 'a'])
+>>> list(model.original), model.lines
+([0, 1, 0], ['a', 'b'])
+>>> working = model.intern_lines(['a', 'c', 'a'])
+>>> list(working), model.get_lines(working)
+([0, 2, 0], ['a', 'c', 'a'])
+'''
+from array import array
+from itertools import islice
+import threading
+
+
+class TextModel:
+    '''
+    Interned lines and the ids of the ``original`` text made of them.
+
+    Ids are only meaningful for the model that made them.  Lines that are no
+    longer used stay interned until ``compact`` drops them.
+
+    Lines may be interned from a worker thread while the GUI thread interns
+    its edits; long inputs take the lock in batches so neither waits long.
+    '''
+
+    def __init__(self, lines=('',)):
+        self._ids = {}
+        self._lock = threading.Lock()
+        self.lines = []
+        self.original = self.intern_lines(lines)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def intern(self, line):
+        with self._lock:
+            return self._intern(line)
+
+    def _intern(self, line):
+        line_id = self._ids.get(line)
+        if line_id is None:
+            line_id = self._ids[line] = len(self.lines)
+            self.lines.append(line)
+
+        return line_id
+
+    def intern_lines(self, lines):
+        ids = array('i')
+        lines = iter(lines)
+        while True:
+            with self._lock:
+                count = len(ids)
+                ids.extend(map(self._intern, islice(lines, 4096)))
+            if len(ids) - count < 4096:
+                return ids
+
+    def get_lines(self, ids):
+        return list(map(self.lines.__getitem__, ids))
+
+    def text(self, ids):
+        return '\n'.join(map(self.lines.__getitem__, ids))
+
+    def append_text(self, text):
+        '''
+        Append ``text`` to the original, its first line continues the last one.
+        '''
+        parts = text.split('\n')
+        original = self.original
+        original[-1] = self.intern(self.lines[original[-1]] + parts[0])
+        original.extend(self.intern_lines(parts[1:]))
+
+    def compact(self, *texts):
+        '''
+        Drop the lines not used by the original or ``texts``.
+
+        Ids are renumbered, the original and ``texts`` are updated in place;
+        any other id array of this model is invalid afterwards.
+        '''
+        with self._lock:
+            self._compact(texts)
+
+    def _compact(self, texts):
+        used = {id(self.original): self.original}
+        for ids in texts:
+            used[id(ids)] = ids
+
+        remap = {}
+        lines = []
+        for ids in used.values():
+            for line_id in ids:
+                if line_id not in remap:
+                    remap[line_id] = len(lines)
+                    lines.append(self.lines[line_id])
+
+        for ids in used.values():
+            ids[:] = array('i', map(remap.__getitem__, ids))
+
+        self.lines = lines
+        self._ids = {line: line_id for line_id, line in enumerate(lines)}